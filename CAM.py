@@ -3,21 +3,37 @@
 import os
 import sys
 import glob
-import pandas as pd
-import csv
+import functools
+import threading
+import subprocess
 
 current_path = os.path.realpath(__file__)
 cam_directory = os.path.dirname(current_path)
 current_path = os.path.dirname(current_path) + '/PRAGUI'
 
+# PRAGUI (rnaseq_pip_util, which imports pandas) is only imported by the stages that use it
+# (trim_galore, fastqc, multiqc), and numpy and pandas by aggregation and library QC,
+# so that --help and importing CAM from other pipelines stay fast (see cam/)
 sys.path.append(current_path)
-import rnaseq_pip_util as pragui
 
 current_path = current_path + '/cell_bio_util'
 sys.path.append(current_path)
 
 import cell_bio_util as util
 
+import guide_counts
+import count_vectors
+import index_cache
+import library_registry
+import aligner_scheduler
+import cpu_budget
+import protospacer
+import step_cache
+import run_report
+import demultiplex
+import count_table
+import progress
+
 
 PROG_NAME = 'CAM'
 DESCRIPTION = '''CRISPR Analysis Module - Software to process fastq files from a 
@@ -26,42 +42,190 @@ DESCRIPTION = '''CRISPR Analysis Module - Software to process fastq files from a
                  common softwares for statistical analysis).'''
 
 
-# Function to convert sam to bam using samtools:
-def convert_sam_to_bam(sam):
-  util.info('Converting %s to bam format so to save disk space...' % sam) 
-  bam_file = sam.strip('.sam') + '.bam'
-  cmdArgs = ['samtools','view','-bh',sam,'-o',bam_file]
-  util.call(cmdArgs)
-  os.remove(sam)
-  return(bam_file)
+# Function to run a command like util.call, recording its resource use in the run report
+def call(cmdArgs,stdout=None,stderr=None):
+  util.info('Running: %s' % ' '.join(cmdArgs))
+  returncode = run_report.get_report().call(cmdArgs,stdout=stdout,stderr=stderr)
+  if returncode != 0:
+    util.critical('%s failed with exit status %d.' % (cmdArgs[0],returncode))
+
+
+# Function to get the samtools command that compresses sam from stdin into a bam file,
+# or into a cram file against the reference fasta (the guide library, which 20 nt reads compress very well against)
+def compressed_writer(output,reference_fasta=None):
+  if output.endswith('.cram'):
+    return(['samtools','view','-C','-T',reference_fasta,'-o',output,'-'])
+  return(['samtools','view','-b','-o',output,'-'])
+
+
+# Function to write lines to the stdin of a process from a separate thread.
+# Any error while generating or writing the lines is kept in thread.error.
+def feed_stdin(proc,lines):
+  def write():
+    try:
+      for line in lines:
+        proc.stdin.write(line)
+    except BaseException as error:
+      thread.error = error
+    finally:
+      try:
+        proc.stdin.close()
+      except BrokenPipeError:
+        pass
+  thread = threading.Thread(target=write)
+  thread.error = None
+  thread.start()
+  return(thread)
+
+
+# Function to wait for the stdin feeder of an aligner and stop if it failed
+def join_feeder(feeder,aligner,log):
+  feeder.join()
+  if feeder.error is not None and not isinstance(feeder.error,BrokenPipeError):
+    util.critical('Failed to feed reads to %s: %s. Please check %s for more information.' % (aligner,feeder.error,log))
+
+
+# Function to run the aligner with its sam output piped straight into the guide counter.
+# If stream_bam is True, the sam stream is also teed into samtools to keep a bam file.
+# If reads is given, it is called to get the aligner input, which is written to the aligner stdin.
+def stream_aligner_counts(cmdArgs,log,counts_file,aligner,stream_bam=False,bam_file=None,collapsed=False,library=None,reads=None):
+  util.info('Counting guides on the fly from %s output...' % aligner)
+  report = run_report.get_report()
+  with open(log,'w') as log_obj:
+    stdin = None
+    if reads is not None:
+      stdin = subprocess.PIPE
+    aligner_proc = report.popen(cmdArgs,stdin=stdin,stdout=subprocess.PIPE,stderr=log_obj,universal_newlines=True)
+    if reads is not None:
+      feeder = feed_stdin(aligner_proc,reads())
+    sam_lines = aligner_proc.stdout
+    if stream_bam:
+      if bam_file is None:
+        bam_file = counts_file[:-len('_lib_guidecounts.txt')] + '.bam'
+      util.info('Saving %s output to %s...' % (aligner,bam_file))
+      samtools_proc = report.popen(compressed_writer(bam_file),stdin=subprocess.PIPE,universal_newlines=True)
+      sam_lines = guide_counts.tee_lines(sam_lines,samtools_proc.stdin)
+    counts, stats = guide_counts.count_sam_records(sam_lines,aligner=aligner,collapsed=collapsed)
+    aligner_proc.stdout.close()
+    if reads is not None:
+      join_feeder(feeder,aligner,log)
+    if report.wait(aligner_proc) != 0:
+      util.critical('%s failed. Please check %s for more information.' % (aligner,log))
+    if stream_bam:
+      samtools_proc.stdin.close()
+      if report.wait(samtools_proc) != 0:
+        util.critical('samtools failed to write %s.' % bam_file)
+  guide_counts.write_sam_counts(counts_file,counts,stats,library)
+  return(counts_file)
+
+
+# Function to run the aligner with its input written to its stdin from reads() 
+# and/or its output piped straight into a writer (see compressed_writer), so no sam file is written
+def pipe_aligner(cmdArgs,log,reads=None,writer=None):
+  aligner = cmdArgs[0]
+  report = run_report.get_report()
+  if writer is None:
+    util.info('Running %s with protospacers from the native trimmer...' % ' '.join(cmdArgs))
+  else:
+    util.info('Running: %s | %s' % (' '.join(cmdArgs),' '.join(writer)))
+  with open(log,'w') as log_obj:
+    stdin = None
+    if reads is not None:
+      stdin = subprocess.PIPE
+    stdout = None
+    if writer is not None:
+      stdout = subprocess.PIPE
+    aligner_proc = report.popen(cmdArgs,stdin=stdin,stdout=stdout,stderr=log_obj,universal_newlines=True)
+    if writer is not None:
+      writer_proc = report.popen(writer,stdin=aligner_proc.stdout)
+      aligner_proc.stdout.close() # Only the writer reads the pipe
+    if reads is not None:
+      feeder = feed_stdin(aligner_proc,reads())
+      join_feeder(feeder,aligner,log)
+    if report.wait(aligner_proc) != 0:
+      util.critical('%s failed. Please check %s for more information.' % (aligner,log))
+    if writer is not None and report.wait(writer_proc) != 0:
+      util.critical('%s failed to write the %s output.' % (' '.join(writer[:3]),aligner))
+
+
+# Function to run one aligner job on the given number of cores.
+# With stream_args, the aligner output is counted on the fly (see stream_aligner_counts),
+# so one core goes to the counter and, with stream_bam, another one to samtools.
+# With writer, the aligner output is compressed by samtools as it is written, which takes another core.
+# With reads (see protospacer.collapsed_fasta), the aligner reads its input from stdin 
+# and one more core goes to the thread that extracts the protospacers.
+def aligner_job(threads,cmd_head,cmd_tail,log,stream_args=None,reads=None,writer=None,sample=None):
+  # Progress of the sample: with reads, it is tracked while the protospacers are extracted. 
+  # Otherwise the aligner reads the fastq file itself, so only the start and end of the job are known.
+  tracker = None
+  if reads is None and sample is not None:
+    tracker = progress.get_progress().tracker(sample)
+    tracker.start()
+  if reads is not None:
+    threads = max(1, threads - 1)
+  if stream_args is None:
+    if writer is not None:
+      threads = max(1, threads - 1)
+    cmdArgs = cmd_head + ['-p',str(threads)] + cmd_tail
+    if reads is None and writer is None:
+      call(cmdArgs,stderr=log)
+    else:
+      pipe_aligner(cmdArgs,log,reads=reads,writer=writer)
+  else:
+    threads = max(1, threads - 1 - int(stream_args['stream_bam']))
+    cmdArgs = cmd_head + ['-p',str(threads)] + cmd_tail
+    stream_aligner_counts(cmdArgs=cmdArgs,log=log,reads=reads,**stream_args)
+  if tracker is not None:
+    tracker.done()
 
 
 # Function to run bowtie
-def run_aligner(trimmed_fq,fastq_dirs,aligner='bowtie2',guide_library='bassik',reference_fasta=None,genome_index=None,num_cpu=util.MAX_CORES, is_single_end=True,pair_tags=['r_1','r_2'],aligner_args=None,convert_to_bam=True):
+def run_aligner(trimmed_fq,fastq_dirs,aligner='bowtie2',guide_library='bassik',reference_fasta=None,genome_index=None,num_cpu=util.MAX_CORES, is_single_end=True,pair_tags=['r_1','r_2'],aligner_args=None,convert_to_bam=True,cram=False,collapsed=False,stream=False,stream_bam=False,index_cache_dir=None,trim_settings=None,delete_sam=False):
   # Generate genome indexes if not provided
   if aligner == 'bowtie':
-    genome_index_default = os.path.dirname(reference_fasta) + '/bt-genome/'
     index_builder = 'bowtie-build'
   elif aligner == 'bowtie2':
-    genome_index_default = os.path.dirname(reference_fasta) + '/bt2-genome/'
     index_builder = 'bowtie2-build'
   if aligner in [ 'bowtie', 'bowtie2']:
     if genome_index is None:
-      genome_index = genome_index_default
-      util.warn('Folder where %s indices are located hasn\'t been specified. Program will default to %s...' % (aligner,genome_index))
-      base = os.path.basename(reference_fasta).split('.')[:-1]
-      base = '.'.join(base)
-      base = genome_index + base
-      if not os.path.exists(genome_index):
-        os.mkdir(genome_index)
-        util.info('Bowtie2 indices not found. Generating indices...')
-        cmdArgs = [index_builder,reference_fasta,base]
-        util.call(cmdArgs)
-      genome_index = base
+      util.warn('Folder where %s indices are located hasn\'t been specified. Program will use the index cache in %s...' % (aligner,index_cache.cache_dir(index_cache_dir)))
+      # Indices are shared between runs and keyed on the fasta contents and the index builder version
+      util.info('Looking up %s indices for %s...' % (aligner,reference_fasta))
+      with cpu_budget.get_pool().tokens(1,'%s' % index_builder), run_report.get_report().stage('index'):
+        try:
+          genome_index, built = index_cache.get_index(reference_fasta,index_builder,index_cache_dir)
+        except RuntimeError as error:
+          util.critical(str(error))
+      if built:
+        util.info('%s indices not found. Indices generated in %s' % (aligner,os.path.dirname(genome_index)))
     
     # Alignment
     util.info('Aligning reads using %s...' % aligner)
     
+    # With the native trimmer, the unique protospacers of each (untrimmed) fastq file 
+    # are fed to the aligner on stdin as collapsed reads
+    if trim_settings is not None:
+      collapsed = True
+    
+    def aligner_input(f,sam):
+      if trim_settings is None:
+        return(f, None)
+      trim_log = sam[:-len('.sam')] + '.trimming.log'
+      return('-', functools.partial(protospacer.collapsed_fasta,f,trim_settings,trim_log))
+    
+    # Collapsed reads are in fasta format
+    input_args = []
+    if collapsed:
+      input_args = ['-f']
+    
+    # Guide library, used to write binary count vectors when streaming
+    library = None
+    if stream:
+      library = guide_counts.read_library(reference_fasta)
+    
+    # Alignments to run, as [estimated number of reads, job(threads)]
+    aligner_jobs = []
+    
     def format_aligner_input(trimmed_fq,aligner,aligner_args,is_single_end,convert_to_bam):
       if aligner == 'bowtie':
         ext = 'bt'
@@ -80,7 +244,7 @@ def run_aligner(trimmed_fq,fastq_dirs,aligner='bowtie2',guide_library='bassik',r
         return(sam_log_list)
     
     if aligner == 'bowtie':
-      if convert_to_bam:
+      if convert_to_bam or stream:
         sam_args = ['-S','--no-unal']
       else:
           sam_args = []
@@ -88,26 +252,9 @@ def run_aligner(trimmed_fq,fastq_dirs,aligner='bowtie2',guide_library='bassik',r
         aligner_args = ['-v', '0', '-m', '1', '--strata', '--best'] # allow no mismatches and report reads that align only once
         if guide_library == 'bassik':
           aligner_args = aligner_args + ['-5','1']
-      sam_log_list = format_aligner_input(trimmed_fq=trimmed_fq,aligner=aligner,aligner_args=aligner_args,is_single_end=is_single_end,convert_to_bam=convert_to_bam)
-      file_list = []
-      for f, sam , log in sam_log_list:
-        if convert_to_bam:
-          wd = os.path.dirname(sam)
-          sam_header = os.path.basename(sam).split('.')[:-1]
-          sam_header = '.'.join(sam_header)
-          check_exists = wd + '/' + sam_header + '.bam'
-        else:
-          check_exists = sam
-        file_list.append(sam)
-        if pragui.exists_skip(check_exists):
-        # Function pragui.exists_skip() determines if next step should go ahead.
-        # It skips the next step if the file path provided exists.
-        # This prevents overwriting files and also saves processing time.
-          cmdArgs = [aligner] + aligner_args + ['-p',str(num_cpu), genome_index,f] + sam_args + [sam]
-          util.call(cmdArgs,stderr=log)
           
     if aligner == 'bowtie2':
-      if convert_to_bam:
+      if convert_to_bam or stream_bam:
           header_opt = []
       else:
         header_opt = ['--no-hd']
@@ -116,233 +263,556 @@ def run_aligner(trimmed_fq,fastq_dirs,aligner='bowtie2',guide_library='bassik',r
         aligner_args = ['-N','0','--no-1mm-upfront','--score-min', 'L,0,0', '--no-unal'] + header_opt
         if guide_library == 'bassik':
           aligner_args = aligner_args + ['-5','1']
-      sam_log_list = format_aligner_input(trimmed_fq=trimmed_fq,aligner=aligner,aligner_args=aligner_args,is_single_end=is_single_end,convert_to_bam=convert_to_bam)
-      file_list = []
-      for f, sam , log in sam_log_list:
+    
+    # Index, input and (unless streaming) sam output arguments
+    def aligner_cmd_tail(reads_in,sam=None):
+      if aligner == 'bowtie':
+        cmd_tail = [genome_index,reads_in] + sam_args
+        if sam is not None:
+          cmd_tail = cmd_tail + [sam]
+      else:
+        cmd_tail = ['-x', genome_index,'-U', reads_in]
+        if sam is not None:
+          cmd_tail = cmd_tail + ['-S', sam]
+      return(cmd_tail)
+    
+    # Alignments are only skipped if they were completed with the same fastq file, index, 
+    # aligner version and arguments, and their outputs haven't changed since (see step_cache.py)
+    index_files = sorted(glob.glob(genome_index + '.*'))
+    def align_step(f,outputs,extra_args=[],tools=[],extra_inputs=[]):
+      args = aligner_args + input_args + extra_args
+      if trim_settings is not None:
+        args = args + [['native trimmer',sorted(trim_settings.items())]]
+      return(step_cache.Step('%s alignment' % aligner,outputs,inputs=[f] + index_files + extra_inputs,tools=[aligner] + tools,args=args))
+    
+    sam_log_list = format_aligner_input(trimmed_fq=trimmed_fq,aligner=aligner,aligner_args=aligner_args,is_single_end=is_single_end,convert_to_bam=convert_to_bam)
+    file_list = []
+    # Keys of the alignment steps of the sam files, which stand for the sam files deleted once counted (see sam_count_step)
+    alignment_keys = {}
+    # Steps run now, each committed as soon as its alignment is done
+    run_steps = []
+    for f, sam , log in sam_log_list:
+      cmd_head = [aligner] + aligner_args + input_args
+      reads_in, reads = aligner_input(f,sam)
+      if stream:
+        # Aligner output goes to stdout and guides are counted on the fly
+        counts_file = sam[:-len('.sam')] + '_lib_guidecounts.txt'
+        bam_file = sam[:-len('.sam')] + '.bam'
+        outputs = counts_outputs(counts_file,library is not None)
+        if stream_bam:
+          outputs.append(bam_file)
+        step = align_step(f,outputs,extra_args=['stream',collapsed],tools=['samtools'] if stream_bam else [])
+        file_list.append(counts_file)
+        if step.is_current():
+          util.info('%s is up to date. Skipping alignment...' % counts_file)
+          continue
+        step.start()
+        stream_args = {'counts_file':step.temp(counts_file),'aligner':aligner,'stream_bam':stream_bam,'bam_file':step.temp(bam_file),'collapsed':collapsed,'library':library}
+        job = functools.partial(aligner_job,cmd_head=cmd_head,cmd_tail=aligner_cmd_tail(reads_in),log=log,stream_args=stream_args,reads=reads,sample=os.path.basename(f))
+        run_steps.append(step)
+      else:
         if convert_to_bam:
-          wd = os.path.dirname(sam)
-          sam_header = os.path.basename(sam).split('.')[:-1]
-          sam_header = '.'.join(sam_header)
-          check_exists = wd + '/' + sam_header + '.bam'
+          # The aligner writes sam to stdout, compressed into bam (or cram) by samtools as it goes,
+          # so no uncompressed sam file is ever written
+          output = sam[:-len('.sam')] + ('.cram' if cram else '.bam')
+          if cram:
+            step = align_step(f,[output],extra_args=['samtools view -C'],tools=['samtools'],extra_inputs=[reference_fasta])
+          else:
+            step = align_step(f,[output],extra_args=['samtools view -b'],tools=['samtools'])
         else:
-          check_exists = sam
-        file_list.append(sam)
-        if pragui.exists_skip(check_exists):
-          cmdArgs = [aligner] + aligner_args + ['-p',str(num_cpu),'-x', genome_index,'-U', f, '-S', sam]
-          util.call(cmdArgs,stderr=log)
-            
-    # Convert sam to bam
-    if convert_to_bam is True:
-      file_list = []
-      for f, sam , log in sam_log_list:
-        wd = os.path.dirname(sam)
-        sam_header = os.path.basename(sam).split('.')[:-1]
-        sam_header = '.'.join(sam_header)
-        check_exists = wd + '/' + sam_header + '.bam'
-        if pragui.exists_skip(check_exists):
-          file = convert_sam_to_bam(sam=sam)
+          output = sam
+          step = align_step(f,[output])
+        file_list.append(output)
+        alignment_keys[output] = step.key
+        if delete_sam and sam_count_step(output,aligner,collapsed,reference_fasta,step.key).is_current():
+          util.info('Guides of %s are already counted. Skipping alignment...' % output)
+          continue
+        if step.is_current():
+          util.info('%s is up to date. Skipping alignment...' % output)
+          continue
+        step.start()
+        if convert_to_bam:
+          job = functools.partial(aligner_job,cmd_head=cmd_head,cmd_tail=aligner_cmd_tail(reads_in),log=log,reads=reads,sample=os.path.basename(f),
+                                  writer=compressed_writer(step.temp(output),reference_fasta))
         else:
-          file = check_exists
-        file_list.append(file)
+          job = functools.partial(aligner_job,cmd_head=cmd_head,cmd_tail=aligner_cmd_tail(reads_in,step.temp(output)),log=log,reads=reads,sample=os.path.basename(f))
+        run_steps.append(step)
+      aligner_jobs.append([aligner_scheduler.estimate_reads(f),functools.partial(run_step,step,job)])
     
-    return(file_list)
+    # Run the alignments of several samples at the same time, splitting the CPU pool into per-job threads
+    report = run_report.get_report()
+    if aligner_jobs:
+      with report.stage('alignment') as stage:
+        aligner_scheduler.run_jobs(aligner_jobs,cpu_budget.get_pool(),log=util.info)
+        if stream:
+          stage['reads'] = counted_reads([step.outputs[0] for step in run_steps])
+    
+    return(file_list, alignment_keys)
+
+
+# Function to get the total number of reads counted, from the .log files of counts files
+def counted_reads(counts_file_list):
+  reads = 0
+  for counts_file in counts_file_list:
+    counts_log = counts_file[:-len('.txt')] + '.log'
+    if os.path.exists(counts_log):
+      reads += guide_counts.stats_reads(guide_counts.read_count_log(counts_log))
+  return(reads)
+
+
+# Function to get the files written for a counts file: .txt, .log and, with vector, the .bin count vector
+def counts_outputs(counts_file,vector=True):
+  outputs = [counts_file, counts_file[:-len('.txt')] + '.log']
+  if vector:
+    outputs.append(count_vectors.vector_file(counts_file))
+  return(outputs)
+
+
+# Function to run a job that writes the temporary outputs of a cache step (see step_cache.py) and commit 
+# the step as soon as the job is done, so that the outputs of finished jobs are kept if another one fails
+def run_step(step,job,*args,**kwargs):
+  result = job(*args,**kwargs)
+  step.commit()
+  return(result)
+
+
+# Function to get the cache step of the counts files of a sam/bam file, keyed on the file and the guide library.
+# Sam files deleted once counted (-sam_output delete) are keyed on the alignment that wrote them instead, 
+# so their counts stay valid on reruns without the sam file.
+def sam_count_step(sam_file,aligner,collapsed=False,reference_fasta=None,alignment_key=None):
+  counts_file = os.path.splitext(sam_file)[0] + '_lib_guidecounts.txt'
+  inputs = []
+  if reference_fasta is not None:
+    inputs = [reference_fasta]
+  args = [aligner,collapsed]
+  if alignment_key is None:
+    inputs = [sam_file] + inputs
+  else:
+    args = args + [['alignment',alignment_key]]
+  return(step_cache.Step('sam counting',counts_outputs(counts_file,reference_fasta is not None),inputs=inputs,args=args))
+
+
+# Function to get the read 1 fastq files of the samples csv and the folders they are in.
+# Used instead of pragui.trim_bam when reads are trimmed in-process (-trimmer native).
+def samples_fastq(csv):
+  fastq_list = []
+  for row in csv:
+    # Samples demultiplexed from the same pooled fastq file share it
+    if row[1] not in fastq_list:
+      fastq_list.append(row[1])
+  fastq_dirs = []
+  for f in fastq_list:
+    fastq_dir = os.path.dirname(os.path.abspath(f))
+    if fastq_dir not in fastq_dirs:
+      fastq_dirs.append(fastq_dir)
+  return(fastq_list, fastq_dirs)
+
+
+# Function to run fastqc on untrimmed fastq files
+def run_fastqc(fastq_list,fastqc_args=None,num_cpu=util.MAX_CORES):
+  import rnaseq_pip_util as pragui
+  fastqc_list = []
+  for f in fastq_list:
+    base = os.path.basename(f)
+    for ext in ['.gz','.fastq','.fq']:
+      if base.endswith(ext):
+        base = base[:-len(ext)]
+    report = os.path.dirname(os.path.abspath(f)) + '/' + base + '_fastqc.html'
+    if pragui.exists_skip(report):
+      fastqc_list.append(f)
+  if fastqc_list:
+    util.info('Running fastqc on %d fastq files...' % len(fastqc_list))
+    cmdArgs = ['fastqc','-t',str(min(num_cpu,len(fastqc_list)))]
+    if fastqc_args:
+      cmdArgs = cmdArgs + fastqc_args.split(' ')
+    call(cmdArgs + fastqc_list)
+
+
+# Function to collapse identical reads so that only unique sequences are aligned.
+# Collapsed files are only reused if they were completed from the same fastq file (see step_cache.py).
+def collapse_reads(trimmed_fq,fastq_dirs,num_cpu=util.MAX_CORES):
+  
+  util.info('Collapsing identical reads before alignment...')
+  
+  collapsed_fq = []
+  collapse_steps = []
+  for f in trimmed_fq:
+    fo = fastq_dirs[0] + '/' + os.path.basename(f)
+    if fo.endswith('.gz'):
+      fo = fo[:-len('.gz')]
+    collapsed_fasta = fo + '.collapsed.fa'
+    collapsed_fq.append(collapsed_fasta)
+    step = step_cache.Step('read collapsing',[collapsed_fasta],inputs=[f])
+    if step.is_current():
+      util.info('%s is up to date. Skipping collapsing...' % collapsed_fasta)
+      continue
+    step.start()
+    collapse_steps.append([f, step])
+  
+  def collapse(fastq_step):
+    f, step = fastq_step
+    return(run_step(step,guide_counts.collapse_fastq,[f, step.temp(step.outputs[0])]))
+  
+  if collapse_steps:
+    pool = cpu_budget.get_pool()
+    num_workers = pool.workers(min(num_cpu,len(collapse_steps)))
+    with pool.tokens(num_workers,'read collapsing'):
+      util.parallel_split_job(collapse,collapse_steps,[],num_workers)
+  return(collapsed_fq)
+
+
+# Function to count guides directly from fastq files by exact sequence lookup, without alignment
+# With trim_settings, protospacers are first extracted from the untrimmed fastq files (see protospacer.py).
+# Counts are only reused if they were completed from the same fastq file, library and settings (see step_cache.py).
+def run_native_counter(trimmed_fq,fastq_dirs,reference_fasta,guide_library='bassik',num_cpu=util.MAX_CORES,mismatches=0,trim_settings=None):
+  
+  trim5 = 0
+  if guide_library == 'bassik':
+    trim5 = 1 # Same as aligner option -5 1
+  
+  step_args = [trim5,mismatches]
+  if trim_settings is not None:
+    step_args = step_args + [['native trimmer',sorted(trim_settings.items())]]
+  counts_file_list = []
+  fastq_counts_list = []
+  for f in trimmed_fq:
+    counts_file = fastq_dirs[0] + '/' + os.path.basename(f) + '_lib_guidecounts.txt'
+    counts_file_list.append(counts_file)
+    step = step_cache.Step('native counting',counts_outputs(counts_file),inputs=[f,reference_fasta],args=step_args)
+    if step.is_current():
+      util.info('%s is up to date. Skipping counting...' % counts_file)
+      continue
+    step.start()
+    fastq_counts_list.append([f, step])
+  if not fastq_counts_list:
+    return(counts_file_list)
+  
+  if mismatches:
+    util.info('Building lookup table of guide sequences with up to %d mismatch...' % mismatches)
+  library = guide_counts.read_library(reference_fasta,mismatches)
+  
+  util.info('Counting guides in fastq files by sequence lookup...')
+  count_func = guide_counts.count_fastq_file
+  common_args=[library,trim5]
+  if trim_settings is not None:
+    count_func = protospacer.count_fastq_file
+    common_args=[library,trim_settings,trim5]
+  
+  def count_step(fastq_step,*common_args,num_workers=1):
+    f, step = fastq_step
+    return(run_step(step,count_func,[f, step.temp(step.outputs[0])],*common_args,num_workers=num_workers))
+  
+  pool = cpu_budget.get_pool()
+  num_cpu = min(num_cpu,pool.total)
+  if len(fastq_counts_list) < num_cpu:
+    # Fewer files than cores: each file is split into chunks counted across all cores (see fastq_reader.py)
+    with pool.tokens(num_cpu,'chunked guide counting'):
+      for fastq_step in fastq_counts_list:
+        util.info('Counting %s in chunks on %d cores...' % (fastq_step[0],num_cpu))
+        count_step(fastq_step,*common_args,num_workers=num_cpu)
+    return(counts_file_list)
+  num_workers = pool.workers(min(num_cpu,len(fastq_counts_list)))
+  with pool.tokens(num_workers,'guide counting'):
+    util.parallel_split_job(count_step,fastq_counts_list,common_args,num_workers)
+  return(counts_file_list)
 
 
-# Function to run sam_parser_to_guide_counts.sh and to convert sam files to bam
-def sam_parser_parallel(file_list, convert_to_bam,aligner,num_cpu=util.MAX_CORES, remove_sam = True):
+# Function to demultiplex pooled fastq files by the barcode column of the samples csv and count the guides of each sample
+def run_demultiplexer(csv,barcode_col,fastq_dirs,reference_fasta,guide_library='bassik',num_cpu=util.MAX_CORES,mismatches=0,trim_settings=None,barcode_offset=0,barcode_mismatches=0):
+  
+  try:
+    pools = demultiplex.pooled_samples(csv,barcode_col)
+  except ValueError as error:
+    util.critical('%s. Please check the barcode column of the samples csv.' % error)
+  
+  trim5 = 0
+  if guide_library == 'bassik':
+    trim5 = 1 # Same as aligner option -5 1
+  
+  # Counts of a pooled file are only reused if they were completed from the same fastq file, 
+  # samples, library and settings (see step_cache.py)
+  step_args = [trim5,mismatches,barcode_offset,barcode_mismatches]
+  if trim_settings is not None:
+    step_args = step_args + [['native trimmer',sorted(trim_settings.items())]]
+  counts_file_list = []
+  pool_steps = []
+  for fastq, samples in pools.items():
+    counts_files = [fastq_dirs[0] + '/' + sample + '_lib_guidecounts.txt' for sample, barcode in samples]
+    counts_file_list += counts_files
+    outputs = [fastq_dirs[0] + '/' + os.path.basename(fastq) + '_demultiplex.log']
+    for counts_file in counts_files:
+      outputs += counts_outputs(counts_file)
+    step = step_cache.Step('demultiplexing',outputs,inputs=[fastq,reference_fasta],args=step_args + [[list(sample) for sample in samples]])
+    if step.is_current():
+      util.info('%s is up to date. Skipping demultiplexing...' % outputs[0])
+      continue
+    step.start()
+    pool_steps.append([fastq, samples, counts_files, step])
+  if not pool_steps:
+    return(counts_file_list)
+  
+  if mismatches:
+    util.info('Building lookup table of guide sequences with up to %d mismatch...' % mismatches)
+  library = guide_counts.read_library(reference_fasta,mismatches)
+  
+  # Each pooled file is read once, split into chunks counted across all cores (see fastq_reader.py)
+  pool = cpu_budget.get_pool()
+  num_cpu = min(num_cpu,pool.total)
+  with pool.tokens(num_cpu,'demultiplexing'):
+    for fastq, samples, counts_files, step in pool_steps:
+      util.info('Demultiplexing %s into %d samples and counting guides on %d cores...' % (fastq,len(samples),num_cpu))
+      temp_files = [step.temp(counts_file) for counts_file in counts_files]
+      temp_files, stats = demultiplex.count_pooled_fastq(fastq,samples,temp_files,library,trim_settings,trim5,barcode_offset,barcode_mismatches,num_cpu)
+      guide_counts.write_count_log(step.temp(step.outputs[0]),stats)
+      step.commit()
+      util.info('%s: %d reads, %d assigned to samples, %d without a known barcode and %d with an ambiguous barcode' % (fastq,stats['reads'],stats['assigned'],stats['unassigned'],stats['ambiguous_barcode']))
+  return(counts_file_list)
+
+
+# Function to count guides from sam/bam files.
+# Counts are only reused if they were completed from the same sam/bam file and library (see sam_count_step).
+# alignment_keys are the keys of the alignment steps of the sam files (see run_aligner).
+def sam_parser_parallel(file_list, convert_to_bam,aligner,num_cpu=util.MAX_CORES, remove_sam = True, collapsed = False, reference_fasta = None, alignment_keys = None):
   
   util.info('Parsing sam files to get guide counts...')
   
-  def sam_parser(sam_file,aligner,remove_sam = True):
-    ext = '.sam'
-    if '.bam' in sam_file:
-      ext = '.bam'
-    counts_file = sam_file.strip(ext) + '_lib_guidecounts.txt'
-    counts_log = sam_file.strip(ext) + '_lib_guidecounts.log'
-    sam_parser_to_guide_counts = os.path.dirname(os.path.realpath(__file__)) + '/sam_parser_to_guide_counts.sh'
-    if convert_to_bam:
-      util.info('Removing sam header from %s in order to proceed to read counting...' % sam_file)
-      # Remove header
-      temp = sam_file.strip(ext) + '_temp.sam'
-      # Remove unaligned reads if there are any. 
-      # This is particularly important when using bowtie because the --no-unal flag doesn't really work.
-      cmdArgs = ['samtools','view','-F','4',sam_file,'-o',temp] 
-      util.call(cmdArgs)
-      util.info('Counting reads from %s...' % sam_file)
-      cmdArgs = [sam_parser_to_guide_counts,temp,counts_file,aligner]
-      util.call(cmdArgs,stderr=counts_log)
-      os.remove(temp)
-    else:
-      util.info('Counting reads from %s...' % sam_file)
-      cmdArgs = [sam_parser_to_guide_counts,sam_file,counts_file,aligner]
-      util.call(cmdArgs,stderr=counts_log)
-    if remove_sam is True and ext is '.sam':
+  if alignment_keys is None:
+    alignment_keys = {}
+  counts_file_list = []
+  sam_steps = []
+  for sam_file in file_list:
+    alignment_key = None
+    if remove_sam is True and sam_file.endswith('.sam'):
+      alignment_key = alignment_keys.get(sam_file)
+    step = sam_count_step(sam_file,aligner,collapsed,reference_fasta,alignment_key)
+    counts_file_list.append(step.outputs[0])
+    if step.is_current():
+      util.info('%s is up to date. Skipping counting...' % step.outputs[0])
+      continue
+    step.start()
+    sam_steps.append([sam_file, step])
+  if not sam_steps:
+    return(counts_file_list)
+  
+  # Guide library, used to write binary count vectors
+  library = None
+  if reference_fasta is not None:
+    library = guide_counts.read_library(reference_fasta)
+  
+  def sam_parser(sam_step,aligner,remove_sam = True,collapsed = False,library = None,num_workers = 1):
+    sam_file, step = sam_step
+    ext = os.path.splitext(sam_file)[1]
+    counts_file = step.outputs[0]
+    util.info('Counting reads from %s...' % sam_file)
+    # Unaligned reads are skipped (same as samtools view -F 4), 
+    # which is particularly important when using bowtie because the --no-unal flag doesn't really work.
+    counts, stats = guide_counts.count_sam_file(sam_file,aligner=aligner,collapsed=collapsed,num_workers=num_workers,reference_fasta=reference_fasta)
+    guide_counts.write_sam_counts(step.temp(counts_file),counts,stats,library)
+    step.commit()
+    util.info('%s: %d mapped, %d unmapped and %d multimapped reads' % (sam_file,stats['mapped'],stats['unmapped'],stats['multimapped']))
+    if remove_sam is True and ext == '.sam':
       os.remove(sam_file)
+      step_cache.forget(sam_file)
     return(counts_file)
  
-  common_args=[aligner,remove_sam]
-  counts_file_list = util.parallel_split_job(sam_parser,file_list,common_args,num_cpu)
+  common_args=[aligner,remove_sam,collapsed,library]
+  # Each worker keeps a core busy (bam files are decoded in-process, see bam_reader.py),
+  # plus another one for samtools view when reading cram files
+  cost = 1
+  if any(sam_file.endswith('.cram') for sam_file, step in sam_steps):
+    cost = 2
+  pool = cpu_budget.get_pool()
+  num_cpu = min(num_cpu,pool.total)
+  if cost == 1 and len(sam_steps) < num_cpu:
+    # Fewer sam/bam files than cores: each sam file is split into chunks counted across all cores (see fastq_reader.py)
+    # and the blocks of each bam file are decompressed by threads on all cores
+    with pool.tokens(num_cpu,'chunked sam parsing'):
+      for sam_step in sam_steps:
+        sam_parser(sam_step,*common_args,num_workers=num_cpu)
+    return(counts_file_list)
+  num_workers = pool.workers(min(num_cpu,len(sam_steps)),cost)
+  with pool.tokens(num_workers * cost,'sam parsing'):
+    util.parallel_split_job(sam_parser,sam_steps,common_args,num_workers)
   return(counts_file_list)
 
 
-# Reformat data for compatibility with either MAGeCK or Bagel
+# Reformat data for compatibility with either MAGeCK or Bagel (see count_table.py)
 def tsv_format(counts_file_list,reference_fasta,software=list('mageck' or 'bagel')[1]):
   
-  wd = counts_file_list[0].split('/')[:-1]
-  wd = "/".join(wd)
-  counts_aggregated_file='%s/counts_aggregated_%s.tsv' % (wd,software)
+  if software not in count_table.SOFTWARE_COLUMNS:
+    util.critical('CRISPR software tool must be either mageck or bagel.')
   
+  counts_aggregated_file = count_table.aggregated_file(counts_file_list,software)
   util.info('Generating guide counts file in %s format. Results saved in %s...' % (software,counts_aggregated_file))
   
-  # Generates reference list of all library sgRNAs
-  fasta_obj = open(reference_fasta,'r')
-  sgrnas_list0 = []
-  sgRNA_output = []
-  gene_output = []
-  for line in fasta_obj:
-    if '>' in line:
-      line = line.rstrip('\n')
-      line = line.lstrip('>')
-      s,g = line.split("_", 1)
-      sgrnas_list0.append(line)
-      sgRNA_output.append(g)
-      gene_output.append(s)
-
-  # Generates reference Pandas data frame from sgRNA list library file
-  if software == 'mageck':
-    d0 = {'sgRNA':pd.Series(sgRNA_output),'gene':pd.Series(gene_output),'sgRNA2':pd.Series(sgrnas_list0)}
-  elif software == 'bagel':
-    d0 = {'SEQID':pd.Series(sgRNA_output),'GENE':pd.Series(gene_output),'sgRNA2':pd.Series(sgrnas_list0)}
-  else:
-    util.critical('CRISPR software tool must be either mageck or bagel.')
-  
-  dfjoin1 = pd.DataFrame(d0) #sgRNA/gene column required for MAGeCK, sgRNA2 is needed for join operation (deleted later)
-
-
+  # Generates Pandas data frame with sgRNA/gene columns (required for MAGeCK/Bagel) and one column per sample,
+  # written to a single .tsv file, ready for either MAGeCK or Bagel
   counts_file_list.sort()
-  counts_file_list2 = [w.replace('.txt','') for w in counts_file_list]
-  counts_file_list2 = [w.split('/')[-1] for w in counts_file_list2]
-  
-
-  # Counts number of .txt files in script folder
-  txtnumber = len(counts_file_list)
-
-  # Generates list of lists for join function output
-  cycle = 1
-  master_count_list0 = []
-  while cycle <= txtnumber:
-      master_count_list0.append("count_list"+ str(cycle))
-      cycle +=1
-  master_count_list1 = []
-  for i in master_count_list0:
-      master_count_list1.append([i])
-    
-  cycle = 1
-  master_sgrna_list0 = []
-  while cycle <= txtnumber:
-      master_sgrna_list0.append("sgrna_list"+ str(cycle))
-      cycle +=1
-  master_sgrna_list1 = []
-  for i in master_sgrna_list0:
-      master_sgrna_list1.append([i])
-  
-  if software == 'bagel':
-    cycle = 1
-    master_joined_count_list0 = []
-    while cycle <= txtnumber:
-        master_joined_count_list0.append("joined_count_list"+ str(cycle))
-        cycle +=1
-    master_joined_count_list1 = []
-    for i in master_joined_count_list0:
-        master_joined_count_list1.append([i])
-  
-  # Generates Pandas data frame and adds each of the count files in the folder to it after joining
-  counter = 0
-  while counter < txtnumber:
-      # Opens count files and extract counts and sgRNA names
-      file = list(csv.reader(open(counts_file_list [counter])))
-    
-      for x in file:
-          a = str(x)
-          if a.count(' ') > 1:
-              z,b,c = a.split()
-              bint = int(b)
-              cmod = c.replace("']","")
-              master_count_list1 [counter].append(bint)
-              master_sgrna_list1 [counter].append(cmod)
-          else:
-              b,c = a.split()
-              bint = b.replace("['","")
-              bint = int(bint)
-              cmod = c.replace("']","")
-              master_count_list1 [counter].append(bint)
-              master_sgrna_list1 [counter].append(cmod)
-    
-      # Generates Pandas data frame for the data
-      d1 = {'sgRNA2':pd.Series(master_sgrna_list1 [counter]),
-          counts_file_list2 [counter]:pd.Series(master_count_list1 [counter])}
-      df1 = pd.DataFrame(d1)
-
-      # Performs left join to merge Pandas data frames sets:
-      dfjoin1 = pd.merge(dfjoin1, df1, on='sgRNA2', how='left')
-      dfjoin1 = dfjoin1.fillna(0) #Replaces nan with zero
-       
-      counter +=1
-
-  # Deletes sgRNA2 column from dataframe (only needed for joining)
-  dfjoin2 = dfjoin1.drop(columns='sgRNA2')
- 
-  # Writes all data to a single .tsv file, ready for either MAGeCK or Bagel
-  dfjoin2.to_csv(counts_aggregated_file, sep='\t',index=False)
+  counts_aggregated_file, dfjoin2 = count_table.aggregate(counts_file_list,reference_fasta,software,counts_aggregated_file,warn=util.warn)
   
   return(dfjoin2)
 
 
 ######################## 
 # Wrapper function
-def CAM(samples_csv, reference_fasta=None, trim_galore=None, skipfastqc=False, fastqc_args=None, is_single_end=True, pair_tags=['r_1','r_2'], aligner='bowtie2', genome_index=None, aligner_args=None, sam_output='convert_to_bam', guide_library='bassik',software=list('mageck' or 'bagel')[1], multiqc=True, num_cpu=util.MAX_CORES):
+def CAM(samples_csv, reference_fasta=None, trim_galore=None, skipfastqc=False, fastqc_args=None, is_single_end=True, pair_tags=['r_1','r_2'], aligner='bowtie2', genome_index=None, aligner_args=None, sam_output='convert_to_bam', guide_library='bassik',software=list('mageck' or 'bagel')[1], trimmer='trim_galore', counter='aligner', mismatches=0, barcode_offset=0, barcode_mismatches=0, collapse=False, index_cache_dir=None, multiqc=True, num_cpu=util.MAX_CORES, progress_events=None):
 
   
+  if trimmer not in ['trim_galore','native']:
+    util.critical('trimmer flag has been misassigned. Please assign one of the following option: trim_galore or native. For help please type python3 CAM.py --help')
+  if counter not in ['aligner','native']:
+    util.critical('counter flag has been misassigned. Please assign one of the following option: aligner or native. For help please type python3 CAM.py --help')
+  if mismatches not in [0,1]:
+    util.critical('mismatches flag has been misassigned. Please assign either 0 or 1. For help please type python3 CAM.py --help')
+  if barcode_mismatches not in [0,1]:
+    util.critical('barcode_mismatches flag has been misassigned. Please assign either 0 or 1. For help please type python3 CAM.py --help')
+  if mismatches and counter != 'native':
+    util.warn('Option -mismatches only applies to -counter native. To allow mismatches with an aligner please use -aligner_args.')
+  
+  # Live progress of every stage and sample, as JSON lines (see progress.py)
+  events = progress.init_progress(progress_events)
+  
+  # CPU tokens shared by every stage, so that num_cpu is a budget for the whole run
+  pool = cpu_budget.init_pool(num_cpu,log=util.info)
+  num_cpu = pool.total
+  
+  # Time, CPU, memory and I/O of every stage, written to cam_run_report.json next to the counts files
+  report = run_report.init_report()
+  report.info.update({'samples_csv':samples_csv,'reference_fasta':reference_fasta,'trimmer':trimmer,'counter':counter,
+                      'aligner':aligner,'sam_output':sam_output,'num_cpu':num_cpu})
+  
+  # Bundled libraries can be given by name (e.g. brunello_human_lib)
+  reference_fasta = library_registry.resolve_fasta(reference_fasta)
+  
   convert_to_bam = False
+  cram = False
   remove_sam = True
+  stream = False
+  stream_bam = False
   
-  if sam_output not in ['sam','convert_to_bam','delete']:
-    util.critical('sam_output flag has been misassigned. Please assign one of the following option: sam, convert_to_bam or delete. For help please type python3 CAM.py --help')
-  elif sam_output == 'convert_to_bam':
+  if sam_output not in ['sam','convert_to_bam','cram','delete','stream','stream_bam']:
+    util.critical('sam_output flag has been misassigned. Please assign one of the following option: sam, convert_to_bam, cram, delete, stream or stream_bam. For help please type python3 CAM.py --help')
+  elif sam_output in ['convert_to_bam','cram']:
     convert_to_bam = True
+    cram = sam_output == 'cram'
   elif sam_output == 'sam':
     remove_sam = False
+  elif sam_output in ['stream','stream_bam']:
+    stream = True
+    stream_bam = sam_output == 'stream_bam'
   
   if isinstance(pair_tags, str):
     pair_tags = pair_tags.split(',')
   
+  import rnaseq_pip_util as pragui
   header, csv = pragui.parse_csv(samples_csv)
   
+  # Pooled fastq files with inline sample barcodes are demultiplexed while counting,
+  # so reads are trimmed in-process after their barcode and counted natively
+  barcode_col = demultiplex.barcode_column(header)
+  if barcode_col is not None:
+    util.info('Samples csv has a barcode column: pooled fastq files are demultiplexed while counting guides (barcode offset %d, %d mismatches)' % (barcode_offset,barcode_mismatches))
+    if trimmer != 'native':
+      util.info('Reads are trimmed in-process after their barcode (-trimmer native)')
+      trimmer = 'native'
+    if counter != 'native':
+      util.warn('Option -counter %s is ignored: demultiplexed reads are counted by sequence lookup (-counter native)' % counter)
+      counter = 'native'
+    report.info.update({'trimmer':trimmer,'counter':counter,'demultiplex':True})
+  
   if isinstance(aligner_args,str):
     aligner_args = aligner_args.split(' ')
   
-  # Fastq file trimming using trimgalore
-  # Defaults: --length 12 -e 0.2 -a GTTTAAGAGCTA ( only first 12 bp of adapter GTTTAAGAGCTAAGCTGGAAACAGCATAGCAA)
-  if trim_galore is None:
-    trim_galore='--length 11 -e 0.2 -a GTTTAAGAGCTA --clip_R1 1' # Allow up to two differences in adapter
-  trimmed_fq, fastq_dirs = pragui.trim_bam(samples_csv=samples_csv, csv=csv, trim_galore=trim_galore, skipfastqc=skipfastqc, fastqc_args=fastqc_args, 
-                                    is_single_end=is_single_end, pair_tags=pair_tags)
-
-  # Alignment
-  file_list = run_aligner(trimmed_fq=trimmed_fq,fastq_dirs=fastq_dirs,aligner=aligner,reference_fasta=reference_fasta,genome_index=genome_index, guide_library=guide_library,num_cpu=num_cpu, is_single_end=is_single_end,pair_tags=pair_tags,aligner_args=aligner_args,convert_to_bam=convert_to_bam)
+  trim_settings = None
+  if trimmer == 'native':
+    # Protospacers are extracted in-process while counting or aligning, so no trimmed fastq files are written.
+    # Same options as trim_galore. Without -a, the 3' vector of the library in libraries_info.csv is used.
+    adapter = library_registry.library_info(reference_fasta).get('vector_3prime')
+    trim_settings, ignored = protospacer.parse_trim_args(trim_galore,adapter)
+    if ignored:
+      util.warn('trim_galore options not used by the native trimmer: %s' % ' '.join(ignored))
+    util.info('Native trimmer: adapter %(adapter)s, error rate %(error_rate)s, minimum length %(min_length)d, 5\' clip %(clip5)d' % trim_settings)
+    trimmed_fq, fastq_dirs = samples_fastq(csv)
+    if not skipfastqc:
+      with pool.tokens(min(pool.total,len(trimmed_fq)),'fastqc'), report.stage('fastqc'):
+        run_fastqc(trimmed_fq,fastqc_args=fastqc_args,num_cpu=num_cpu)
+  else:
+    # Fastq file trimming using trimgalore
+    # Defaults: --length 12 -e 0.2 -a GTTTAAGAGCTA ( only first 12 bp of adapter GTTTAAGAGCTAAGCTGGAAACAGCATAGCAA)
+    if trim_galore is None:
+      trim_galore='--length 11 -e 0.2 -a GTTTAAGAGCTA --clip_R1 1' # Allow up to two differences in adapter
+    # trim_galore and fastqc manage their own parallelism, so they hold the whole pool
+    with pool.tokens(pool.total,'trimming and fastqc'), report.stage('trimming and fastqc'):
+      trimmed_fq, fastq_dirs = pragui.trim_bam(samples_csv=samples_csv, csv=csv, trim_galore=trim_galore, skipfastqc=skipfastqc, fastqc_args=fastqc_args, 
+                                        is_single_end=is_single_end, pair_tags=pair_tags)
+
+  report.path = fastq_dirs[0] + '/' + run_report.REPORT_FILE
+  report.write()
+
+  if barcode_col is not None:
+    # Reads of each pooled fastq file are routed to the counts of their sample in a single pass
+    with report.stage('demultiplexing and counting') as stage:
+      counts_file_list = run_demultiplexer(csv=csv,barcode_col=barcode_col,fastq_dirs=fastq_dirs,reference_fasta=reference_fasta,guide_library=guide_library,num_cpu=num_cpu,mismatches=mismatches,trim_settings=trim_settings,barcode_offset=barcode_offset,barcode_mismatches=barcode_mismatches)
+      stage['reads'] = counted_reads(counts_file_list)
+  elif counter == 'native':
+    # Count exact guide matches straight from the fastq files (no sam/bam files are written)
+    with report.stage('counting') as stage:
+      counts_file_list = run_native_counter(trimmed_fq=trimmed_fq,fastq_dirs=fastq_dirs,reference_fasta=reference_fasta,guide_library=guide_library,num_cpu=num_cpu,mismatches=mismatches,trim_settings=trim_settings)
+      stage['reads'] = counted_reads(counts_file_list)
+  else:
+    # Optionally collapse identical reads so that each unique sequence is aligned only once.
+    # The native trimmer always feeds collapsed reads to the aligner.
+    if trim_settings is not None:
+      collapse = True
+    elif collapse:
+      with report.stage('collapsing'):
+        trimmed_fq = collapse_reads(trimmed_fq=trimmed_fq,fastq_dirs=fastq_dirs,num_cpu=num_cpu)
+    
+    # Alignment
+    # When streaming, guides are counted from the aligner output and the counts files are returned
+    file_list, alignment_keys = run_aligner(trimmed_fq=trimmed_fq,fastq_dirs=fastq_dirs,aligner=aligner,reference_fasta=reference_fasta,genome_index=genome_index, guide_library=guide_library,num_cpu=num_cpu, is_single_end=is_single_end,pair_tags=pair_tags,aligner_args=aligner_args,convert_to_bam=convert_to_bam,cram=cram,collapsed=collapse,stream=stream,stream_bam=stream_bam,index_cache_dir=index_cache_dir,trim_settings=trim_settings,delete_sam=sam_output == 'delete')
 
-  # Bam files processing to create input for MAGeCK
-  # Run sam_parser_to_guide_counts.sh
-  counts_file_list = sam_parser_parallel(file_list=file_list,aligner=aligner,num_cpu=num_cpu,convert_to_bam=convert_to_bam)
+    if stream:
+      counts_file_list = file_list
+    else:
+      # Bam files processing to create input for MAGeCK
+      with report.stage('counting') as stage:
+        counts_file_list = sam_parser_parallel(file_list=file_list,aligner=aligner,num_cpu=num_cpu,convert_to_bam=convert_to_bam,remove_sam=remove_sam,collapsed=collapse,reference_fasta=reference_fasta,alignment_keys=alignment_keys)
+        stage['reads'] = counted_reads(counts_file_list)
   
   # Join all your individual alignment files (.txt) into one file that is suitable for either MAGeCK or Bagel analysis
-  dfjoin2 = tsv_format(counts_file_list=counts_file_list,reference_fasta=reference_fasta,software=software)
+  with report.stage('aggregation'):
+    dfjoin2 = tsv_format(counts_file_list=counts_file_list,reference_fasta=reference_fasta,software=software)
+  
+  # Gini index, 90/10 skew ratio, zero-count fraction, coverage and Lorenz curves of every sample
+  with report.stage('library qc'):
+    import library_qc
+    qc_dir = os.path.dirname(counts_file_list[0])
+    qc, fractions = library_qc.library_qc(dfjoin2.iloc[:,2:].to_numpy(),list(dfjoin2.columns[2:]))
+    qc_tsv, qc_json = library_qc.write_qc(qc,fractions,qc_dir)
+  util.info('Library QC saved in %s:' % qc_tsv)
+  for line in library_qc.summary(qc):
+    util.info(line)
 
   # Run Multiqc for quality control 
-  pragui.run_multiqc(multiqc=multiqc)
+  with pool.tokens(1,'multiqc'), report.stage('multiqc'):
+    pragui.run_multiqc(multiqc=multiqc)
+  
+  util.info('Peak CPU pool usage: %d/%d cores' % (pool.peak,pool.total))
+  report.info['peak_cpu_pool'] = pool.peak
+  report.write()
+  util.info('Run report saved in %s:' % report.path)
+  for line in report.summary():
+    util.info(line)
+  
+  counts_aggregated_file = count_table.aggregated_file(counts_file_list,software)
+  events.emit('run',state='done',counts_aggregated=counts_aggregated_file,report=report.path)
+  progress.init_progress()
+  return(counts_aggregated_file)
 
 
-if __name__ == '__main__':
+# Function to run CAM from command line arguments (sys.argv[1:] by default)
+def main(argv=None):
 
   from argparse import ArgumentParser
 
@@ -360,7 +830,9 @@ if __name__ == '__main__':
                                  For single-ended experiments, please fill read2 slot with NA.''')
 
   arg_parse.add_argument('reference_fasta', metavar='REFERENCE_FASTA',
-                         help='File path of guide RNAs\' reference sequence FASTA file (for use by genome aligner)')
+                         help='''File path of guide RNAs\' reference sequence FASTA file (for use by genome aligner), 
+                                 or name of one of the libraries bundled in Addgene_CRISPR_libraries_FASTA (e.g. brunello_human_lib).
+                                 Bundled libraries can be precompiled with: python3 library_registry.py compile-libraries''')
                     
   arg_parse.add_argument('-trim_galore',
                          default=None,
@@ -369,8 +841,17 @@ if __name__ == '__main__':
                                  If not provided, trimgalore will run with the following options:
                                  "--length 11 -e 0.2 -a GTTTAAGAGCTA --clip_R1 1"
                                  Please ensure these are suitable.
+                                 With -trimmer native, the options -a, -e, --length, --clip_R1 and --stringency are used.
                                  ''')
 
+  arg_parse.add_argument('-trimmer',default = 'trim_galore',
+                         help = '''Specify how adapters are trimmed. 
+                                 Options are: 
+                                 trim_galore (write trimmed fastq files with trim_galore), 
+                                 native (extract protospacers in-process while counting or aligning, no trimmed fastq files are written; 
+                                 the adapter is taken from -trim_galore or, if not given there, from the library 3' vector in libraries_info.csv). 
+                                 Default: trim_galore.''')
+
   arg_parse.add_argument('-fastqc_args', metavar='FASTQC',
                          default=None,
                          help='''Options to be provided to fastqc. 
@@ -386,6 +867,11 @@ if __name__ == '__main__':
   arg_parse.add_argument('-aligner_index', metavar='BOWTIE_REFERENCE_SEQUENCE_INDEX', default=None,
                          help='Path to directory where indices are stored (for either bowtie or bowtie2).')
 
+  arg_parse.add_argument('-index_cache', metavar='INDEX_CACHE_DIR', default=None,
+                         help='''Directory where aligner indices are cached when -aligner_index is not specified. 
+                                 Indices are reused by any run against the same fasta file and aligner version. 
+                                 Default: $CAM_INDEX_CACHE or ~/.cache/cam/indexes''')
+
   arg_parse.add_argument('-aligner_args', default=None,
                          help='''Options to be provided to the aligner. 
                                  They should be provided under double quotes. 
@@ -399,8 +885,11 @@ if __name__ == '__main__':
                          help='''Specify what to do with the sam file. 
                                  Options are: 
                                  sam (keep sam file), 
-                                 convert_to_bam (convert sam file to bam format), 
-                                 delete (delete sam file - best option to save disk space). 
+                                 convert_to_bam (compress the aligner output to bam format as it is written, no sam file is written), 
+                                 cram (as convert_to_bam, but in cram format against the guide library fasta, which is much smaller), 
+                                 delete (delete sam file - best option to save disk space), 
+                                 stream (count guides on the fly from the aligner output, no sam file is written), 
+                                 stream_bam (as stream, but also save the aligner output as a bam file). 
                                  Default is set to convert_to_bam.''')
   
   arg_parse.add_argument('-guide_library',default='bassik',
@@ -409,6 +898,30 @@ if __name__ == '__main__':
   arg_parse.add_argument('-crispr_software',default = 'mageck',
                          help = 'Specify whether you want your guide counts in MAGeCK or Bagel compatible format. Default: MAGeCK.')
   
+  arg_parse.add_argument('-counter',default = 'aligner',
+                         help = '''Specify how guides are counted. 
+                                 Options are: 
+                                 aligner (align reads with bowtie/bowtie2 and count the sam/bam files), 
+                                 native (count exact guide sequence matches straight from the fastq files, no sam/bam files are written). 
+                                 Default: aligner.''')
+  
+  arg_parse.add_argument('-mismatches', default=0, type=int,
+                         help='''Number of mismatches (0 or 1) allowed between reads and guides with -counter native. 
+                                 With 1, every guide sequence one substitution away is precomputed and reads matching 
+                                 more than one guide are discarded. This needs about 1 GB of memory for a genome-wide library. Default: 0''')
+  
+  arg_parse.add_argument('-barcode_offset', default=0, type=int,
+                         help='''Position of the inline sample barcode in the reads (bases from the 5' end), 
+                                 when the samples csv has a barcode column. Default: 0''')
+  
+  arg_parse.add_argument('-barcode_mismatches', default=0, type=int,
+                         help='''Number of mismatches (0 or 1) allowed in sample barcodes. 
+                                 Reads one mismatch away from the barcodes of two samples are discarded. Default: 0''')
+  
+  arg_parse.add_argument('-collapse_reads', default=False, action='store_true',
+                         help='''Collapse identical reads before alignment so that each unique sequence is aligned only once. 
+                                 Read counts are restored when counting guides. Ignored with -counter native.''')
+  
   arg_parse.add_argument('-cpu', metavar='NUM_CORES', default=util.MAX_CORES, type=int,
                          help='Number of parallel CPU cores to use. Default: All available (%d)' % util.MAX_CORES)
 
@@ -420,8 +933,13 @@ if __name__ == '__main__':
   
   arg_parse.add_argument('-disable_multiqc', default=False, action='store_true',
                          help='Specify whether to disable multiqc run. Defaults to False.')
+  
+  arg_parse.add_argument('-progress', metavar='DESTINATION', default=None,
+                         help='''Send live progress events (stage, sample, reads processed, reads/s, ETA) as JSON lines to 
+                                 a file, a named pipe (FIFO), a Unix socket or an open file descriptor number. 
+                                 See progress.py for the format.''')
 
-  args = vars(arg_parse.parse_args())
+  args = vars(arg_parse.parse_args(argv))
 
   samples_csv      = args['samples_csv']
   reference_fasta  = args['reference_fasta']
@@ -430,14 +948,26 @@ if __name__ == '__main__':
   fastqc_args      = args['fastqc_args']
   aligner          = args['al']
   genome_index     = args['aligner_index']
+  index_cache_dir  = args['index_cache']
   aligner_args     = args['aligner_args']
   sam_output       = args['sam_output']
   guide_library    = args['guide_library']
   software         = args['crispr_software']
+  trimmer          = args['trimmer']
+  counter          = args['counter']
+  mismatches       = args['mismatches']
+  barcode_offset   = args['barcode_offset']
+  barcode_mismatches = args['barcode_mismatches']
+  collapse         = args['collapse_reads']
   num_cpu          = args['cpu'] or None # May not be zero
   pair_tags        = args['pe']
   is_single_end    = args['se']
   multiqc          = not args['disable_multiqc']
+  progress_events  = args['progress']
   
-  CAM(samples_csv=samples_csv, reference_fasta=reference_fasta, trim_galore=trim_galore, skipfastqc=skipfastqc, fastqc_args=fastqc_args, is_single_end=is_single_end, pair_tags=pair_tags, aligner=aligner, genome_index=genome_index, aligner_args=aligner_args, sam_output=sam_output, guide_library=guide_library, software=software, multiqc=multiqc, num_cpu=num_cpu)
+  return(CAM(samples_csv=samples_csv, reference_fasta=reference_fasta, trim_galore=trim_galore, skipfastqc=skipfastqc, fastqc_args=fastqc_args, is_single_end=is_single_end, pair_tags=pair_tags, aligner=aligner, genome_index=genome_index, aligner_args=aligner_args, sam_output=sam_output, guide_library=guide_library, software=software, trimmer=trimmer, counter=counter, mismatches=mismatches, barcode_offset=barcode_offset, barcode_mismatches=barcode_mismatches, collapse=collapse, index_cache_dir=index_cache_dir, multiqc=multiqc, num_cpu=num_cpu, progress_events=progress_events))
+
+
+if __name__ == '__main__':
+  main()
   
@@ -5,13 +5,17 @@ from tempfile import NamedTemporaryFile
 from subprocess import run, Popen
 import sys
 import os
+import json
+import time
 import traceback
 import uuid
+import shlex
 import subprocess
 current_path = os.path.realpath(__file__)
 current_path = os.path.dirname(current_path) + '/cell_bio_util'
 sys.path.append(current_path)
 import cell_bio_util as util
+import progress
 
 
 class CAMSignals(QObject):
@@ -20,9 +24,11 @@ class CAMSignals(QObject):
   Supported signals are:
   finished - Boolean (did the job run without errors?)
   error - tuple ( exctype, value, traceback.format_exc() )
+  progress - dict (progress event of CAM, see progress.py)
   """
   finished = pyqtSignal(bool)
   error    = pyqtSignal(tuple)
+  progress = pyqtSignal(dict)
 
 class RunCAM(QRunnable):
   """
@@ -49,6 +55,100 @@ class RunCAM(QRunnable):
       self.signals.finished.emit(ok)
 
 
+class ReadProgress(QRunnable):
+  """
+  Class to read the progress events of CAM (JSON lines) 
+  from the read end of a pipe, until CAM closes the other end.
+  """
+  def __init__(self, fd):
+    super(ReadProgress, self).__init__()
+    self.fd = fd
+    self.signals = CAMSignals()
+    
+  @pyqtSlot()
+  def run(self):
+    with os.fdopen(self.fd, 'r') as fileObj:
+      for line in fileObj:
+        try:
+          self.signals.progress.emit(json.loads(line))
+        except ValueError:
+          pass
+
+
+class ProgressPanel(QWidget):
+  """
+  Window with the current stage of a CAM run and 
+  a progress bar per sample, with reads processed, reads/s and ETA. 
+  Samples without news for STALL_S seconds are shown in red.
+  """
+  STALL_S = 30
+  
+  def __init__(self,parent=None):
+    QWidget.__init__(self, parent)
+    self.initUI()
+  
+  def initUI(self):
+    self.setWindowTitle('CAM Progress')
+    self.stage_lbl = QLabel('Waiting for CAM to start...',self)
+    self.grid = QGridLayout()
+    vbox = QVBoxLayout()
+    vbox.addWidget(self.stage_lbl)
+    vbox.addLayout(self.grid)
+    vbox.addStretch(1)
+    self.setLayout(vbox)
+    self.rows = {}
+    self.hide()
+    self.resize(500,200)
+    centre(self)
+  
+  def clear(self):
+    for name_lbl, bar, info_lbl, last in self.rows.values():
+      for widget in [name_lbl, bar, info_lbl]:
+        self.grid.removeWidget(widget)
+        widget.deleteLater()
+    self.rows = {}
+    self.stage_lbl.setText('Waiting for CAM to start...')
+  
+  def update_event(self, event):
+    if event['event'] == 'stage':
+      if event['state'] == 'start':
+        self.stage_lbl.setText('Stage: %s' % event['stage'])
+      else:
+        self.stage_lbl.setText('Stage: %s (done)' % event['stage'])
+    elif event['event'] == 'run':
+      self.stage_lbl.setText('Run %s' % event['state'])
+    elif event['event'] == 'sample':
+      key = (event['stage'], event['sample'])
+      if key not in self.rows:
+        row = len(self.rows)
+        name_lbl = QLabel('%s: %s' % key, self)
+        bar = QProgressBar(self)
+        info_lbl = QLabel('', self)
+        self.grid.addWidget(name_lbl,row,0)
+        self.grid.addWidget(bar,row,1)
+        self.grid.addWidget(info_lbl,row,2)
+        self.rows[key] = [name_lbl, bar, info_lbl, None]
+      name_lbl, bar, info_lbl, last = self.rows[key]
+      if event['state'] == 'done':
+        bar.setRange(0,100)
+        bar.setValue(100)
+      elif event['fraction'] is None:
+        bar.setRange(0,0) # busy indicator: the size of the input is not known
+      else:
+        bar.setRange(0,100)
+        bar.setValue(int(100*event['fraction']))
+      name_lbl.setStyleSheet('')
+      info_lbl.setText(progress.describe(event))
+      self.rows[key][3] = None if event['state'] == 'done' else time.time()
+  
+  def check_stalled(self):
+    now = time.time()
+    for name_lbl, bar, info_lbl, last in self.rows.values():
+      if last is not None and now - last > self.STALL_S:
+        name_lbl.setStyleSheet('color: red')
+        info_lbl.setText('No progress for %d s' % (now - last))
+
+
 class MyFileFetchFrame(QFrame):
   """
   Class with a frame to find and load filenames. 
@@ -183,6 +283,10 @@ class Window(QWidget):
     super().__init__()
     self.initUI()
     self.threadpool = QThreadPool()
+    # One thread runs CAM and another one reads its progress events
+    self.threadpool.setMaxThreadCount(max(2, self.threadpool.maxThreadCount()))
+    self.timer = QTimer()
+    self.timer.timeout.connect(self.progress_panel.check_stalled)
     
   def initUI(self):
     def section_label(label):
@@ -228,6 +332,7 @@ class Window(QWidget):
     self.qsub.stateChanged.connect(self.enable_node_request)
     self.csv_create = BuildCSV(None)
     self.csv_upload = UploadCSV(None)
+    self.progress_panel = ProgressPanel(None)
     submit_btn = QPushButton('Submit',self)
     quit_btn = MyQuitButton(self)
     
@@ -350,9 +455,10 @@ class Window(QWidget):
     else:
       event.ignore()        
   
-  def execute_CAM(self):
+  def execute_CAM(self, progress_fd=None):
     """
-    This function collects variables and starts process
+    This function collects variables and starts process.
+    Progress events of a local run are written to progress_fd (see ProgressPanel).
     """
     if self.csv_opt == "Create":
       self.csv_file = self.csv_create.csv_file
@@ -391,11 +497,11 @@ class Window(QWidget):
                  'crispr_software' : soft_dict[self.soft],
                  'guide_library'   : dict_guides[self.lib]}
     if len(self.tgalore_args)>0:
-      dict_args['trim_galore'] = '"%s"' % self.tgalore_args
+      dict_args['trim_galore'] = self.tgalore_args
     if len(self.fastqc_args)>0:
-      dict_args['fastqc_args'] = '"%s"' % self.fastqc_args
+      dict_args['fastqc_args'] = self.fastqc_args
     if len(self.al_args)>0:
-      dict_args['aligner_args']     = '"%s"' % self.al_args
+      dict_args['aligner_args']     = self.al_args
     if self.seq == 'single-end':
       self.flags.append('-se')
     if len(self.cpu_args)>0:
@@ -408,8 +514,8 @@ class Window(QWidget):
     # Run CAM on the LMB cluster as a qsub job
     if self.qsub.isChecked():
       if self.seq == 'paired-end':
-        args = args + ['-pe',self.pe_tags]
-      command = ' '.join(args)
+        args = args + ['-pe'] + self.pe_tags.split(' ')
+      command = ' '.join(shlex.quote(arg) for arg in args)
       command = 'module load python3/3.7.1\nmodule load multiqc\npython3 /net/nfs1/public/genomics/CAM/CAM.py %s ' % (command)
       temp = 'job_' + util.get_rand_string(5) + ".sh"
       tempObj = open(temp, 'w')
@@ -431,9 +537,17 @@ class Window(QWidget):
     else:
       if self.seq == 'paired-end':
         args = args + ['-pe'] + self.pe_tags.split(' ')
+      pass_fds = ()
+      if progress_fd is not None:
+        # The child process inherits the write end of the progress pipe under the same number
+        args = args + ['-progress', str(progress_fd)]
+        pass_fds = (progress_fd,)
+      # CAM runs in its own process (arguments are passed as a list, so they aren't parsed by a shell)
       CAM = '%s/CAM.py' % os.path.dirname(os.path.realpath(__file__))
-      args   = ['python3',CAM] + args
-      util.call(args, shell=True)
+      args = [sys.executable, CAM] + args
+      proc = Popen(args, pass_fds=pass_fds)
+      if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args)
 
   def print_error(self):
     self.timer.stop()
@@ -441,12 +555,32 @@ class Window(QWidget):
     show_error_message(msg)
     
   def print_job_done(self,job):
+    self.timer.stop()
     if job:
       msg = 'Job finished successfully.'
       show_pop_up(msg)
+  
+  def run_CAM(self, progress_fd):
+    try:
+      self.execute_CAM(progress_fd)
+    finally:
+      os.close(progress_fd) # ends ReadProgress
            
   def on_submit(self):
-    submit = RunCAM(self.execute_CAM)
+    if self.qsub.isChecked():
+      submit = RunCAM(self.execute_CAM)
+    else:
+      # Progress events of CAM go through a pipe to the progress window
+      read_fd, write_fd = os.pipe()
+      self.progress_panel.clear()
+      self.progress_panel.show()
+      reader = ReadProgress(read_fd)
+      reader.signals.progress.connect(self.progress_panel.update_event)
+      self.threadpool.start(reader)
+      submit = RunCAM(self.run_CAM, write_fd)
+      self.timer.start(5000)
+    submit.signals.error.connect(self.print_error)
+    submit.signals.finished.connect(self.print_job_done)
     self.threadpool.start(submit)
 
 
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+"""
+Runs several aligner jobs at the same time within a CPU budget.
+
+bowtie/bowtie2 scale poorly past about 8 threads on 20 nt reads, so rather
+than aligning samples one after another with all cores, the budget is split
+into concurrent jobs. Jobs are started largest first (by estimated read count)
+and the cores free in the CPU pool at each start are shared among the jobs about
+to start in proportion to their read counts, within [min_threads, max_threads].
+For example, 4 similar samples on 24 cores run as 4 jobs x 6 threads.
+"""
+
+import gzip
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+MAX_THREADS = 8
+MIN_THREADS = 2
+
+
+# Function to estimate the number of reads of a fastq (or fasta) file from its size
+# and the size of its first records (for gzip files, also their compression ratio)
+def estimate_reads(path, sample_bytes=1 << 20):
+  size = os.path.getsize(path)
+  if size == 0:
+    return(0)
+  ratio = 1.0
+  opener = open
+  if path.endswith('.gz'):
+    with open(path, 'rb') as file_obj:
+      compressed = file_obj.read(sample_bytes)
+    data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(compressed)
+    ratio = len(data) / float(len(compressed))
+    opener = gzip.open
+  with opener(path, 'rb') as file_obj:
+    data = file_obj.read(sample_bytes)
+  lines = data.count(b'\n')
+  if lines == 0:
+    return(0)
+  lines_per_record = 4
+  if data.startswith(b'>'):
+    lines_per_record = 2
+  record_bytes = len(data) / (lines / float(lines_per_record))
+  return(int(size * ratio / record_bytes))
+
+
+# Function to split the free cores among the jobs about to start, in proportion to their sizes.
+# Jobs that don't fit within the free cores are left out.
+def thread_split(free_cpu, sizes, max_threads=MAX_THREADS, min_threads=MIN_THREADS):
+  min_threads = max(1, min(min_threads, free_cpu))
+  total = sum(sizes)
+  threads = []
+  for size in sizes:
+    if free_cpu < min_threads:
+      break
+    if total > 0:
+      share = int(free_cpu * size / float(total))
+    else:
+      share = free_cpu // (len(sizes) - len(threads))
+    n = max(min_threads, min(max_threads, share, free_cpu))
+    threads.append(n)
+    free_cpu -= n
+    total -= size
+  return(threads)
+
+
+# Function to run a job with its cores and give them back to the pool when it is done
+def run_with_tokens(job, threads, pool, label):
+  try:
+    return(job(threads))
+  finally:
+    pool.release(threads, label)
+
+
+# Function to run jobs concurrently with cores drawn from a CPU pool (see cpu_budget.py).
+# jobs is a list of [size, job] where job(threads) runs one alignment.
+# Returns the results of the jobs in the order given.
+def run_jobs(jobs, pool, max_threads=MAX_THREADS, min_threads=MIN_THREADS, log=None):
+  min_threads = max(1, min(min_threads, pool.total))
+  pending = sorted(range(len(jobs)), key=lambda k: jobs[k][0], reverse=True)
+  futures = {}
+  running = set()
+  with ThreadPoolExecutor(max_workers=pool.total) as executor:
+    while pending:
+      free_cpu = pool.free
+      if free_cpu < min_threads:
+        if running:
+          done, running = wait(running, return_when=FIRST_COMPLETED)
+          continue
+        # Cores are held elsewhere in the pipeline: wait for them in acquire()
+        free_cpu = min_threads
+      # Jobs that can start now with at least min_threads each
+      starting = pending[:max(1, free_cpu // min_threads)]
+      threads = thread_split(free_cpu, [jobs[k][0] for k in starting], max_threads, min_threads)
+      for k, n in zip(starting, threads):
+        label = 'aligner job %d of %d' % (k + 1, len(jobs))
+        n = pool.acquire(n, label)
+        if log is not None:
+          log('Starting %s with %d threads...' % (label, n))
+        future = executor.submit(run_with_tokens, jobs[k][1], n, pool, label)
+        futures[future] = k
+        running.add(future)
+        pending.remove(k)
+  results = [None] * len(jobs)
+  for future, k in futures.items():
+    results[k] = future.result()
+  return(results)
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+"""
+In-process BAM decoding for guide counting.
+
+Replaces piping each bam file through samtools view: BGZF blocks (gzip
+members of at most 64 KiB) are read from the file and inflated by a pool
+of threads (zlib releases the GIL), in batches kept in file order, and
+the binary records are decoded from memory. Only the fields needed for
+counting are read: reference, flag, read name (for the multiplicity of
+collapsed reads) and, for bowtie2, whether the optional fields hold an XS
+tag. Nothing decompressed is written to disk.
+
+See the SAM/BAM format specification (section 4) for the layouts.
+"""
+
+import struct
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+BGZF_HEADER = struct.Struct('<4BI2BH') # ID1 ID2 CM FLG MTIME XFL OS XLEN
+BAM_RECORD = struct.Struct('<iiBBHHHiiii') # refID pos l_read_name mapq bin n_cigar_op flag l_seq next_refID next_pos tlen
+BATCH_BLOCKS = 64 # BGZF blocks (up to 64 KiB each) inflated per thread task
+TAG_SIZES = {b'A': 1, b'c': 1, b'C': 1, b's': 2, b'S': 2, b'i': 4, b'I': 4, b'f': 4}
+
+
+# Function to read the deflate payloads of the BGZF blocks of a file (with their CRC32 and uncompressed size)
+def bgzf_blocks(file_obj):
+  while True:
+    header = file_obj.read(BGZF_HEADER.size)
+    if not header:
+      return
+    if len(header) < BGZF_HEADER.size:
+      raise IOError('Truncated BGZF block header in %s' % file_obj.name)
+    id1, id2, cm, flg, mtime, xfl, os_id, xlen = BGZF_HEADER.unpack(header)
+    if (id1, id2, cm, flg & 4) != (31, 139, 8, 4):
+      raise IOError('%s is not a BGZF (bam) file' % file_obj.name)
+    extra = file_obj.read(xlen)
+    block_size = None
+    pos = 0
+    while pos + 4 <= len(extra):
+      si1, si2, slen = struct.unpack_from('<BBH', extra, pos)
+      if (si1, si2) == (66, 67): # BC
+        block_size = struct.unpack_from('<H', extra, pos + 4)[0] + 1
+      pos += 4 + slen
+    if block_size is None:
+      raise IOError('BGZF block without a size field in %s' % file_obj.name)
+    data = file_obj.read(block_size - xlen - BGZF_HEADER.size)
+    if len(data) < block_size - xlen - BGZF_HEADER.size:
+      raise IOError('Truncated BGZF block in %s' % file_obj.name)
+    yield data
+
+
+# Function to inflate a batch of BGZF blocks, checking their size and CRC32
+def inflate_blocks(blocks):
+  inflated = []
+  for data in blocks:
+    payload = zlib.decompress(data[:-8], -15)
+    crc, size = struct.unpack('<II', data[-8:])
+    if size != len(payload) or crc != zlib.crc32(payload):
+      raise IOError('Corrupt BGZF block')
+    inflated.append(payload)
+  return(b''.join(inflated))
+
+
+# Function to decompress a BGZF file in batches of blocks, inflated by num_threads threads.
+# Yields the decompressed data of each batch, in file order.
+def read_bgzf(path, num_threads=1, batch_blocks=BATCH_BLOCKS):
+  def batches(file_obj):
+    batch = []
+    for data in bgzf_blocks(file_obj):
+      batch.append(data)
+      if len(batch) == batch_blocks:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+  with open(path, 'rb') as file_obj:
+    if num_threads <= 1:
+      for batch in batches(file_obj):
+        yield inflate_blocks(batch)
+      return
+    with ThreadPoolExecutor(num_threads) as executor:
+      # Up to two batches per thread are read ahead
+      pending = []
+      for batch in batches(file_obj):
+        pending.append(executor.submit(inflate_blocks, batch))
+        if len(pending) >= 2 * num_threads:
+          yield pending.pop(0).result()
+      for future in pending:
+        yield future.result()
+
+
+class BamReader(object):
+  """
+  Reads the reference names and the records of a bam file.
+  records() yields (refID, flag, read name, optional fields) of each record,
+  with the read name and optional fields as bytes.
+  """
+  def __init__(self, path, num_threads=1):
+    self.path = path
+    self._data = read_bgzf(path, num_threads)
+    self._buffer = b''
+    self._pos = 0
+    if self._read(4) != b'BAM\1':
+      raise IOError('%s is not a bam file' % path)
+    l_text = self._int32()
+    self.header_text = self._read(l_text).rstrip(b'\0').decode('ascii', 'replace')
+    self.references = []
+    for k in range(self._int32()):
+      name = self._read(self._int32())
+      self._int32() # l_ref
+      self.references.append(name.rstrip(b'\0').decode('ascii', 'replace'))
+
+  # Makes sure the buffer holds `size` bytes from the current position. Returns False at the end of the data.
+  def _fill(self, size):
+    while len(self._buffer) - self._pos < size:
+      data = next(self._data, None)
+      if data is None:
+        return(False)
+      self._buffer = self._buffer[self._pos:] + data
+      self._pos = 0
+    return(True)
+
+  def _read(self, size):
+    if not self._fill(size):
+      raise IOError('Truncated bam file %s' % self.path)
+    data = self._buffer[self._pos:self._pos + size]
+    self._pos += size
+    return(data)
+
+  def _int32(self):
+    return(struct.unpack('<i', self._read(4))[0])
+
+  def records(self):
+    unpack = BAM_RECORD.unpack_from
+    fixed_size = BAM_RECORD.size
+    while self._fill(4):
+      block_size = struct.unpack_from('<i', self._buffer, self._pos)[0]
+      if not self._fill(4 + block_size):
+        raise IOError('Truncated bam record in %s' % self.path)
+      start = self._pos + 4
+      ref_id, pos, l_read_name, mapq, bin_, n_cigar_op, flag, l_seq = unpack(self._buffer, start)[:8]
+      name_start = start + fixed_size
+      tags_start = name_start + l_read_name + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq
+      end = start + block_size
+      yield(ref_id, flag, self._buffer[name_start:name_start + l_read_name - 1], self._buffer[tags_start:end])
+      self._pos = end
+
+
+# Function to find whether the optional fields of a bam record hold a tag
+def has_tag(tags, tag):
+  if tag not in tags:
+    return(False)
+  pos = 0
+  while pos + 3 <= len(tags):
+    if tags[pos:pos + 2] == tag:
+      return(True)
+    value_type = tags[pos + 2:pos + 3]
+    pos += 3
+    if value_type in TAG_SIZES:
+      pos += TAG_SIZES[value_type]
+    elif value_type in (b'Z', b'H'):
+      pos = tags.index(b'\0', pos) + 1
+    elif value_type == b'B':
+      sub_type = tags[pos:pos + 1]
+      count = struct.unpack_from('<i', tags, pos + 1)[0]
+      pos += 5 + count * TAG_SIZES[sub_type]
+    else:
+      raise IOError('Unknown bam tag type %r' % value_type)
+  return(False)
+
+
+# Function to count guides from the records of a bam file, like guide_counts.count_sam_records:
+# unaligned reads (flag 4) are dropped and, for bowtie2, so are reads with an XS tag (multi-mapped).
+# Records are added to tracker (see progress.py) as they are read, if it is given.
+def count_bam_records(bam_file, aligner='bowtie2', collapsed=False, num_threads=1, tracker=None):
+  reader = BamReader(bam_file, num_threads)
+  references = reader.references
+  counts = Counter()
+  stats = {'mapped': 0, 'unmapped': 0, 'multimapped': 0}
+  check_xs = aligner == 'bowtie2'
+  records = reader.records()
+  if tracker is not None:
+    records = tracker.lines(records)
+  for ref_id, flag, read_name, tags in records:
+    n = 1
+    if collapsed:
+      n = int(read_name.rsplit(b'-', 1)[1])
+    if flag & 4:
+      stats['unmapped'] += n
+    elif check_xs and has_tag(tags, b'XS'):
+      stats['multimapped'] += n
+    else:
+      counts[references[ref_id]] += n
+      stats['mapped'] += n
+  return(counts, stats)
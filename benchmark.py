@@ -0,0 +1,471 @@
+#!/usr/bin/python3
+"""
+Synthetic screen generator and stage-by-stage benchmark of CAM.
+
+Generates FASTQ files from any guide library FASTA, with a given number of
+reads, guide representation skew (Gini index), sequencing error rate,
+adapter (3' vector) presence and 5' offset (e.g. the extra base of Bassik
+libraries). It then times each pipeline stage on them (trimming, alignment,
+counting, aggregation, normalisation and QC) and checks that the counts
+recovered match the simulated truth.
+
+The startup stage guards the import time of the cam package and of
+python3 CAM.py --help: it fails if they take longer than -max_startup
+seconds more than the python interpreter alone, or if importing cam loads
+numpy, pandas, matplotlib or PRAGUI.
+
+Results are appended as one JSON line per benchmark run to a results file
+(benchmark_results.jsonl), together with the CAM version (git describe), so
+that runs can be compared across versions. Stages whose tools or Python
+modules are not installed are recorded as skipped.
+
+Usage: python3 benchmark.py brunello_human_lib -reads 1000000 -samples 4 -gini 0.25
+"""
+
+import gzip
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cam
+import guide_counts
+import index_cache
+import library_registry
+import protospacer
+import run_report
+
+
+PROG_NAME = 'benchmark'
+CAM_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+VECTOR_3PRIME = 'GTTTAAGAGCTAAGCTGGAAACAGCATAGCAA' # sgRNA scaffold after the protospacer
+STAGES = ['startup', 'trim', 'align', 'parse', 'count', 'aggregate', 'normalise', 'qc']
+BASES = 'ACGT'
+STARTUP_RUNS = 5 # the best of these runs is kept
+HEAVY_MODULES = ['numpy', 'pandas', 'matplotlib', 'rnaseq_pip_util']
+
+
+# Function to get the inverse of the standard normal cumulative distribution (by bisection)
+def normal_quantile(p):
+  lo, hi = -10.0, 10.0
+  for k in range(100):
+    mid = (lo + hi) / 2
+    if 0.5 * (1 + math.erf(mid / math.sqrt(2))) < p:
+      lo = mid
+    else:
+      hi = mid
+  return((lo + hi) / 2)
+
+
+# Function to draw guide abundances whose Gini index is about `gini`.
+# Abundances are log-normal, for which Gini = 2 x Phi(sigma / sqrt(2)) - 1.
+def guide_weights(num_guides, gini, rng):
+  if gini <= 0:
+    return([1.0] * num_guides)
+  sigma = math.sqrt(2) * normal_quantile((gini + 1) / 2.0)
+  return([rng.lognormvariate(0, sigma) for k in range(num_guides)])
+
+
+# Function to calculate the Gini index of a list of counts
+def gini_index(counts):
+  values = sorted(counts)
+  n = len(values)
+  total = float(sum(values))
+  if n == 0 or total == 0:
+    return(0.0)
+  weighted = sum((k + 1) * v for k, v in enumerate(values))
+  return(2.0 * weighted / (n * total) - (n + 1.0) / n)
+
+
+# Function to write the synthetic fastq file of one sample.
+# Returns the number of reads generated for each guide and the number expected to be found by
+# exact matching (no sequencing error within the protospacer, sequence unique in the library).
+def write_sample(fastq, library, weights, num_reads, rng, error_rate=0.001, read_length=50, offset=2, adapter=True):
+  num_guides = len(library)
+  cum_weights = []
+  total = 0.0
+  for w in weights:
+    total += w
+    cum_weights.append(total)
+  picks = rng.choices(range(num_guides), cum_weights=cum_weights, k=num_reads)
+  generated = [0] * num_guides
+  expected = [0] * num_guides
+  unique = [library.lookup.get(seq) == i for i, seq in enumerate(library.seqs)]
+  log_keep = math.log(1 - error_rate) if 0 < error_rate < 1 else None
+  # Position of the next sequencing error in the concatenated reads (geometric skips)
+  def next_error(pos):
+    if log_keep is None:
+      return(float('inf'))
+    return(pos + int(math.log(1 - rng.random()) / log_keep) + 1)
+  error_pos = next_error(-1)
+  pos = 0
+  quality = 'I' * read_length
+  opener = gzip.open if fastq.endswith('.gz') else open
+  with opener(fastq, 'wt') as file_obj:
+    for k, i in enumerate(picks):
+      seq = library.seqs[i]
+      read = ''.join(rng.choice(BASES) for n in range(offset)) + seq
+      if adapter:
+        read += VECTOR_3PRIME
+      if len(read) < read_length:
+        read += ''.join(rng.choice(BASES) for n in range(read_length - len(read)))
+      read = read[:read_length]
+      clean = True
+      if error_pos < pos + read_length:
+        read = list(read)
+        while error_pos < pos + read_length:
+          p = error_pos - pos
+          read[p] = rng.choice(BASES.replace(read[p], ''))
+          if offset <= p < offset + len(seq):
+            clean = False
+          error_pos = next_error(error_pos)
+        read = ''.join(read)
+      pos += read_length
+      generated[i] += 1
+      if clean and unique[i] and offset + len(seq) <= read_length:
+        expected[i] += 1
+      file_obj.write('@read%d_%s\n%s\n+\n%s\n' % (k, i, read, quality))
+  return(generated, expected)
+
+
+# Function to generate a synthetic screen: one fastq file per sample, a samples csv for CAM and the truth
+def generate(reference_fasta, out_dir, num_reads=1000000, num_samples=2, gini=0.2, error_rate=0.001,
+             read_length=50, offset=2, adapter=True, seed=1, gz=True):
+  os.makedirs(out_dir, exist_ok=True)
+  rng = random.Random(seed)
+  library = guide_counts.read_library(reference_fasta)
+  base_weights = guide_weights(len(library), gini, rng)
+  samples = []
+  for k in range(num_samples):
+    sample = 'sample%d' % (k + 1)
+    # Samples share the library skew, with some sample-to-sample variation on top
+    weights = [w * rng.lognormvariate(0, 0.2) for w in base_weights]
+    fastq = os.path.join(out_dir, sample + ('.fastq.gz' if gz else '.fastq'))
+    generated, expected = write_sample(fastq, library, weights, num_reads, rng, error_rate, read_length, offset, adapter)
+    samples.append({'sample': sample, 'fastq': fastq, 'generated': generated, 'expected': expected,
+                    'gini': round(gini_index(generated), 4)})
+  with open(os.path.join(out_dir, 'samples.csv'), 'w') as file_obj:
+    for sample in samples:
+      file_obj.write('%s,%s,NA\n' % (sample['sample'], sample['fastq']))
+  return(library, samples)
+
+
+# Function to compare recovered counts (guide name -> count) with the expected ones
+def check_counts(library, expected, recovered):
+  expected_by_name = {}
+  for name, n in zip(library.names, expected):
+    expected_by_name[name] = expected_by_name.get(name, 0) + n
+  names = set(expected_by_name) | set(recovered)
+  diffs = [abs(recovered.get(name, 0) - expected_by_name.get(name, 0)) for name in names]
+  total_expected = sum(expected_by_name.values())
+  total_recovered = sum(recovered.values())
+  return({'expected_reads': total_expected,
+          'recovered_reads': total_recovered,
+          'recovered_fraction': round(total_recovered / float(total_expected), 6) if total_expected else None,
+          'guides_differing': sum(1 for d in diffs if d),
+          'max_difference': max(diffs) if diffs else 0,
+          'abs_difference_fraction': round(sum(diffs) / float(total_expected), 6) if total_expected else None})
+
+
+# Function to read a _lib_guidecounts.txt file into guide name -> count
+def read_counts_file(counts_file):
+  counts = {}
+  with open(counts_file, 'r') as file_obj:
+    for line in file_obj:
+      # Guide names may contain spaces (e.g. Non-Targeting Control_1)
+      fields = line.strip().split(None, 1)
+      if len(fields) == 2:
+        counts[fields[1]] = int(fields[0])
+  return(counts)
+
+
+# Function to get the CAM version being benchmarked
+def cam_version():
+  try:
+    proc = subprocess.run(['git', '-C', CAM_DIRECTORY, 'describe', '--always', '--dirty'],
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return(proc.stdout.strip() or None)
+  except OSError:
+    return(None)
+
+
+# Function to time a python command run from the CAM folder (best of `runs`). Returns None if it fails.
+def python_time(args, runs=STARTUP_RUNS):
+  times = []
+  for k in range(runs):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable] + args, cwd=CAM_DIRECTORY, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    times.append(time.perf_counter() - start)
+    if proc.returncode != 0:
+      return(None)
+  return(min(times))
+
+
+# Function to find which of HEAVY_MODULES are loaded by importing a module
+def heavy_imports(module):
+  code = 'import sys, %s; print(" ".join(m for m in %r if m in sys.modules))' % (module, HEAVY_MODULES)
+  proc = subprocess.run([sys.executable, '-c', code], cwd=CAM_DIRECTORY, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                        universal_newlines=True)
+  if proc.returncode != 0:
+    return(None)
+  return(proc.stdout.split())
+
+
+class Benchmark(object):
+  """
+  Runs and times the stages of CAM on a synthetic screen.
+  Each stage records its timings through run_report, or why it was skipped.
+  """
+  def __init__(self, library, samples, out_dir, reference_fasta, num_cpu=1, guide_library='bassik', tolerance=0.001,
+               max_startup=0.25):
+    self.library = library
+    self.samples = samples
+    self.out_dir = out_dir
+    self.reference_fasta = reference_fasta
+    self.num_cpu = num_cpu
+    self.trim5 = 1 if guide_library == 'bassik' else 0
+    self.tolerance = tolerance
+    self.max_startup = max_startup
+    self.trim_settings = protospacer.parse_trim_args(None, VECTOR_3PRIME)[0]
+    self.report = run_report.RunReport()
+    self.skipped = {}
+    self.checks = {}
+    self.sam_files = []
+    self.counts_files = []
+    self.aggregated = None
+
+  def skip(self, stage, reason):
+    print('Skipping %s: %s' % (stage, reason))
+    self.skipped[stage] = reason
+
+  def check(self, stage, counts_files):
+    results = []
+    for sample, counts_file in zip(self.samples, counts_files):
+      result = check_counts(self.library, sample['expected'], read_counts_file(counts_file))
+      result['sample'] = sample['sample']
+      results.append(result)
+    passed = all(r['abs_difference_fraction'] is not None and r['abs_difference_fraction'] <= self.tolerance for r in results)
+    self.checks[stage] = {'passed': passed, 'samples': results}
+    print('%s counts %s the simulated truth' % (stage, 'match' if passed else 'DO NOT match'))
+
+  # Import time of the cam package and of python3 CAM.py --help, above the start-up of python itself
+  def stage_startup(self):
+    interpreter = python_time(['-c', 'pass'])
+    result = {'python_s': round(interpreter, 4), 'max_startup_s': self.max_startup}
+    passed = True
+    for name, args in [('import cam', ['-c', 'import cam']), ('CAM.py --help', ['CAM.py', '--help'])]:
+      elapsed = python_time(args)
+      if elapsed is None:
+        self.skip('startup (%s)' % name, 'failed to run (dependencies not installed?)')
+        continue
+      result[name] = round(elapsed - interpreter, 4)
+      passed = passed and elapsed - interpreter <= self.max_startup
+      print('%s: %.3f s above python start-up' % (name, elapsed - interpreter))
+    result['heavy_imports'] = heavy_imports('cam')
+    if result['heavy_imports']:
+      print('import cam loads %s' % ', '.join(result['heavy_imports']))
+      passed = False
+    result['passed'] = passed
+    self.checks['startup'] = result
+    print('startup %s' % ('is fast enough' if passed else 'is TOO SLOW'))
+
+  # Native trimmer: protospacer extraction only
+  def stage_trim(self):
+    with self.report.stage('trim (native)', reads=self.num_reads()):
+      for sample in self.samples:
+        protospacer.protospacer_counts(sample['fastq'], self.trim_settings)
+    if shutil.which('trim_galore') is None:
+      self.skip('trim (trim_galore)', 'trim_galore not installed')
+      return
+    with self.report.stage('trim (trim_galore)', reads=self.num_reads()):
+      for sample in self.samples:
+        self.report.call(['trim_galore', '--length', '11', '-e', '0.2', '-a', 'GTTTAAGAGCTA', '--clip_R1', '1',
+                          '-o', self.out_dir, sample['fastq']], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+  # bowtie2 alignment of the collapsed protospacers, as with -trimmer native
+  def stage_align(self):
+    if shutil.which('bowtie2') is None or shutil.which('bowtie2-build') is None:
+      self.skip('align', 'bowtie2 not installed')
+      return
+    if shutil.which('samtools') is None:
+      print('samtools not installed: sam files are parsed without it')
+    with self.report.stage('index'):
+      genome_index, built = index_cache.get_index(self.reference_fasta, 'bowtie2-build')
+    aligner_args = ['-N', '0', '--no-1mm-upfront', '--score-min', 'L,0,0', '--no-unal', '--no-hd', '-f', '-p', str(self.num_cpu)]
+    if self.trim5:
+      aligner_args += ['-5', str(self.trim5)]
+    with self.report.stage('align (bowtie2)', reads=self.num_reads()):
+      for sample in self.samples:
+        sam = os.path.join(self.out_dir, sample['sample'] + '.bt2.sam')
+        collapsed = os.path.join(self.out_dir, sample['sample'] + '.collapsed.fa')
+        with open(collapsed, 'w') as file_obj:
+          file_obj.writelines(protospacer.collapsed_fasta(sample['fastq'], self.trim_settings))
+        self.report.call(['bowtie2'] + aligner_args + ['-x', genome_index, '-U', collapsed, '-S', sam], stderr=subprocess.DEVNULL)
+        self.sam_files.append(sam)
+
+  def stage_parse(self):
+    if not self.sam_files:
+      self.skip('parse', 'no sam files (align was skipped)')
+      return
+    counts_files = []
+    with self.report.stage('parse (sam)', reads=self.num_reads()):
+      for sam in self.sam_files:
+        counts, stats = guide_counts.count_sam_file(sam, 'bowtie2', collapsed=True, num_workers=self.num_cpu)
+        counts_file = sam[:-len('.sam')] + '_lib_guidecounts.txt'
+        guide_counts.write_sam_counts(counts_file, counts, stats, self.library)
+        counts_files.append(counts_file)
+    self.check('parse (sam)', counts_files)
+
+  # Native trimmer and counter, from fastq to counts files
+  def stage_count(self):
+    self.counts_files = []
+    with self.report.stage('count (native)', reads=self.num_reads()):
+      for sample in self.samples:
+        counts_file = os.path.join(self.out_dir, sample['sample'] + '_lib_guidecounts.txt')
+        protospacer.count_fastq_file([sample['fastq'], counts_file], self.library, self.trim_settings, self.trim5, self.num_cpu)
+        self.counts_files.append(counts_file)
+    self.check('count (native)', self.counts_files)
+
+  def stage_aggregate(self):
+    if not self.counts_files:
+      self.skip('aggregate', 'no counts files (count was skipped)')
+      return
+    try:
+      import pandas
+    except ImportError as error:
+      self.skip('aggregate', 'pandas not installed (%s)' % error)
+      return
+    with self.report.stage('aggregate'):
+      self.aggregated = cam.aggregate(self.counts_files, self.reference_fasta, 'mageck')
+
+  # Every normalisation method, on the aggregated counts file
+  def stage_normalise(self):
+    if self.aggregated is None:
+      self.skip('normalise', 'no aggregated counts (aggregate was skipped)')
+      return
+    try:
+      import normalise
+    except ImportError as error:
+      self.skip('normalise', 'numpy not installed (%s)' % error)
+      return
+    for method in normalise.METHODS:
+      out_file = os.path.join(self.out_dir, 'normalised-counts-%s.tsv' % method)
+      try:
+        with self.report.stage('normalise (%s)' % method):
+          normalise.normalise(self.aggregated, out_file, method)
+      except ValueError as error:
+        self.skip('normalise (%s)' % method, str(error))
+
+  # QC metrics of every sample, on the aggregated counts file
+  def stage_qc(self):
+    if self.aggregated is None:
+      self.skip('qc', 'no aggregated counts (aggregate was skipped)')
+      return
+    try:
+      import library_qc
+    except ImportError as error:
+      self.skip('qc', 'numpy not installed (%s)' % error)
+      return
+    with self.report.stage('qc'):
+      library_qc.counts_file_qc(self.aggregated, self.out_dir)
+    try:
+      import qc_plots
+    except ImportError as error:
+      self.skip('qc plots', 'matplotlib not installed (%s)' % error)
+      return
+    with self.report.stage('qc plots'):
+      counts, samples = library_qc.read_counts(self.aggregated)
+      qc_plots.plot_samples(counts, samples, self.out_dir, num_workers=self.num_cpu)
+
+  def num_reads(self):
+    return(sum(sum(sample['generated']) for sample in self.samples))
+
+  def run(self, stages=STAGES):
+    for stage in STAGES:
+      if stage in stages:
+        getattr(self, 'stage_' + stage)()
+    return(self.report.stages)
+
+
+# Function to generate a synthetic screen, benchmark it and append the results to results_file
+def run_benchmark(reference_fasta, out_dir=None, stages=STAGES, results_file='benchmark_results.jsonl', num_cpu=1,
+                  guide_library='bassik', tolerance=0.001, max_startup=0.25, keep=False, **params):
+  reference_fasta = library_registry.resolve_fasta(reference_fasta)
+  temp_dir = None
+  if out_dir is None:
+    out_dir = temp_dir = tempfile.mkdtemp(prefix='cam_benchmark')
+  try:
+    start = time.time()
+    library, samples = generate(reference_fasta, out_dir, **params)
+    generate_s = time.time() - start
+    print('Generated %d samples of %d reads in %s (%.1f s)' % (len(samples), params.get('num_reads', 0), out_dir, generate_s))
+    bench = Benchmark(library, samples, out_dir, reference_fasta, num_cpu, guide_library, tolerance, max_startup)
+    bench.run(stages)
+    result = {'version': cam_version(),
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'host': os.uname().nodename,
+              'cpu_count': os.cpu_count(),
+              'num_cpu': num_cpu,
+              'library': os.path.basename(reference_fasta),
+              'num_guides': len(library),
+              'params': params,
+              'sample_gini': [sample['gini'] for sample in samples],
+              'generate_s': round(generate_s, 3),
+              'stages': bench.report.stages,
+              'skipped': bench.skipped,
+              'checks': bench.checks}
+    if results_file:
+      with open(results_file, 'a') as file_obj:
+        file_obj.write(json.dumps(result) + '\n')
+    for line in bench.report.summary():
+      print(line)
+    return(result)
+  finally:
+    if temp_dir is not None and not keep:
+      shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+
+  from argparse import ArgumentParser
+
+  arg_parse = ArgumentParser(prog=PROG_NAME, description='Benchmark CAM stages on a synthetic CRISPR screen.')
+  arg_parse.add_argument('reference_fasta', metavar='REFERENCE_FASTA',
+                         help='Guide library FASTA file, or name of a bundled library (e.g. brunello_human_lib)')
+  arg_parse.add_argument('-reads', default=1000000, type=int, help='Reads per sample. Default: 1000000')
+  arg_parse.add_argument('-samples', default=2, type=int, help='Number of samples. Default: 2')
+  arg_parse.add_argument('-gini', default=0.2, type=float, help='Gini index of guide representation. Default: 0.2')
+  arg_parse.add_argument('-error_rate', default=0.001, type=float, help='Sequencing error rate per base. Default: 0.001')
+  arg_parse.add_argument('-read_length', default=50, type=int, help='Read length. Default: 50')
+  arg_parse.add_argument('-offset', default=2, type=int,
+                         help='''Bases before the protospacer. The default (2) matches the default CAM options for
+                                 Bassik libraries (trim_galore --clip_R1 1 and aligner -5 1).''')
+  arg_parse.add_argument('-no_adapter', default=False, action='store_true', help='Generate reads without the 3\' vector.')
+  arg_parse.add_argument('-plain', default=False, action='store_true', help='Write uncompressed fastq files.')
+  arg_parse.add_argument('-seed', default=1, type=int, help='Random seed. Default: 1')
+  arg_parse.add_argument('-guide_library', default='bassik', help='Same as the CAM option. Default: bassik')
+  arg_parse.add_argument('-stages', nargs='*', default=STAGES, choices=STAGES, help='Stages to run. Default: all')
+  arg_parse.add_argument('-cpu', default=1, type=int, help='Number of cores for counting and alignment. Default: 1')
+  arg_parse.add_argument('-tolerance', default=0.001, type=float,
+                         help='Largest fraction of reads that may be miscounted for the truth check to pass. Default: 0.001')
+  arg_parse.add_argument('-max_startup', default=0.25, type=float,
+                         help='Largest time (s) that import cam and CAM.py --help may take above python start-up. Default: 0.25')
+  arg_parse.add_argument('-out', default=None, help='Folder for the synthetic screen. Default: a temporary folder')
+  arg_parse.add_argument('-keep', default=False, action='store_true', help='Keep the temporary folder.')
+  arg_parse.add_argument('-results', default='benchmark_results.jsonl', help='File the results are appended to.')
+
+  args = vars(arg_parse.parse_args())
+
+  result = run_benchmark(args['reference_fasta'], out_dir=args['out'], stages=args['stages'], results_file=args['results'],
+                         num_cpu=args['cpu'], guide_library=args['guide_library'], tolerance=args['tolerance'],
+                         max_startup=args['max_startup'], keep=args['keep'],
+                         num_reads=args['reads'], num_samples=args['samples'], gini=args['gini'], error_rate=args['error_rate'],
+                         read_length=args['read_length'], offset=args['offset'], adapter=not args['no_adapter'],
+                         seed=args['seed'], gz=not args['plain'])
+  if not all(check['passed'] for check in result['checks'].values()):
+    sys.exit(1)
@@ -0,0 +1,101 @@
+"""
+Python API of CAM, for calling it from other pipelines without starting a
+new process:
+
+  import cam
+  counts_files = cam.count(['pre.fq.gz', 'post.fq.gz'], 'brunello_human_lib', out_dir='counts')
+  counts_tsv = cam.aggregate(counts_files, 'brunello_human_lib')
+  counts_tsv = cam.run('samples.csv', 'brunello_human_lib', trimmer='native', counter='native')
+  cam.main(['samples.csv', 'brunello_human_lib', '-counter', 'native'])
+
+The folder holding CAM.py (the parent of this package) must be on the
+python path. Importing cam only loads the standard library: count() needs
+the CAM counting modules, aggregate() numpy and pandas, and run() and
+main() CAM.py, with PRAGUI for the stages that use it. Each is imported
+on first call.
+"""
+
+import os
+
+
+__all__ = ['count', 'aggregate', 'run', 'main']
+
+
+# Function to get the settings of the native trimmer from trim_galore options, as CAM -trimmer native.
+# Without -a, the 3' vector of the library in libraries_info.csv is used.
+def native_trim_settings(reference_fasta, trim_galore=None):
+  import library_registry
+  import protospacer
+
+  adapter = library_registry.library_info(reference_fasta).get('vector_3prime')
+  trim_settings, ignored = protospacer.parse_trim_args(trim_galore, adapter)
+  if ignored:
+    raise ValueError('trim_galore options not used by the native trimmer: %s' % ' '.join(ignored))
+  return(trim_settings)
+
+
+# Function to count the guides of fastq files by sequence lookup, as CAM -counter native.
+# With trimmer='native', protospacers are extracted from untrimmed reads using the trim_galore
+# options in trim_galore (see protospacer.py); with trimmer=None, reads are already trimmed.
+# Counts files are written to out_dir (default: the folder of the first fastq file).
+# library and trim_settings can be given already parsed (e.g. kept resident by cam_server.py).
+# Returns the counts files, in the order of the fastq files.
+def count(fastq_files, reference_fasta, out_dir=None, guide_library='bassik', trimmer='native', trim_galore=None,
+          mismatches=0, num_cpu=None, library=None, trim_settings=None):
+  import guide_counts
+  import library_registry
+  import protospacer
+
+  if isinstance(fastq_files, str):
+    fastq_files = [fastq_files]
+  if trimmer not in ['native', None]:
+    raise ValueError('trimmer must be native or None (reads already trimmed)')
+  if mismatches not in [0, 1]:
+    raise ValueError('mismatches must be 0 or 1')
+
+  reference_fasta = library_registry.resolve_fasta(reference_fasta)
+  if library is None:
+    library = guide_counts.read_library(reference_fasta, mismatches)
+  trim5 = 1 if guide_library == 'bassik' else 0 # Same as aligner option -5 1
+  if out_dir is None:
+    out_dir = os.path.dirname(os.path.abspath(fastq_files[0]))
+  num_cpu = num_cpu or os.cpu_count()
+
+  count_func = guide_counts.count_fastq_file
+  common_args = [library, trim5]
+  if trimmer == 'native':
+    if trim_settings is None:
+      trim_settings = native_trim_settings(reference_fasta, trim_galore)
+    count_func = protospacer.count_fastq_file
+    common_args = [library, trim_settings, trim5]
+
+  # Each file is split into chunks counted across all cores (see fastq_reader.py)
+  counts_files = []
+  for fastq in fastq_files:
+    counts_file = os.path.join(out_dir, os.path.basename(fastq) + '_lib_guidecounts.txt')
+    counts_files.append(count_func([fastq, counts_file], *common_args, num_workers=num_cpu))
+  return(counts_files)
+
+
+# Function to aggregate counts files into one table for MAGeCK or Bagel (see count_table.py).
+# Returns the file written (default: counts_aggregated_<software>.tsv next to the counts files).
+def aggregate(counts_files, reference_fasta, software='mageck', out_file=None, library=None):
+  import count_table
+  import library_registry
+
+  reference_fasta = library_registry.resolve_fasta(reference_fasta)
+  out_file, table = count_table.aggregate(counts_files, reference_fasta, software, out_file, library=library)
+  return(out_file)
+
+
+# Function to run the whole pipeline on a samples csv, with the keyword options of CAM.CAM.
+# Returns the aggregated counts file.
+def run(samples_csv, reference_fasta=None, **options):
+  import CAM
+  return(CAM.CAM(samples_csv, reference_fasta, **options))
+
+
+# Function to run CAM from command line arguments, as python3 CAM.py (e.g. ['samples.csv', 'library.fa', '-cpu', '4'])
+def main(argv=None):
+  import CAM
+  return(CAM.main(argv))
@@ -0,0 +1,7 @@
+"""
+python3 -m cam samples.csv reference.fa [options], same as python3 CAM.py
+"""
+
+import cam
+
+cam.main()
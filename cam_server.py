@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+"""
+Long-running CAM worker service.
+
+A new CAM process parses the guide library fasta again, builds the
+one-mismatch lookup table if asked to, hashes the fasta to find its aligner
+index and warms up its protospacer cache. The server does this once per
+library: it keeps parsed libraries, lookup tables, native trimmer settings
+and aligner index paths in memory, keyed by the path, size and modification
+time of the fasta, so an edited file is read again. Jobs sent to it skip all
+of that setup, which is most of the run time of small screens and re-counts.
+
+Jobs are JSON lines sent over a Unix socket ($CAM_SERVER_SOCKET, or
+~/.cache/cam/cam_server.sock if it is not set). There is one job per
+connection, and the reply is one JSON line: {"ok": true, "result": ...}
+or {"ok": false, "error": "..."}. The jobs are:
+
+  count      {"fastq_files": [...], "reference_fasta": ..., options of cam.count} -> counts files
+  aggregate  {"counts_files": [...], "reference_fasta": ..., "software": ..., "out_file": ...} -> aggregated counts file
+  screen     count, then aggregate the counts files -> {"counts_files": [...], "counts_aggregated": ...}
+  index      {"reference_fasta": ..., "aligner": "bowtie2"} -> index base name (see index_cache.py)
+  status     resident libraries, jobs run and CPU pool use
+  stop       stops the server once running jobs are done
+
+Jobs run in parallel, one thread each, and share one CPU token pool (see
+cpu_budget.py). A job takes its num_cpu tokens (default: the whole pool)
+and counts each fastq file across that many worker processes. The workers
+are forked from the server, so they inherit the resident library instead
+of parsing it again.
+
+Usage: python3 cam_server.py start -cpu 16
+       python3 cam_server.py screen pre.fq.gz post.fq.gz -reference brunello_human_lib -out_dir counts
+       python3 cam_server.py status
+       python3 cam_server.py stop
+"""
+
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import cam
+import cpu_budget
+import guide_counts
+import index_cache
+import library_registry
+
+
+PROG_NAME = 'cam_server'
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.cache', 'cam', 'cam_server.sock')
+COMMANDS = ['start', 'status', 'stop', 'count', 'aggregate', 'screen', 'index']
+
+
+def socket_file(path=None):
+  if path is None:
+    path = os.environ.get('CAM_SERVER_SOCKET', DEFAULT_SOCKET)
+  return(os.path.abspath(path))
+
+
+# Function to get the identity of a file for the resident cache: path, size and modification time
+def file_stamp(path):
+  stat = os.stat(path)
+  return(os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class Resident(object):
+  """
+  Values computed from library fasta files (parsed libraries, lookup tables,
+  trimmer settings, aligner indexes) kept for the life of the server.
+  A value is computed again if its fasta has changed. Jobs that need the same
+  value at the same time wait for a single computation.
+  """
+  def __init__(self, log=None):
+    self.log = log
+    self.hits = 0
+    self.misses = 0
+    self._entries = {}
+    self._lock = threading.Lock()
+
+  def get(self, kind, path, args, load):
+    path, size, mtime = file_stamp(path)
+    key = (kind, path) + tuple(args)
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry['stamp'] != (size, mtime):
+        entry = self._entries[key] = {'stamp': (size, mtime), 'lock': threading.Lock(), 'loaded': False, 'value': None}
+    with entry['lock']:
+      if entry['loaded']:
+        self.hits += 1
+        return(entry['value'])
+      start = time.time()
+      entry['value'] = load()
+      entry['loaded'] = True
+      entry['load_s'] = round(time.time() - start, 3)
+      self.misses += 1
+    if self.log is not None:
+      self.log('Loaded %s of %s %s in %.1f s' % (kind, path, list(args), entry['load_s']))
+    return(entry['value'])
+
+  # Parsed guide library (with its lookup table of one-mismatch sequences if mismatches is 1)
+  def library(self, reference_fasta, mismatches=0):
+    return(self.get('library', reference_fasta, [mismatches], lambda: guide_counts.read_library(reference_fasta, mismatches)))
+
+  def trim_settings(self, reference_fasta, trim_galore=None):
+    return(self.get('trim settings', reference_fasta, [trim_galore], lambda: cam.native_trim_settings(reference_fasta, trim_galore)))
+
+  def index(self, reference_fasta, aligner='bowtie2'):
+    index_builder = library_registry.INDEX_BUILDERS[aligner]
+    return(self.get('index', reference_fasta, [aligner], lambda: index_cache.get_index(reference_fasta, index_builder)[0]))
+
+  def summary(self):
+    with self._lock:
+      entries = [{'kind': key[0], 'path': key[1], 'args': list(key[2:]), 'load_s': entry.get('load_s')}
+                 for key, entry in self._entries.items() if entry['loaded']]
+    return({'entries': entries, 'hits': self.hits, 'misses': self.misses})
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+  """
+  Reads one job from a connection, runs it and writes the reply.
+  """
+  def handle(self):
+    line = self.rfile.readline()
+    try:
+      job = json.loads(line.decode('utf-8'))
+      reply = {'ok': True, 'result': self.server.run_job(job)}
+    except Exception as error:
+      reply = {'ok': False, 'error': '%s: %s' % (type(error).__name__, error)}
+      self.server.info('Job failed: %s' % reply['error'])
+    self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class CAMServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  """
+  Unix socket server that runs CAM jobs against resident libraries, on a shared CPU token pool.
+  Job threads are not daemon threads, so server_close() waits for running jobs to finish.
+  """
+
+  def __init__(self, path=None, num_cpu=None, log=None):
+    self.path = socket_file(path)
+    self.log = log
+    self.pool = cpu_budget.CPUPool(num_cpu or os.cpu_count() or 1, log)
+    self.resident = Resident(log)
+    self.started = time.time()
+    self.jobs = {'running': 0, 'done': 0, 'failed': 0}
+    self._jobs_lock = threading.Lock()
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    if os.path.exists(self.path):
+      if ping(self.path):
+        raise IOError('A CAM server is already listening on %s' % self.path)
+      os.remove(self.path) # left behind by a server that did not stop cleanly
+    socketserver.UnixStreamServer.__init__(self, self.path, JobHandler)
+
+  def info(self, msg):
+    if self.log is not None:
+      self.log(msg)
+
+  def run_job(self, job):
+    name = job.pop('job', None)
+    func = getattr(self, 'job_' + str(name), None)
+    if name not in COMMANDS or func is None:
+      raise ValueError('Unknown job %s' % name)
+    with self._jobs_lock:
+      self.jobs['running'] += 1
+    start = time.time()
+    ok = False
+    try:
+      result = func(**job)
+      ok = True
+    finally:
+      with self._jobs_lock:
+        self.jobs['running'] -= 1
+        self.jobs['done' if ok else 'failed'] += 1
+    self.info('Job %s done in %.1f s' % (name, time.time() - start))
+    return(result)
+
+  def job_count(self, fastq_files, reference_fasta, out_dir=None, guide_library='bassik', trimmer='native',
+                trim_galore=None, mismatches=0, num_cpu=None):
+    reference_fasta = library_registry.resolve_fasta(reference_fasta)
+    library = self.resident.library(reference_fasta, mismatches)
+    trim_settings = None
+    if trimmer == 'native':
+      trim_settings = self.resident.trim_settings(reference_fasta, trim_galore)
+    with self.pool.tokens(num_cpu or self.pool.total, 'count') as num_cpu:
+      return(cam.count(fastq_files, reference_fasta, out_dir, guide_library, trimmer, mismatches=mismatches,
+                       num_cpu=num_cpu, library=library, trim_settings=trim_settings))
+
+  def job_aggregate(self, counts_files, reference_fasta, software='mageck', out_file=None):
+    reference_fasta = library_registry.resolve_fasta(reference_fasta)
+    library = self.resident.library(reference_fasta)
+    with self.pool.tokens(1, 'aggregate'):
+      return(cam.aggregate(counts_files, reference_fasta, software, out_file, library=library))
+
+  def job_screen(self, fastq_files, reference_fasta, software='mageck', out_file=None, **options):
+    counts_files = self.job_count(fastq_files, reference_fasta, **options)
+    counts_aggregated = self.job_aggregate(counts_files, reference_fasta, software, out_file)
+    return({'counts_files': counts_files, 'counts_aggregated': counts_aggregated})
+
+  def job_index(self, reference_fasta, aligner='bowtie2'):
+    if aligner not in library_registry.INDEX_BUILDERS:
+      raise ValueError('aligner must be one of %s' % ', '.join(sorted(library_registry.INDEX_BUILDERS)))
+    reference_fasta = library_registry.resolve_fasta(reference_fasta)
+    with self.pool.tokens(1, 'index'):
+      return(self.resident.index(reference_fasta, aligner))
+
+  def job_status(self):
+    with self._jobs_lock:
+      jobs = dict(self.jobs)
+    return({'pid': os.getpid(), 'uptime_s': round(time.time() - self.started, 1), 'jobs': jobs,
+            'cpu': {'total': self.pool.total, 'in_use': self.pool.in_use, 'peak': self.pool.peak},
+            'resident': self.resident.summary()})
+
+  def job_stop(self):
+    # shutdown() waits for serve_forever() to return, so it can't be called from a job thread
+    threading.Thread(target=self.shutdown).start()
+    return('stopping')
+
+  def server_close(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
+    with self._jobs_lock:
+      running = self.jobs['running']
+    if running:
+      self.info('Waiting for %d running jobs to finish...' % running)
+    # Closes the socket and joins the job threads (see socketserver.ThreadingMixIn)
+    super().server_close()
+
+
+# Function to run a CAM server until it is sent a stop job
+def serve(path=None, num_cpu=None, log=None):
+  server = CAMServer(path, num_cpu, log)
+  server.info('CAM server listening on %s with %d cores' % (server.path, server.pool.total))
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+  server.info('CAM server stopped')
+
+
+# Function to send a job (dict with a 'job' key and its options) to a CAM server and return its result.
+# Raises RuntimeError if the job failed.
+def submit(job, path=None):
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    sock.connect(socket_file(path))
+    sock.sendall((json.dumps(job) + '\n').encode('utf-8'))
+    with sock.makefile('rb') as file_obj:
+      line = file_obj.readline()
+  if not line:
+    raise RuntimeError('The CAM server closed the connection without a reply')
+  reply = json.loads(line.decode('utf-8'))
+  if not reply['ok']:
+    raise RuntimeError(reply['error'])
+  return(reply['result'])
+
+
+# Function to check whether a CAM server is listening on a socket
+def ping(path=None):
+  try:
+    submit({'job': 'status'}, path)
+    return(True)
+  except (OSError, RuntimeError, ValueError):
+    return(False)
+
+
+if __name__ == '__main__':
+
+  from argparse import ArgumentParser
+
+  arg_parse = ArgumentParser(prog=PROG_NAME, description='Long-running CAM worker service with resident guide libraries.')
+  arg_parse.add_argument('command', choices=COMMANDS)
+  arg_parse.add_argument('files', nargs='*', metavar='FILE',
+                         help='Fastq files (count, screen) or counts files (aggregate)')
+  arg_parse.add_argument('-reference', default=None,
+                         help='Guide library FASTA file, or name of a bundled library (e.g. brunello_human_lib)')
+  arg_parse.add_argument('-socket', default=None,
+                         help='Socket of the server. Default: $CAM_SERVER_SOCKET or %s' % DEFAULT_SOCKET)
+  arg_parse.add_argument('-cpu', default=None, type=int,
+                         help='start: cores shared by all jobs (default: all). Jobs: cores of the job (default: all of the server)')
+  arg_parse.add_argument('-out_dir', default=None, help='Folder of the counts files. Default: folder of the first fastq file')
+  arg_parse.add_argument('-out_file', default=None, help='Aggregated counts file. Default: counts_aggregated_<software>.tsv')
+  arg_parse.add_argument('-guide_library', default='bassik', help='Same as the CAM option. Default: bassik')
+  arg_parse.add_argument('-trimmer', default='native', choices=['native', 'none'],
+                         help='native (extract protospacers from untrimmed reads) or none (reads already trimmed). Default: native')
+  arg_parse.add_argument('-trim_galore', default=None, help='trim_galore options for the native trimmer, as for CAM.')
+  arg_parse.add_argument('-mismatches', default=0, type=int, help='Same as the CAM option. Default: 0')
+  arg_parse.add_argument('-software', default='mageck', choices=['mageck', 'bagel'], help='Aggregated counts format. Default: mageck')
+  arg_parse.add_argument('-aligner', default='bowtie2', choices=sorted(library_registry.INDEX_BUILDERS),
+                         help='Aligner of the index job. Default: bowtie2')
+
+  args = vars(arg_parse.parse_args())
+
+  command = args['command']
+  if command == 'start':
+    serve(args['socket'], args['cpu'], log=lambda msg: print(msg, flush=True))
+    sys.exit(0)
+
+  if command in ['count', 'aggregate', 'screen', 'index'] and args['reference'] is None:
+    arg_parse.error('%s needs -reference' % command)
+
+  # The server has its own working directory, so paths are sent in full
+  def full_path(path):
+    return(os.path.abspath(path) if path is not None else None)
+
+  reference_fasta = args['reference']
+  if reference_fasta is not None and os.path.exists(reference_fasta):
+    reference_fasta = full_path(reference_fasta) # otherwise a bundled library name
+  trimmer = None if args['trimmer'] == 'none' else args['trimmer']
+  count_options = {'out_dir': full_path(args['out_dir']), 'guide_library': args['guide_library'], 'trimmer': trimmer,
+                   'trim_galore': args['trim_galore'], 'mismatches': args['mismatches'], 'num_cpu': args['cpu']}
+  files = [full_path(f) for f in args['files']]
+
+  job = {'job': command}
+  if command == 'count':
+    job.update(fastq_files=files, reference_fasta=reference_fasta, **count_options)
+  elif command == 'screen':
+    job.update(fastq_files=files, reference_fasta=reference_fasta, software=args['software'], out_file=full_path(args['out_file']),
+               **count_options)
+  elif command == 'aggregate':
+    job.update(counts_files=files, reference_fasta=reference_fasta, software=args['software'], out_file=full_path(args['out_file']))
+  elif command == 'index':
+    job.update(reference_fasta=reference_fasta, aligner=args['aligner'])
+
+  try:
+    result = submit(job, args['socket'])
+  except (OSError, RuntimeError) as error:
+    print('%s: %s' % (PROG_NAME, error))
+    sys.exit(1)
+  print(json.dumps(result, indent=2) if isinstance(result, (dict, list)) else result)
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""
+Aggregation of the counts files of a run into one table, with sgRNA and
+gene columns (named as MAGeCK or Bagel expect) and one column per sample.
+
+Binary count vectors written at counting time are stacked as they are
+(already in library order). Otherwise the counts file (uniq -c layout:
+count guide) is parsed: guides that are not in the library are ignored
+and guides without reads stay at zero.
+
+numpy and pandas are only imported when a table is built.
+"""
+
+import os
+
+import count_vectors
+import guide_counts
+
+
+SOFTWARE_COLUMNS = {'mageck': ('sgRNA', 'gene'), 'bagel': ('SEQID', 'GENE')}
+
+
+# Function to get the aggregated counts file of a run (next to its counts files)
+def aggregated_file(counts_file_list, software='mageck'):
+  return(os.path.join(os.path.dirname(counts_file_list[0]), 'counts_aggregated_%s.tsv' % software))
+
+
+# Function to get the sample name of a counts file (its column in the table)
+def sample_name(counts_file):
+  return(os.path.basename(counts_file).replace('.txt', ''))
+
+
+# Function to fill a samples x guides matrix, one row per counts file.
+# warn is called with a message when a count vector cannot be used and its counts file is parsed instead,
+# and when lines of a counts file cannot be parsed.
+def count_matrix(counts_file_list, library, warn=None):
+  import numpy as np
+
+  # Row of each guide in the output table.
+  # Guides listed more than once in the library get the counts of their first entry.
+  guide_index = {}
+  duplicates = []
+  for i, name in enumerate(library.names):
+    if name in guide_index:
+      duplicates.append([i, guide_index[name]])
+    else:
+      guide_index[name] = i
+
+  counts = np.zeros((len(counts_file_list), len(library)), dtype=np.int64)
+  for k, counts_file in enumerate(counts_file_list):
+    sample_counts = counts[k]
+    vector = count_vectors.vector_file(counts_file)
+    if os.path.exists(vector):
+      try:
+        sample_counts[:] = count_vectors.read_count_vector(vector, library.library_hash)
+        continue
+      except ValueError as error:
+        if warn:
+          warn('%s. Parsing %s instead...' % (error, counts_file))
+    bad_lines = 0
+    with open(counts_file, 'r') as file_obj:
+      for line in file_obj:
+        if not line.strip():
+          continue
+        # Guide names may contain spaces (e.g. Non-Targeting Control_sgNon-Targeting Control_1)
+        try:
+          count, name = line.split(None, 1)
+          count = int(count)
+        except ValueError:
+          bad_lines += 1
+          continue
+        i = guide_index.get(name.rstrip('\n'))
+        if i is not None:
+          sample_counts[i] = count
+    if bad_lines and warn:
+      warn('%d lines of %s could not be parsed as count and guide name and were ignored' % (bad_lines, counts_file))
+  for i, j in duplicates:
+    counts[:,i] = counts[:,j]
+  return(counts)
+
+
+# Function to aggregate counts files into a table for MAGeCK or Bagel (fasta headers of the library are gene_sgRNA).
+# Samples are sorted by counts file. The library can be given already parsed.
+# Returns the file written (default: aggregated_file) and the table (pandas data frame).
+def aggregate(counts_file_list, reference_fasta, software='mageck', out_file=None, warn=None, library=None):
+  import pandas as pd
+
+  if software not in SOFTWARE_COLUMNS:
+    raise ValueError('CRISPR software tool must be either mageck or bagel')
+  guide_col, gene_col = SOFTWARE_COLUMNS[software]
+  if out_file is None:
+    out_file = aggregated_file(counts_file_list, software)
+
+  if library is None:
+    library = guide_counts.read_library(reference_fasta)
+  sgRNA_output = []
+  gene_output = []
+  for name in library.names:
+    s, g = name.split('_', 1)
+    sgRNA_output.append(g)
+    gene_output.append(s)
+
+  counts_file_list = sorted(counts_file_list)
+  counts = count_matrix(counts_file_list, library, warn)
+
+  table = pd.DataFrame(counts.T, columns=[sample_name(f) for f in counts_file_list])
+  table.insert(0, gene_col, gene_output)
+  table.insert(0, guide_col, sgRNA_output)
+  table.to_csv(out_file, sep='\t', index=False)
+  return(out_file, table)
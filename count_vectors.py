@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+"""
+Binary per-sample guide count vectors.
+
+Each file holds a 64-byte header followed by one little-endian uint32 count
+per guide, in the order of the guide library FASTA. The header stores the
+library hash so that vectors are only ever stacked against the library they
+were counted with. Files can be memory-mapped with numpy (see read_count_vector).
+
+Header layout: magic (8 bytes), format version (uint32), number of guides (uint32),
+sha256 digest of the guide library (32 bytes), zero padding to 64 bytes.
+"""
+
+import struct
+import sys
+from array import array
+
+
+MAGIC = b'CAMCOUNT'
+VERSION = 1
+HEADER_SIZE = 64
+HEADER_FORMAT = '<8sII32s'
+MAX_COUNT = 2**32 - 1
+
+
+# Function to get the path of the binary vector that goes with a _lib_guidecounts.txt file
+def vector_file(counts_file):
+  if counts_file.endswith('.txt'):
+    counts_file = counts_file[:-len('.txt')]
+  return(counts_file + '.bin')
+
+
+# Function to write counts (one per guide, in library order) to a binary vector file
+def write_count_vector(path, library, counts):
+  if len(counts) != len(library):
+    raise ValueError('%d counts given for a library of %d guides' % (len(counts), len(library)))
+  header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(counts), bytes.fromhex(library.library_hash))
+  header = header.ljust(HEADER_SIZE, b'\0')
+  data = array('I', [min(n, MAX_COUNT) for n in counts])
+  if sys.byteorder == 'big':
+    data.byteswap()
+  with open(path, 'wb') as file_obj:
+    file_obj.write(header)
+    data.tofile(file_obj)
+  return(path)
+
+
+# Function to read the header of a binary vector file. Returns number of guides and library hash.
+def read_header(path):
+  with open(path, 'rb') as file_obj:
+    header = file_obj.read(HEADER_SIZE)
+  if len(header) < HEADER_SIZE:
+    raise ValueError('%s is not a CAM count vector file' % path)
+  magic, version, num_guides, digest = struct.unpack_from(HEADER_FORMAT, header)
+  if magic != MAGIC:
+    raise ValueError('%s is not a CAM count vector file' % path)
+  if version != VERSION:
+    raise ValueError('%s has unsupported count vector version %d' % (path, version))
+  return(num_guides, digest.hex())
+
+
+# Function to memory-map a binary vector file as a numpy uint32 array.
+# If library_hash is given, the vector must have been counted against that library.
+def read_count_vector(path, library_hash=None):
+  import numpy as np
+  num_guides, digest = read_header(path)
+  if library_hash is not None and digest != library_hash:
+    raise ValueError('%s was counted against a different guide library' % path)
+  return(np.memmap(path, dtype='<u4', mode='r', offset=HEADER_SIZE, shape=(num_guides,)))
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+"""
+Pipeline-wide CPU token pool.
+
+Every stage that starts workers or subprocesses first takes one token per core
+it is going to keep busy, and gives them back when it is done, so that -cpu 16
+means at most about 16 busy cores across the whole run rather than 16 per stage.
+Each acquire and release is logged with the number of tokens in use.
+
+The pool is created once per run with init_pool() and shared through get_pool().
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+
+class CPUPool(object):
+  """
+  Counting semaphore of CPU tokens that can be taken several at a time.
+  Requests larger than the pool are capped at the pool size, so they wait
+  for the whole pool rather than forever.
+  """
+  def __init__(self, num_cpu, log=None):
+    self.total = max(1, int(num_cpu))
+    self.in_use = 0
+    self.peak = 0
+    self.log = log
+    self._condition = threading.Condition()
+
+  @property
+  def free(self):
+    with self._condition:
+      return self.total - self.in_use
+
+  def _log(self, msg):
+    if self.log is not None:
+      self.log(msg)
+
+  # Takes n tokens, waiting until they are free. Returns the number of tokens taken.
+  def acquire(self, n=1, label=''):
+    n = max(1, min(int(n), self.total))
+    with self._condition:
+      while self.total - self.in_use < n:
+        self._condition.wait()
+      self.in_use += n
+      self.peak = max(self.peak, self.in_use)
+      in_use = self.in_use
+    self._log('CPU pool: %d/%d cores in use (+%d %s)' % (in_use, self.total, n, label))
+    return n
+
+  def release(self, n=1, label=''):
+    with self._condition:
+      self.in_use -= n
+      in_use = self.in_use
+      self._condition.notify_all()
+    self._log('CPU pool: %d/%d cores in use (-%d %s)' % (in_use, self.total, n, label))
+
+  @contextmanager
+  def tokens(self, n=1, label=''):
+    n = self.acquire(n, label)
+    try:
+      yield n
+    finally:
+      self.release(n, label)
+
+  # Number of workers of the given cost (cores each) that fit in the pool
+  def workers(self, num_jobs, cost=1):
+    return max(1, min(num_jobs, self.total // max(1, cost)))
+
+
+_pool = None
+
+
+def init_pool(num_cpu=None, log=None):
+  global _pool
+  if num_cpu is None:
+    num_cpu = os.cpu_count() or 1
+  _pool = CPUPool(num_cpu, log)
+  return _pool
+
+
+def get_pool():
+  if _pool is None:
+    return init_pool()
+  return _pool
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+"""
+Single-pass demultiplexing of pooled fastq files straight into guide counts.
+
+When the samples csv has a barcode column, the fastq file of each row is a
+pool of several samples told apart by an inline barcode (at a fixed offset
+from the 5' end of the read). The pool is read once: reads are collapsed
+into unique sequences, each unique sequence is routed to the sample of its
+barcode, and the rest of the read (after the barcode) is trimmed and
+counted as a read of that sample. No per-sample fastq files are written.
+
+Barcodes are matched exactly, or with one mismatch like the guides (see
+guide_counts.GuideLibrary), and can differ in length. Reads without a
+known barcode, or whose barcode is one mismatch away from two samples,
+are counted as unassigned / ambiguous in the pool log.
+
+The counts files of each sample are the same as when counting its own
+fastq file, so aggregation is unchanged.
+"""
+
+import functools
+from collections import Counter, OrderedDict
+from itertools import islice
+
+import fastq_reader
+import guide_counts
+import progress
+import protospacer
+
+
+BARCODE_COLUMN = 'barcode'
+
+
+# Function to find the barcode column of the samples csv header (None if there is none)
+def barcode_column(header):
+  if isinstance(header, str):
+    header = header.replace('\t', ',').split(',')
+  if not header:
+    return(None)
+  for k, name in enumerate(header):
+    if str(name).strip().lower() == BARCODE_COLUMN:
+      return(k)
+  return(None)
+
+
+# Function to group the samples of the csv by pooled fastq file: fastq -> [(sample, barcode), ...]
+def pooled_samples(csv, barcode_col):
+  pools = OrderedDict()
+  for row in csv:
+    barcode = row[barcode_col].strip().upper()
+    if not barcode:
+      raise ValueError('No barcode for sample %s' % row[0])
+    pools.setdefault(row[1], []).append((row[0], barcode))
+  for fastq, samples in pools.items():
+    barcodes = [barcode for sample, barcode in samples]
+    if len(set(barcodes)) < len(barcodes):
+      raise ValueError('Samples of %s share a barcode' % fastq)
+  return(pools)
+
+
+# Function to build the barcode lookup of the samples of a pool (indices follow the order of the samples)
+def sample_barcodes(samples, mismatches=0):
+  return(guide_counts.GuideLibrary([sample for sample, barcode in samples], [barcode for sample, barcode in samples], mismatches))
+
+
+# Function to split read sequence lines by sample barcode and count the guides of each sample.
+# Returns the counts of all samples one after the other (sample k at k x library size) and stats,
+# with the stats of sample k under (k, stat) keys. With settings (-trimmer native), protospacers are
+# extracted from the rest of each read, otherwise trim5 bases are skipped before matching.
+def demultiplex_seq_lines(seq_lines, barcodes, library, settings=None, trim5=0, offset=0):
+  max_length = trim5 + max(library.lengths)
+  window = max_length
+  if settings is not None:
+    window = protospacer.read_window(settings, max_length)
+  barcode_end = offset + max(barcodes.lengths)
+  read_counts = Counter(line[:barcode_end + window] for line in seq_lines)
+  sample_reads = [Counter() for k in range(len(barcodes))]
+  stats = {'reads': 0, 'assigned': 0, 'unassigned': 0, 'ambiguous_barcode': 0}
+  for read, n in read_counts.items():
+    stats['reads'] += n
+    idx = barcodes.match(read[offset:barcode_end])
+    if idx is None:
+      stats['unassigned'] += n
+    elif idx == guide_counts.AMBIGUOUS:
+      stats['ambiguous_barcode'] += n
+    else:
+      stats['assigned'] += n
+      # Reads that end within the window keep their newline (see protospacer.seq_line_protospacers)
+      start = offset + len(barcodes.seqs[idx])
+      sample_reads[idx][read[start:start + window]] += n
+  counts = []
+  for k, reads in enumerate(sample_reads):
+    if settings is not None:
+      seq_counts, sample_stats = protospacer.read_protospacers(reads, settings, max_length)
+      sample_counts, sample_stats = protospacer.count_protospacers(seq_counts, sample_stats, library, trim5)
+    else:
+      prefix_counts = Counter()
+      for read, n in reads.items():
+        prefix_counts[read[trim5:max_length]] += n
+      sample_counts, sample_stats = guide_counts.assign_counts(prefix_counts, library)
+    counts.extend(sample_counts)
+    for key, value in sample_stats.items():
+      stats[(k, key)] = value
+  return(counts, stats)
+
+
+# Function to separate the counts and stats of each sample from those of demultiplex_seq_lines.
+# Returns per-sample counts and stats, and the stats of the pool.
+def split_samples(counts, stats, num_samples, num_guides):
+  sample_counts = [counts[k * num_guides:(k + 1) * num_guides] for k in range(num_samples)]
+  sample_stats = [{} for k in range(num_samples)]
+  pool_stats = {}
+  for key, value in stats.items():
+    if isinstance(key, tuple):
+      sample_stats[key[0]][key[1]] = value
+    else:
+      pool_stats[key] = value
+  return(sample_counts, sample_stats, pool_stats)
+
+
+# Function to demultiplex a pooled fastq file and write the counts files of each of its samples.
+# samples are (sample, barcode) pairs and counts_files the counts file of each sample.
+# With num_workers > 1, the file is split into chunks counted by that many processes.
+# Returns the counts files and the stats of the pool (number of reads of each sample included).
+def count_pooled_fastq(fastq, samples, counts_files, library, settings=None, trim5=0, offset=0, mismatches=0, num_workers=1):
+  barcodes = sample_barcodes(samples, mismatches)
+  mapper = functools.partial(demultiplex_seq_lines, barcodes=barcodes, library=library, settings=settings, trim5=trim5, offset=offset)
+  # Progress is tracked for the whole pool
+  tracker = progress.file_tracker(fastq)
+  if num_workers > 1:
+    counts, stats = fastq_reader.map_reduce(fastq, mapper, num_workers, on_partial=guide_counts.track_partials(tracker))
+  else:
+    with guide_counts.open_fastq(fastq) as fq:
+      counts, stats = mapper(tracker.lines(islice(fq, 1, None, 4), fq))
+  tracker.done()
+  sample_counts, sample_stats, pool_stats = split_samples(counts, stats, len(samples), len(library))
+  for (sample, barcode), counts_file, counts, stats in zip(samples, counts_files, sample_counts, sample_stats):
+    guide_counts.write_sample_counts(counts_file, library, counts, stats)
+    pool_stats[sample] = stats.get('reads', stats.get('total', 0))
+  return(counts_files, pool_stats)
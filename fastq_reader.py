@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+"""
+Chunked FASTQ (and SAM) reading for map-reduce counting across a process pool.
+
+A single large file is split so that all cores count it at once:
+
+  - plain files are cut at record boundaries into byte ranges that every
+    worker reads and parses by itself (nothing is sent between processes
+    but the offsets and the partial results)
+  - gzip files can't be read from the middle, so they are decompressed by
+    pigz (or gzip) in a separate process while the main process cuts the
+    decompressed stream into blocks of whole records for the workers
+
+Each worker applies a mapper to the lines it is given (the sequence line of
+every record) and the partial results (counts and stats) are summed, and
+can be reported as they come in (see progress.py).
+"""
+
+import gzip
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+
+import progress
+
+
+CHUNK_SIZE = 64 << 20 # bytes of a plain file per task
+BLOCK_SIZE = 16 << 20 # decompressed bytes of a gzip file per task
+
+
+# Function to find the start of the first record at or after a byte offset.
+# FASTQ records (record_lines=4) start with a '@' line followed two lines later by a '+' line,
+# which can't be mistaken for a quality line starting with '@'. Other records are single lines.
+def record_start(file_obj, offset, record_lines=4):
+  if offset == 0:
+    return(0)
+  file_obj.seek(offset - 1)
+  file_obj.readline() # rest of the line the offset falls in
+  pos = file_obj.tell()
+  if record_lines == 1:
+    return(pos)
+  lines = []
+  starts = []
+  for k in range(2 * record_lines):
+    starts.append(file_obj.tell())
+    lines.append(file_obj.readline())
+  for k in range(record_lines):
+    if lines[k].startswith(b'@') and lines[k + 2].startswith(b'+'):
+      return(starts[k])
+  raise ValueError('No fastq record found near byte %d of %s' % (offset, file_obj.name))
+
+
+# Function to split a plain file into byte ranges that start and end on record boundaries
+def chunk_offsets(path, chunk_size=CHUNK_SIZE, record_lines=4):
+  size = os.path.getsize(path)
+  offsets = [0]
+  with open(path, 'rb') as file_obj:
+    for offset in range(chunk_size, size, chunk_size):
+      start = record_start(file_obj, offset, record_lines)
+      if start > offsets[-1] and start < size:
+        offsets.append(start)
+  offsets.append(size)
+  return(list(zip(offsets[:-1], offsets[1:])))
+
+
+# Function to read every record_lines-th line of a byte range, starting from line number `line`
+def read_range(path, start, end, record_lines=4, line=1):
+  with open(path, 'rb') as file_obj:
+    file_obj.seek(start)
+    data = file_obj.read(end - start)
+  lines = data.decode('ascii', 'replace').splitlines(True)
+  return(lines[line::record_lines])
+
+
+# Function to decompress a gzip file in a separate process (pigz if available).
+# Returns the process, the decompressed stream and the compressed file, whose offset
+# (shared with the process, which reads it on stdin) tells how far decompression has got.
+def open_decompressor(path):
+  for tool in ['pigz', 'gzip']:
+    if shutil.which(tool):
+      source = open(path, 'rb')
+      proc = subprocess.Popen([tool, '-dc'], stdin=source, stdout=subprocess.PIPE)
+      return(proc, proc.stdout, source)
+  stream = gzip.open(path, 'rb')
+  return(None, stream, stream)
+
+
+# Function to turn whole lines (without line ends) into the lines given to a mapper
+def select_lines(lines, record_lines=4, line=1):
+  selected = lines[line::record_lines]
+  if not selected:
+    return([])
+  return((b'\n'.join(selected) + b'\n').decode('ascii', 'replace').splitlines(True))
+
+
+# Function to read a gzip file in blocks of about block_size decompressed bytes, cut at record boundaries.
+# Yields every record_lines-th line of each block, starting from line number `line`,
+# and the compressed bytes read so far.
+def read_blocks(path, record_lines=4, line=1, block_size=BLOCK_SIZE):
+  proc, stream, source = open_decompressor(path)
+  try:
+    rest = b''
+    for data in iter(lambda: stream.read(block_size), b''):
+      lines = (rest + data).split(b'\n')
+      partial_line = lines.pop()
+      keep = len(lines) - len(lines) % record_lines
+      rest = b'\n'.join(lines[keep:] + [partial_line])
+      yield select_lines(lines[:keep], record_lines, line), progress.file_position(source)
+    if rest:
+      lines = rest.split(b'\n')
+      if lines[-1] == b'':
+        lines.pop()
+      yield select_lines(lines, record_lines, line), progress.file_position(source)
+  finally:
+    stream.close()
+    source.close()
+    if proc is not None and proc.wait() not in (0, -13):
+      raise IOError('Failed to decompress %s' % path)
+
+
+# Function to add a partial result (counts, stats) to a running total.
+# Counts can be lists (one count per guide) or Counters (name -> count).
+def add_partial(total, partial):
+  if total is None:
+    return(partial)
+  counts, stats = total
+  partial_counts, partial_stats = partial
+  if isinstance(counts, list):
+    counts = [a + b for a, b in zip(counts, partial_counts)]
+  else:
+    counts.update(partial_counts)
+  for key, value in partial_stats.items():
+    stats[key] = stats.get(key, 0) + value
+  return(counts, stats)
+
+
+# Mapper of the worker processes, set when the pool starts (inherited when forked, never pickled)
+_mapper = None
+
+
+def _init_worker(mapper):
+  global _mapper
+  _mapper = mapper
+
+
+def _map_range(task):
+  path, start, end = task[:3]
+  return(end - start, _mapper(read_range(*task)))
+
+
+def _map_lines(lines):
+  return(_mapper(lines))
+
+
+# Function to count a file with mapper(lines) -> (counts, stats) across num_workers processes.
+# mapper is given every record_lines-th line of the file, starting from line number `line`
+# (the sequence line of each fastq record by default, or every line with record_lines=1, line=0).
+# If given, on_partial is called with each partial result and the bytes of the file read so far.
+def map_reduce(path, mapper, num_workers, record_lines=4, line=1, chunk_size=CHUNK_SIZE, block_size=BLOCK_SIZE, on_partial=None):
+  context = multiprocessing.get_context('fork')
+  total = None
+  if path.endswith('.gz'):
+    # The decompressor and the main process keep about one core busy between them
+    num_workers = max(1, num_workers - 1)
+    # Blocks in flight are limited so that a fast decompressor doesn't fill up the memory
+    in_flight = threading.BoundedSemaphore(2 * num_workers)
+    read_bytes = 0
+    def blocks():
+      nonlocal read_bytes
+      for block, read_bytes in read_blocks(path, record_lines, line, block_size):
+        in_flight.acquire()
+        yield block
+    with context.Pool(num_workers, _init_worker, (mapper,)) as pool:
+      for partial in pool.imap_unordered(_map_lines, blocks()):
+        in_flight.release()
+        total = add_partial(total, partial)
+        if on_partial is not None:
+          on_partial(partial, read_bytes)
+  else:
+    tasks = [(path, start, end, record_lines, line) for start, end in chunk_offsets(path, chunk_size, record_lines)]
+    done = 0
+    with context.Pool(min(num_workers, len(tasks)), _init_worker, (mapper,)) as pool:
+      for size, partial in pool.imap_unordered(_map_range, tasks):
+        total = add_partial(total, partial)
+        done += size
+        if on_partial is not None:
+          on_partial(partial, done)
+  if total is None:
+    total = mapper([])
+  return(total)
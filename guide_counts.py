@@ -0,0 +1,361 @@
+#!/usr/bin/python3
+"""
+Guide counting for CAM.
+
+Counts guides either from aligner sam/bam output or, without alignment,
+straight from FASTQ files using a sequence -> guide lookup built from the
+guide library FASTA. Counts are written as _lib_guidecounts.txt files in
+the same layout as sort | uniq -c.
+"""
+
+import functools
+import gzip
+import hashlib
+import subprocess
+from collections import Counter
+from itertools import islice
+
+import bam_reader
+import count_vectors
+import fastq_reader
+import progress
+
+
+AMBIGUOUS = -1
+
+
+class GuideLibrary(object):
+  """
+  Guide names and protospacer sequences in reference FASTA order,
+  plus a hash table from sequence to guide index.
+  Sequences shared by more than one guide are marked as AMBIGUOUS,
+  the equivalent of a multi-mapped read for the aligners.
+  
+  With mismatches=1 the table also holds every sequence one substitution
+  (including N) away from a guide, so reads with a single sequencing error
+  are still found with one hash lookup. Exact matches take precedence and
+  neighbours shared by different guides are AMBIGUOUS. This costs about
+  4 x guide length entries per guide (~6 million for a genome-wide library).
+  """
+  def __init__(self, names, seqs, mismatches=0):
+    if mismatches not in [0, 1]:
+      raise ValueError('Only 0 or 1 mismatches are supported, not %s' % mismatches)
+    self.names = names
+    self.seqs = seqs
+    self.mismatches = mismatches
+    self._library_hash = None
+    self.lengths = sorted(set(len(s) for s in seqs), reverse=True)
+    self.lookup = {}
+    for i, seq in enumerate(seqs):
+      if seq in self.lookup:
+        self.lookup[seq] = AMBIGUOUS
+      else:
+        self.lookup[seq] = i
+    if mismatches:
+      self.add_neighbours()
+
+  # Adds the 1-mismatch neighbours of every guide to the lookup table
+  def add_neighbours(self):
+    lookup = self.lookup
+    self.exact = set(lookup)
+    for i, seq in enumerate(self.seqs):
+      for pos in range(len(seq)):
+        head = seq[:pos]
+        tail = seq[pos + 1:]
+        for base in 'ACGTN':
+          if base == seq[pos]:
+            continue
+          neighbour = head + base + tail
+          j = lookup.get(neighbour)
+          if j is None:
+            lookup[neighbour] = i
+          elif j != i and neighbour not in self.exact:
+            lookup[neighbour] = AMBIGUOUS
+
+  def __len__(self):
+    return len(self.names)
+
+  # sha256 of guide names and sequences, in library order
+  @property
+  def library_hash(self):
+    if self._library_hash is None:
+      digest = hashlib.sha256()
+      for name, seq in zip(self.names, self.seqs):
+        digest.update(('%s\t%s\n' % (name, seq)).encode())
+      self._library_hash = digest.hexdigest()
+    return self._library_hash
+
+  # Returns counts in library order from a guide name -> count mapping (unknown names are ignored)
+  def counts_vector(self, guide_counts):
+    return [guide_counts.get(name, 0) for name in self.names]
+
+  # Returns guide index for a read sequence, AMBIGUOUS or None if there is no match
+  def match(self, seq):
+    for length in self.lengths:
+      if len(seq) >= length:
+        idx = self.lookup.get(seq[:length])
+        if idx is not None:
+          return idx
+    return None
+
+
+# Function to get the guide library of a reference FASTA file.
+# Bundled libraries compiled by library_registry.py are loaded from their compiled artifact instead of parsing the FASTA.
+def read_library(reference_fasta, mismatches=0):
+  import library_registry # imports this module
+  compiled = library_registry.compiled_library(reference_fasta)
+  if compiled is not None:
+    return(compiled.guide_library(mismatches))
+  return(parse_library(reference_fasta, mismatches))
+
+
+# Function to read guide names and sequences from the reference FASTA file
+def parse_library(reference_fasta, mismatches=0):
+  names = []
+  seqs = []
+  chunks = []
+  with open(reference_fasta, 'r') as fasta_obj:
+    for line in fasta_obj:
+      line = line.rstrip('\r\n')
+      if line.startswith('>'):
+        if names:
+          seqs.append(''.join(chunks).upper())
+        names.append(line[1:])
+        chunks = []
+      elif line:
+        chunks.append(line)
+  if names:
+    seqs.append(''.join(chunks).upper())
+  return(GuideLibrary(names, seqs, mismatches))
+
+
+def open_fastq(fastq):
+  if fastq.endswith('.gz'):
+    return(gzip.open(fastq, 'rt'))
+  return(open(fastq, 'r'))
+
+
+# Function to collapse read sequence lines into unique read prefixes.
+# Prefixes are long enough to hold the longest guide after skipping trim5 bases.
+def prefix_counts(seq_lines, max_length, trim5=0):
+  end = trim5 + max_length
+  return(Counter(line[trim5:end] for line in seq_lines))
+
+
+# Function to collapse the sequence line of each fastq record into unique read prefixes.
+# Reads are added to tracker (see progress.py) as they are read, if it is given.
+def read_prefix_counts(fastq, max_length, trim5=0, tracker=None):
+  with open_fastq(fastq) as fq:
+    seq_lines = islice(fq, 1, None, 4)
+    if tracker is not None:
+      seq_lines = tracker.lines(seq_lines, fq)
+    seq_counts = prefix_counts(seq_lines, max_length, trim5)
+  return(seq_counts)
+
+
+# Function to assign unique read prefixes to guides
+def assign_counts(seq_counts, library):
+  counts = [0] * len(library)
+  stats = {'total': 0, 'matched': 0, 'ambiguous': 0, 'unmatched': 0}
+  if library.mismatches:
+    stats['matched_with_mismatch'] = 0
+  for seq, n in seq_counts.items():
+    stats['total'] += n
+    seq = seq.rstrip('\n')
+    idx = library.match(seq)
+    if idx is None:
+      stats['unmatched'] += n
+    elif idx == AMBIGUOUS:
+      stats['ambiguous'] += n
+    else:
+      counts[idx] += n
+      stats['matched'] += n
+      if library.mismatches and seq[:len(library.seqs[idx])] not in library.exact:
+        stats['matched_with_mismatch'] += n
+  return(counts, stats)
+
+
+# Function to count guides in read sequence lines (one chunk of a fastq file, see fastq_reader.py)
+def count_seq_lines(seq_lines, library, trim5=0):
+  return(assign_counts(prefix_counts(seq_lines, max(library.lengths), trim5), library))
+
+
+# Function to get the on_partial callback of fastq_reader.map_reduce that adds the reads of each partial result to a tracker
+def track_partials(tracker):
+  def on_partial(partial, position):
+    tracker.update(stats_reads(partial[1]), position)
+  return(on_partial)
+
+
+# Function to count guides in a fastq file.
+# With num_workers > 1, the file is split into chunks counted by that many processes.
+def count_fastq(fastq, library, trim5=0, num_workers=1):
+  tracker = progress.file_tracker(fastq)
+  if num_workers > 1:
+    mapper = functools.partial(count_seq_lines, library=library, trim5=trim5)
+    counts, stats = fastq_reader.map_reduce(fastq, mapper, num_workers, on_partial=track_partials(tracker))
+  else:
+    seq_counts = read_prefix_counts(fastq, max(library.lengths), trim5, tracker)
+    counts, stats = assign_counts(seq_counts, library)
+  tracker.done()
+  return(counts, stats)
+
+
+# Function to write counts in the same layout as uniq -c (guides with no reads are omitted)
+def write_counts(counts_file, library, counts):
+  with open(counts_file, 'w') as file_obj:
+    for name, n in zip(library.names, counts):
+      if n > 0:
+        file_obj.write('%7d %s\n' % (n, name))
+  return(counts_file)
+
+
+def write_count_log(counts_log, stats):
+  with open(counts_log, 'w') as file_obj:
+    for key in stats:
+      file_obj.write('%s\t%d\n' % (key, stats[key]))
+  return(counts_log)
+
+
+# Function to read the stats written by write_count_log
+def read_count_log(counts_log):
+  stats = {}
+  with open(counts_log, 'r') as file_obj:
+    for line in file_obj:
+      key, value = line.rstrip('\n').split('\t')
+      stats[key] = int(value)
+  return(stats)
+
+
+# Function to get the number of reads behind count stats (fastq or sam counts)
+def stats_reads(stats):
+  if 'reads' in stats:
+    return(stats['reads'])
+  if 'total' in stats:
+    return(stats['total'])
+  return(stats.get('mapped', 0) + stats.get('unmapped', 0) + stats.get('multimapped', 0))
+
+
+# Function to collapse identical reads of a fastq file into a fasta file of unique sequences.
+# Read names carry the multiplicity (fastx_collapser style: >rank-count), so counts can be restored after alignment.
+def collapse_fastq(fastq_collapsed):
+  fastq, collapsed_fasta = fastq_collapsed
+  tracker = progress.file_tracker(fastq)
+  with open_fastq(fastq) as fq:
+    seq_counts = Counter(line.rstrip('\n') for line in tracker.lines(islice(fq, 1, None, 4), fq))
+  tracker.done()
+  with open(collapsed_fasta, 'w') as file_obj:
+    for rank, (seq, n) in enumerate(seq_counts.most_common(), 1):
+      file_obj.write('>%d-%d\n%s\n' % (rank, n, seq))
+  return(collapsed_fasta)
+
+
+# Function to get the read multiplicity back from a collapsed read name
+def read_multiplicity(read_name):
+  return(int(read_name.rsplit('-', 1)[1]))
+
+
+# Function to count guides from sam records (header lines are skipped).
+# Unaligned reads (flag 4) are dropped and, for bowtie2, so are reads with an XS: tag (multi-mapped).
+# Memory use depends on the number of guides, not on the number of reads.
+def count_sam_records(sam_lines, aligner='bowtie2', collapsed=False):
+  counts = Counter()
+  stats = {'mapped': 0, 'unmapped': 0, 'multimapped': 0}
+  check_xs = aligner == 'bowtie2'
+  for line in sam_lines:
+    if line.startswith('@'):
+      continue
+    fields = line.split('\t', 3)
+    n = 1
+    if collapsed:
+      n = read_multiplicity(fields[0])
+    flag = fields[1]
+    if flag in ('+', '-'):
+      # bowtie default (non-sam) output only lists aligned reads, with the strand in the second column
+      flag = '0'
+    if int(flag) & 4:
+      stats['unmapped'] += n
+    elif check_xs and 'XS:' in line:
+      stats['multimapped'] += n
+    else:
+      counts[fields[2]] += n
+      stats['mapped'] += n
+  return(counts, stats)
+
+
+# Function to count guides from a sam, bam or (through samtools view) cram file.
+# With num_workers > 1, sam files are split into chunks counted by that many processes
+# and bam files are decompressed by that many threads (see bam_reader.py).
+# cram files are decoded against reference_fasta.
+# Progress is tracked in sam records (collapsed reads count once).
+def count_sam_file(sam_file, aligner='bowtie2', collapsed=False, num_workers=1, reference_fasta=None):
+  tracker = progress.file_tracker(sam_file)
+  if sam_file.endswith('.bam'):
+    counts, stats = bam_reader.count_bam_records(sam_file, aligner, collapsed, num_workers, tracker)
+  elif sam_file.endswith('.cram'):
+    counts, stats = count_cram_file(sam_file, aligner, collapsed, reference_fasta, tracker)
+  elif num_workers > 1:
+    mapper = functools.partial(count_sam_records, aligner=aligner, collapsed=collapsed)
+    counts, stats = fastq_reader.map_reduce(sam_file, mapper, num_workers, record_lines=1, line=0, on_partial=track_partials(tracker))
+  else:
+    with open(sam_file, 'r') as sam_obj:
+      counts, stats = count_sam_records(tracker.lines(sam_obj, sam_obj), aligner, collapsed)
+  tracker.done()
+  return(counts, stats)
+
+
+# Function to count guides from a cram file, decoded by samtools view
+def count_cram_file(cram_file, aligner='bowtie2', collapsed=False, reference_fasta=None, tracker=None):
+  cmdArgs = ['samtools', 'view']
+  if reference_fasta is not None:
+    cmdArgs += ['-T', reference_fasta]
+  samtools_proc = subprocess.Popen(cmdArgs + [cram_file], stdout=subprocess.PIPE, universal_newlines=True)
+  sam_lines = samtools_proc.stdout
+  if tracker is not None:
+    sam_lines = tracker.lines(sam_lines)
+  counts, stats = count_sam_records(sam_lines, aligner, collapsed)
+  samtools_proc.stdout.close()
+  if samtools_proc.wait() != 0:
+    raise IOError('samtools view failed to read %s' % cram_file)
+  return(counts, stats)
+
+
+# Function to pass lines through while copying them to another stream (e.g. samtools stdin)
+def tee_lines(lines, file_obj):
+  for line in lines:
+    file_obj.write(line)
+    yield line
+
+
+# Function to write guide name -> count pairs in the same layout as sort | uniq -c
+def write_guide_counts(counts_file, counts):
+  with open(counts_file, 'w') as file_obj:
+    for name in sorted(counts):
+      file_obj.write('%7d %s\n' % (counts[name], name))
+  return(counts_file)
+
+
+# Function to write the _lib_guidecounts.txt, .log and binary .bin files of a sample.
+# counts holds one count per library guide, in library order.
+def write_sample_counts(counts_file, library, counts, stats):
+  write_counts(counts_file, library, counts)
+  write_count_log(counts_file[:-len('.txt')] + '.log', stats)
+  count_vectors.write_count_vector(count_vectors.vector_file(counts_file), library, counts)
+  return(counts_file)
+
+
+# Function to write the counts files of a sample counted from sam records (guide name -> count).
+# The binary .bin vector is only written if the guide library is given.
+def write_sam_counts(counts_file, counts, stats, library=None):
+  write_guide_counts(counts_file, counts)
+  write_count_log(counts_file[:-len('.txt')] + '.log', stats)
+  if library is not None:
+    count_vectors.write_count_vector(count_vectors.vector_file(counts_file), library, library.counts_vector(counts))
+  return(counts_file)
+
+
+# Function to count one fastq file and write its counts files
+def count_fastq_file(fastq_counts, library, trim5=0, num_workers=1):
+  fastq, counts_file = fastq_counts
+  counts, stats = count_fastq(fastq, library, trim5, num_workers)
+  return(write_sample_counts(counts_file, library, counts, stats))
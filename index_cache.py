@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+"""
+Shared cache of bowtie/bowtie2 indices.
+
+Indices are keyed by a hash of the reference FASTA contents and of the index
+builder version, so an edited FASTA or a new aligner release gets a fresh
+index. Builds happen in a temporary directory that is renamed into place once
+complete, under a file lock, so concurrent runs against the same library build
+the index exactly once and never see a half-written index.
+
+The cache lives in $CAM_INDEX_CACHE, or ~/.cache/cam/indexes if it is not set.
+If a build fails, its log is kept next to the index directory as
+<index dir>.failed.log and a RuntimeError naming it is raised.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
+
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'cam', 'indexes')
+
+
+def cache_dir(cache=None):
+  if cache is None:
+    cache = os.environ.get('CAM_INDEX_CACHE', DEFAULT_CACHE)
+  return(os.path.abspath(cache))
+
+
+# Function to hash the contents of a file
+def file_digest(path, block_size=1 << 20):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as file_obj:
+    for block in iter(lambda: file_obj.read(block_size), b''):
+      digest.update(block)
+  return(digest.hexdigest())
+
+
+# Function to get the version string reported by the index builder (e.g. bowtie2-build --version)
+def builder_version(index_builder):
+  try:
+    proc = subprocess.run([index_builder, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+  except OSError as error:
+    raise RuntimeError('Index builder %s could not be run (%s). Please check that it is installed and in your PATH.' % (index_builder, error))
+  return(proc.stdout.strip())
+
+
+# Function to get the cache key of the index of a FASTA file
+def index_key(reference_fasta, index_builder):
+  digest = hashlib.sha256()
+  digest.update(file_digest(reference_fasta).encode())
+  digest.update(index_builder.encode())
+  digest.update(builder_version(index_builder).encode())
+  return(digest.hexdigest()[:32])
+
+
+@contextmanager
+def file_lock(lock_file):
+  with open(lock_file, 'w') as lock_obj:
+    fcntl.lockf(lock_obj, fcntl.LOCK_EX)
+    try:
+      yield lock_obj
+    finally:
+      fcntl.lockf(lock_obj, fcntl.LOCK_UN)
+
+
+# Function to return the index base name for a FASTA file, building the index if it isn't cached yet.
+# Returns the index base name and whether the index had to be built.
+def get_index(reference_fasta, index_builder, cache=None):
+  cache = cache_dir(cache)
+  key = index_key(reference_fasta, index_builder)
+  base = os.path.basename(reference_fasta).split('.')[:-1]
+  base = '.'.join(base)
+  index_dir = os.path.join(cache, '%s-%s' % (os.path.basename(index_builder), key))
+  if os.path.isdir(index_dir):
+    return(os.path.join(index_dir, base), False)
+
+  os.makedirs(cache, exist_ok=True)
+  with file_lock(index_dir + '.lock'):
+    # Another run may have built the index while we waited for the lock
+    if os.path.isdir(index_dir):
+      return(os.path.join(index_dir, base), False)
+    temp_dir = tempfile.mkdtemp(prefix=os.path.basename(index_dir) + '.tmp', dir=cache)
+    build_log = os.path.join(temp_dir, 'build.log')
+    try:
+      try:
+        with open(build_log, 'w') as log_obj:
+          cmdArgs = [index_builder, reference_fasta, os.path.join(temp_dir, base)]
+          subprocess.run(cmdArgs, stdout=log_obj, stderr=subprocess.STDOUT, check=True)
+      except (OSError, subprocess.CalledProcessError):
+        # The temporary directory is removed below, so the log is kept next to the index directory
+        failed_log = index_dir + '.failed.log'
+        shutil.copyfile(build_log, failed_log)
+        raise RuntimeError('%s failed to build the index of %s. See %s' % (index_builder, reference_fasta, failed_log))
+      # mkdtemp creates private directories; make the index readable like any other new directory
+      umask = os.umask(0)
+      os.umask(umask)
+      os.chmod(temp_dir, 0o777 & ~umask)
+      os.rename(temp_dir, index_dir)
+    except BaseException:
+      shutil.rmtree(temp_dir, ignore_errors=True)
+      raise
+  return(os.path.join(index_dir, base), True)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Library representation QC of every sample of an aggregated counts file.
+
+For each sample (column of the counts matrix):
+
+  reads           total guide counts
+  guides          number of guides
+  coverage        mean reads per guide
+  zero_fraction   fraction of guides without reads
+  gini            Gini index of the guide counts (0: even representation)
+  skew_ratio      90th / 10th percentile of the guide counts (None if the 10th percentile is 0)
+  lorenz          Lorenz curve (cumulative fraction of reads of the guides ranked by abundance)
+                  at LORENZ_POINTS evenly spaced fractions of guides
+
+All samples are computed at once from the column-sorted matrix.
+Results are written to library_qc.tsv (one row per sample) and library_qc.json (with the Lorenz curves).
+
+Usage: python3 library_qc.py counts_aggregated_mageck.tsv
+"""
+
+import json
+import os
+
+import numpy as np
+
+import normalise
+
+
+PROG_NAME = 'library_qc'
+QC_TSV = 'library_qc.tsv'
+QC_JSON = 'library_qc.json'
+LORENZ_POINTS = 101
+METRICS = ['reads', 'guides', 'coverage', 'zero_fraction', 'gini', 'skew_ratio']
+
+
+# Function to read the counts matrix (guides x samples) and sample names of an aggregated counts file
+def read_counts(counts_tsv, id_columns=normalise.ID_COLUMNS):
+  samples = normalise.read_header(counts_tsv)[id_columns:]
+  chunks = [counts for ids, counts in normalise.read_chunks(counts_tsv, id_columns=id_columns)]
+  if chunks:
+    counts = np.vstack(chunks)
+  else:
+    counts = np.zeros((0, len(samples)))
+  return(counts, samples)
+
+
+# Function to get the Gini index of every column of a column-sorted matrix
+def gini(sorted_counts):
+  n = sorted_counts.shape[0]
+  totals = sorted_counts.sum(axis=0)
+  weighted = np.arange(1, n + 1) @ sorted_counts
+  with np.errstate(divide='ignore', invalid='ignore'):
+    index = 2.0 * weighted / (n * totals) - (n + 1.0) / n
+  return(np.where(totals > 0, index, np.nan))
+
+
+# Function to get the full Lorenz curves (n + 1 points from 0 to 1) of every column of a column-sorted matrix
+def lorenz_curves(sorted_counts):
+  totals = sorted_counts.sum(axis=0)
+  cumulative = np.vstack([np.zeros((1, sorted_counts.shape[1])), sorted_counts.cumsum(axis=0)])
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return(np.where(totals > 0, cumulative / totals, np.nan))
+
+
+# Function to get the Lorenz curves at num_points evenly spaced fractions of guides (linear interpolation)
+def lorenz_points(sorted_counts, num_points=LORENZ_POINTS):
+  curves = lorenz_curves(sorted_counts)
+  n = curves.shape[0] - 1
+  fractions = np.linspace(0, 1, num_points)
+  positions = fractions * n
+  lower = np.floor(positions).astype(np.int64)
+  upper = np.minimum(lower + 1, n)
+  weights = (positions - lower)[:,None]
+  return(fractions, curves[lower] * (1 - weights) + curves[upper] * weights)
+
+
+# Function to compute the QC metrics of every sample of a counts matrix (guides x samples)
+def library_qc(counts, samples, num_points=LORENZ_POINTS):
+  counts = np.asarray(counts, dtype=np.float64)
+  sorted_counts = np.sort(counts, axis=0)
+  n = sorted_counts.shape[0]
+  reads = sorted_counts.sum(axis=0)
+  p10, p90 = np.percentile(sorted_counts, [10, 90], axis=0) if n else (np.zeros(len(samples)), np.zeros(len(samples)))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    coverage = reads / n
+    zero_fraction = (sorted_counts == 0).sum(axis=0) / float(n)
+    skew_ratio = np.where(p10 > 0, p90 / p10, np.nan)
+  gini_index = gini(sorted_counts)
+  fractions, lorenz = lorenz_points(sorted_counts, num_points)
+  def value(x, digits=6):
+    return(None if np.isnan(x) else round(float(x), digits))
+  qc = []
+  for k, sample in enumerate(samples):
+    qc.append({'sample': sample,
+               'reads': int(reads[k]) if reads[k] == int(reads[k]) else float(reads[k]),
+               'guides': n,
+               'coverage': value(coverage[k], 3),
+               'zero_fraction': value(zero_fraction[k]),
+               'gini': value(gini_index[k]),
+               'skew_ratio': value(skew_ratio[k], 3),
+               'lorenz': [value(x) for x in lorenz[:,k]]})
+  return(qc, [round(float(x), 6) for x in fractions])
+
+
+# Function to write the QC metrics to a .tsv table and a .json file (with the Lorenz curves)
+def write_qc(qc, fractions, out_dir='.'):
+  qc_tsv = os.path.join(out_dir, QC_TSV)
+  qc_json = os.path.join(out_dir, QC_JSON)
+  with open(qc_tsv, 'w') as file_obj:
+    file_obj.write('\t'.join(['sample'] + METRICS) + '\n')
+    for sample in qc:
+      file_obj.write('\t'.join([sample['sample']] + ['NA' if sample[m] is None else str(sample[m]) for m in METRICS]) + '\n')
+  with open(qc_json, 'w') as file_obj:
+    json.dump({'lorenz_fractions': fractions, 'samples': qc}, file_obj, indent=1)
+  return(qc_tsv, qc_json)
+
+
+# Function to run the QC of an aggregated counts file and write the results next to it
+def counts_file_qc(counts_tsv, out_dir=None, num_points=LORENZ_POINTS):
+  if out_dir is None:
+    out_dir = os.path.dirname(counts_tsv) or '.'
+  counts, samples = read_counts(counts_tsv)
+  qc, fractions = library_qc(counts, samples, num_points)
+  write_qc(qc, fractions, out_dir)
+  return(qc)
+
+
+# Function to format the QC metrics as table lines (for the log)
+def summary(qc):
+  lines = ['%-30s %12s %10s %8s %8s %8s' % ('Sample', 'Reads', 'Coverage', 'Zero', 'Gini', '90/10')]
+  for sample in qc:
+    lines.append('%-30s %12d %10.1f %8.4f %8.3f %8s' % (sample['sample'][:30], sample['reads'], sample['coverage'] or 0,
+                                                         sample['zero_fraction'] or 0, sample['gini'] or 0,
+                                                         'NA' if sample['skew_ratio'] is None else '%.2f' % sample['skew_ratio']))
+  return(lines)
+
+
+if __name__ == '__main__':
+
+  from argparse import ArgumentParser
+
+  arg_parse = ArgumentParser(prog=PROG_NAME, description='Library representation QC of every sample of an aggregated counts file.')
+  arg_parse.add_argument('counts_tsv', metavar='COUNTS_TSV', nargs='?', default=None,
+                         help='Aggregated counts file (e.g. counts_aggregated_mageck.tsv). Default: the one in the current folder')
+  arg_parse.add_argument('-o', '--out_dir', default=None, help='Output folder. Default: the folder of the counts file')
+  arg_parse.add_argument('-lorenz_points', default=LORENZ_POINTS, type=int,
+                         help='Number of points of the Lorenz curves in the json file. Default: %d' % LORENZ_POINTS)
+
+  args = vars(arg_parse.parse_args())
+
+  counts_tsv = args['counts_tsv'] or normalise.find_counts_file()
+  qc = counts_file_qc(counts_tsv, args['out_dir'], args['lorenz_points'])
+  for line in summary(qc):
+    print(line)
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+"""
+Registry of the guide libraries bundled in Addgene_CRISPR_libraries_FASTA.
+
+compile-libraries preprocesses every library FASTA once into a compact
+artifact directory (compiled/<library name>/):
+
+  library.json   - library metadata, vector (adapter) sequences from
+                   libraries_info.csv, library hash, aligner indices and
+                   size and modification time of the FASTA it was built from
+  seqs.2bit      - guide sequences packed 2 bits per base (A=0 C=1 G=2 T=3)
+  lengths.bin    - guide lengths (uint8), needed to unpack seqs.2bit
+  names.txt      - guide names, one per line, in FASTA order
+
+Aligner indices are built into the shared index cache (see index_cache.py),
+so runs against a compiled library never build them again.
+
+At runtime guide_counts.read_library loads bundled libraries from their
+artifact (see compiled_library) instead of parsing the FASTA, as long as
+the FASTA hasn't changed since it was compiled. load_library(name) returns
+a CompiledLibrary that only reads the files it needs when they are first
+used.
+
+Usage: python3 library_registry.py compile-libraries [-aligners bowtie2 bowtie]
+       python3 library_registry.py list
+"""
+
+import csv
+import glob
+import json
+import os
+import sys
+from array import array
+from itertools import accumulate
+
+import guide_counts
+import index_cache
+
+
+PROG_NAME = 'library_registry'
+LIBRARY_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Addgene_CRISPR_libraries_FASTA')
+LIBRARY_INFO = os.path.join(LIBRARY_DIR, 'libraries_info.csv')
+DEFAULT_REGISTRY = os.path.join(LIBRARY_DIR, 'compiled')
+FORMAT_VERSION = 2
+
+BASE_CODE = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+# Base at each of the 4 positions of a packed byte, as bytes.translate tables
+UNPACK_TABLES = [bytes(ord('ACGT'[(b >> shift) & 3]) for b in range(256)) for shift in (6, 4, 2, 0)]
+INDEX_BUILDERS = {'bowtie': 'bowtie-build', 'bowtie2': 'bowtie2-build'}
+
+
+def registry_dir(registry=None):
+  if registry is None:
+    registry = os.environ.get('CAM_LIBRARY_REGISTRY', DEFAULT_REGISTRY)
+  return(os.path.abspath(registry))
+
+
+# Function to list the bundled library fasta files: library name -> (collection, fasta path).
+# Library names are the fasta file names without extension, collections are their folders.
+def find_libraries(library_dir=LIBRARY_DIR):
+  libraries = {}
+  for fasta in sorted(glob.glob(os.path.join(library_dir, '*', '*.fasta'))):
+    name = os.path.basename(fasta).rsplit('.', 1)[0]
+    collection = os.path.basename(os.path.dirname(fasta))
+    libraries[name] = (collection, fasta)
+  return(libraries)
+
+
+# Function to read libraries_info.csv: collection -> Addgene number and vector sequences
+def read_library_info(library_info=LIBRARY_INFO):
+  def clean(value):
+    value = value.strip()
+    if value.lower() in ['', 'na']:
+      return(None)
+    return(value)
+  info = {}
+  with open(library_info, 'r', newline='') as file_obj:
+    reader = csv.reader(file_obj)
+    next(reader)
+    for row in reader:
+      row = row + [''] * (6 - len(row))
+      info[row[0]] = {'addgene': clean(row[1]),
+                      'vector_5prime': clean(row[2]),
+                      'vector_3prime': clean(row[3]),
+                      'standard_method': clean(row[4]),
+                      'comments': clean(row[5])}
+  return(info)
+
+
+# Function to pack a sequence 2 bits per base, 4 bases per byte (non-ACGT bases are packed as A)
+def pack_seq(seq):
+  packed = bytearray((len(seq) + 3) // 4)
+  for i, base in enumerate(seq):
+    packed[i >> 2] |= BASE_CODE.get(base, 0) << (6 - 2 * (i & 3))
+  return(bytes(packed))
+
+
+# Function to unpack the sequences packed one after the other by pack_seq
+def unpack_seqs(packed, lengths):
+  bases = bytearray(4 * len(packed))
+  for position, table in enumerate(UNPACK_TABLES):
+    bases[position::4] = packed.translate(table)
+  bases = bases.decode('ascii')
+  starts = [0] + list(accumulate([4 * ((length + 3) // 4) for length in lengths]))
+  return([bases[start:start + length] for start, length in zip(starts, lengths)])
+
+
+def fasta_stat(fasta):
+  stat = os.stat(fasta)
+  return([stat.st_size, stat.st_mtime_ns])
+
+
+# Function to write the compiled artifact of one library fasta
+def compile_library(name, collection, fasta, out_dir, info=None, aligners=None, cache=None):
+  library = guide_counts.parse_library(fasta)
+  os.makedirs(out_dir, exist_ok=True)
+
+  lengths = array('B', [len(s) for s in library.seqs])
+  with open(os.path.join(out_dir, 'lengths.bin'), 'wb') as file_obj:
+    lengths.tofile(file_obj)
+  with open(os.path.join(out_dir, 'seqs.2bit'), 'wb') as file_obj:
+    for seq in library.seqs:
+      file_obj.write(pack_seq(seq))
+  with open(os.path.join(out_dir, 'names.txt'), 'w') as file_obj:
+    file_obj.write('\n'.join(library.names) + '\n')
+  # Sequences with bases other than ACGT can't be packed, so they are kept as they are
+  exceptions = {}
+  for i, seq in enumerate(library.seqs):
+    if set(seq) - set('ACGT'):
+      exceptions[str(i)] = seq
+
+  indices = {}
+  for aligner in aligners or []:
+    indices[aligner], built = index_cache.get_index(fasta, INDEX_BUILDERS[aligner], cache)
+
+  meta = {'format_version': FORMAT_VERSION,
+          'name': name,
+          'collection': collection,
+          'fasta': os.path.abspath(fasta),
+          'fasta_sha256': index_cache.file_digest(fasta),
+          'fasta_stat': fasta_stat(fasta),
+          'library_hash': library.library_hash,
+          'num_guides': len(library),
+          'guide_lengths': sorted(set(lengths)),
+          'exceptions': exceptions,
+          'info': info or {},
+          'indices': indices}
+  with open(os.path.join(out_dir, 'library.json'), 'w') as file_obj:
+    json.dump(meta, file_obj, indent=1)
+  return(out_dir)
+
+
+# Function to compile every bundled library into the registry
+def compile_libraries(registry=None, aligners=None, cache=None, library_dir=LIBRARY_DIR):
+  registry = registry_dir(registry)
+  info = read_library_info(os.path.join(library_dir, 'libraries_info.csv'))
+  compiled = []
+  for name, (collection, fasta) in find_libraries(library_dir).items():
+    print('Compiling %s (%s)...' % (name, collection))
+    out_dir = os.path.join(registry, name)
+    compiled.append(compile_library(name, collection, fasta, out_dir, info.get(collection), aligners, cache))
+  return(compiled)
+
+
+class CompiledLibrary(object):
+  """
+  A library compiled by compile-libraries.
+  Metadata is read on load, everything else when first used.
+  """
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, 'library.json'), 'r') as file_obj:
+      self.meta = json.load(file_obj)
+    self.name = self.meta['name']
+    self.fasta = self.meta['fasta']
+    self.info = self.meta['info']
+    self.indices = self.meta['indices']
+    self._names = None
+    self._seqs = None
+    self._guide_libraries = {}
+
+  def __len__(self):
+    return self.meta['num_guides']
+
+  def _read_lines(self, file_name):
+    with open(os.path.join(self.path, file_name), 'r') as file_obj:
+      return file_obj.read().splitlines()
+
+  @property
+  def names(self):
+    if self._names is None:
+      self._names = self._read_lines('names.txt')
+    return self._names
+
+  @property
+  def seqs(self):
+    if self._seqs is None:
+      lengths = array('B')
+      with open(os.path.join(self.path, 'lengths.bin'), 'rb') as file_obj:
+        lengths.frombytes(file_obj.read())
+      with open(os.path.join(self.path, 'seqs.2bit'), 'rb') as file_obj:
+        seqs = unpack_seqs(file_obj.read(), lengths)
+      for i, seq in self.meta['exceptions'].items():
+        seqs[int(i)] = seq
+      self._seqs = seqs
+    return self._seqs
+
+  @property
+  def vector_3prime(self):
+    return self.info.get('vector_3prime')
+
+  @property
+  def vector_5prime(self):
+    return self.info.get('vector_5prime')
+
+  # GuideLibrary with the sequence -> guide lookup used for counting
+  def guide_library(self, mismatches=0):
+    if mismatches not in self._guide_libraries:
+      library = guide_counts.GuideLibrary(self.names, self.seqs, mismatches)
+      library._library_hash = self.meta['library_hash']
+      self._guide_libraries[mismatches] = library
+    return self._guide_libraries[mismatches]
+
+
+# Function to load a compiled library by name
+def load_library(name, registry=None):
+  path = os.path.join(registry_dir(registry), name)
+  if not os.path.exists(os.path.join(path, 'library.json')):
+    raise KeyError('Library %s has not been compiled. Please run: python3 library_registry.py compile-libraries' % name)
+  return(CompiledLibrary(path))
+
+
+# Function to get the compiled library of a reference fasta, or None if the fasta is not a compiled
+# bundled library (e.g. a user's own fasta with the same file name) or has changed since it was compiled
+def compiled_library(reference_fasta, registry=None):
+  path = os.path.join(registry_dir(registry), os.path.basename(reference_fasta).rsplit('.', 1)[0])
+  if not os.path.exists(os.path.join(path, 'library.json')):
+    return(None)
+  try:
+    library = CompiledLibrary(path)
+    if library.meta['format_version'] != FORMAT_VERSION:
+      return(None)
+    if os.path.realpath(library.fasta) != os.path.realpath(reference_fasta):
+      return(None)
+    if library.meta['fasta_stat'] != fasta_stat(reference_fasta):
+      return(None)
+  except (OSError, ValueError, KeyError):
+    return(None)
+  return(library)
+
+
+# Function to get the libraries_info.csv entry (vector sequences etc.) of a bundled library fasta.
+# Returns an empty dict for fasta files that are not bundled.
+def library_info(reference_fasta, registry=None):
+  library = compiled_library(reference_fasta, registry)
+  if library is not None:
+    return(library.info)
+  for name, (collection, fasta) in find_libraries().items():
+    if os.path.realpath(fasta) == os.path.realpath(reference_fasta):
+      return(read_library_info().get(collection, {}))
+  return({})
+
+
+# Function to get a reference fasta path from either a fasta path or the name of a bundled library
+def resolve_fasta(reference_fasta, registry=None):
+  if reference_fasta is None or os.path.exists(reference_fasta):
+    return(reference_fasta)
+  try:
+    return(load_library(reference_fasta, registry).fasta)
+  except KeyError:
+    libraries = find_libraries()
+    if reference_fasta in libraries:
+      return(libraries[reference_fasta][1])
+  return(reference_fasta)
+
+
+if __name__ == '__main__':
+
+  from argparse import ArgumentParser
+
+  arg_parse = ArgumentParser(prog=PROG_NAME, description='Compile and list the bundled CRISPR guide libraries.')
+  arg_parse.add_argument('command', choices=['compile-libraries', 'list'])
+  arg_parse.add_argument('-registry', default=None,
+                         help='Directory of compiled libraries. Default: $CAM_LIBRARY_REGISTRY or %s' % DEFAULT_REGISTRY)
+  arg_parse.add_argument('-aligners', nargs='*', default=[], choices=sorted(INDEX_BUILDERS),
+                         help='Aligners whose indices should be prebuilt into the index cache.')
+  arg_parse.add_argument('-index_cache', default=None,
+                         help='Directory of the aligner index cache. Default: $CAM_INDEX_CACHE or ~/.cache/cam/indexes')
+
+  args = vars(arg_parse.parse_args())
+
+  if args['command'] == 'compile-libraries':
+    compile_libraries(registry=args['registry'], aligners=args['aligners'], cache=args['index_cache'])
+  else:
+    for name, (collection, fasta) in find_libraries().items():
+      status = 'compiled' if compiled_library(fasta, args['registry']) is not None else 'not compiled'
+      print('%s\t%s\t%s' % (name, collection, status))
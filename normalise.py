@@ -5,39 +5,209 @@ Created on Thu Sep  5 14:51:11 2019
 
 @author: nwit
 
-Normalises sgRNA count from join file output for direct visual comparisons.
+Normalises sgRNA counts of the aggregated counts file (tsv_format output:
+guide and gene columns followed by one column per sample) for direct
+visual comparisons.
 
+Methods (normalised count = count / size factor of the sample):
+
+  total         scales every sample to the mean number of reads per sample
+  cpm           counts per million reads
+  median_ratio  median ratio to the geometric mean of each guide across
+                samples (DESeq), over guides counted in every sample
+  control       scales the control guides (e.g. non-targeting) of every
+                sample to their mean number of reads per sample
+
+The file is read in chunks of rows, so the matrix is never loaded in full:
+one pass gets the size factors (two for median_ratio, which finds the
+median of each sample exactly from a histogram first) and one more writes
+the normalised counts. Counts are not truncated to integers.
+
+Usage: python3 normalise.py counts_aggregated_mageck.tsv -method median_ratio
 """
-import pandas as pd
+
 import glob
+import itertools
+import os
+import re
+
+import numpy as np
+
+
+PROG_NAME = 'normalise'
+METHODS = ['total', 'cpm', 'median_ratio', 'control']
+OUT_FILE = 'normalised-counts-aggregated.tsv'
+CHUNK_ROWS = 1 << 16
+ID_COLUMNS = 2 # guide and gene
+CONTROL_PATTERN = 'non.?target|control' # names of control guides in the bundled libraries
+LOG_RATIO_RANGE = 40.0 # natural log ratios are binned between -40 and 40
+LOG_RATIO_BINS = 8000
+
+
+# Function to read the header of a counts file
+def read_header(counts_tsv):
+  with open(counts_tsv, 'r') as file_obj:
+    return(file_obj.readline().rstrip('\n').split('\t'))
+
+
+# Function to read a counts file in chunks of rows.
+# Yields the identifier columns of the rows and their counts (rows x samples).
+def read_chunks(counts_tsv, chunk_rows=CHUNK_ROWS, id_columns=ID_COLUMNS):
+  with open(counts_tsv, 'r') as file_obj:
+    file_obj.readline()
+    while True:
+      lines = list(itertools.islice(file_obj, chunk_rows))
+      if not lines:
+        break
+      rows = [line.rstrip('\n').split('\t') for line in lines if line.strip()]
+      ids = [row[:id_columns] for row in rows]
+      counts = np.array([row[id_columns:] for row in rows], dtype=np.float64)
+      yield(ids, counts)
+
+
+# Function to find the control guides of a chunk: their guide or gene name matches a regular
+# expression, or their guide name is in a set of names
+def control_mask(ids, controls):
+  if isinstance(controls, (set, frozenset)):
+    return(np.array([row[0] in controls for row in ids], dtype=bool))
+  return(np.array([controls.search(' '.join(row)) is not None for row in ids], dtype=bool))
+
+
+# Function to get the control guides from a file of guide names (one per line), or else a regular expression
+def read_controls(controls=CONTROL_PATTERN):
+  if isinstance(controls, str) and os.path.isfile(controls):
+    with open(controls, 'r') as file_obj:
+      return(set(line.strip() for line in file_obj if line.strip()))
+  if isinstance(controls, str):
+    return(re.compile(controls, re.IGNORECASE))
+  return(controls)
+
+
+# Function to get the total and control guide counts of every sample
+def column_sums(counts_tsv, controls=None, chunk_rows=CHUNK_ROWS, id_columns=ID_COLUMNS):
+  num_samples = len(read_header(counts_tsv)) - id_columns
+  sums = np.zeros(num_samples)
+  control_sums = np.zeros(num_samples)
+  num_controls = 0
+  for ids, counts in read_chunks(counts_tsv, chunk_rows, id_columns):
+    sums += counts.sum(axis=0)
+    if controls is not None:
+      mask = control_mask(ids, controls)
+      control_sums += counts[mask].sum(axis=0)
+      num_controls += int(mask.sum())
+  return(sums, control_sums, num_controls)
+
+
+# Function to get the log ratios of every guide counted in all samples to its geometric mean
+def log_ratios(counts):
+  counts = counts[(counts > 0).all(axis=1)]
+  logs = np.log(counts)
+  return(logs - logs.mean(axis=1, keepdims=True))
+
+
+# Function to get the median ratio size factors (DESeq) of every sample.
+# The first pass bins the log ratios of each sample to find the bins its median falls in,
+# the second keeps only the log ratios in those bins to get the exact median.
+def median_ratio_factors(counts_tsv, chunk_rows=CHUNK_ROWS, id_columns=ID_COLUMNS):
+  num_samples = len(read_header(counts_tsv)) - id_columns
+  width = 2 * LOG_RATIO_RANGE / LOG_RATIO_BINS
+  def bins(ratios):
+    return(np.clip(((ratios + LOG_RATIO_RANGE) / width).astype(np.int64), 0, LOG_RATIO_BINS - 1))
+  histograms = np.zeros((num_samples, LOG_RATIO_BINS), dtype=np.int64)
+  num_guides = 0
+  for ids, counts in read_chunks(counts_tsv, chunk_rows, id_columns):
+    ratios = log_ratios(counts)
+    num_guides += len(ratios)
+    offsets = bins(ratios) + np.arange(num_samples) * LOG_RATIO_BINS
+    histograms += np.bincount(offsets.ravel(), minlength=num_samples * LOG_RATIO_BINS).reshape(num_samples, LOG_RATIO_BINS)
+  if num_guides == 0:
+    raise ValueError('No guide has reads in every sample of %s: median ratio normalisation is not possible' % counts_tsv)
+  # The median is the mean of the values ranked (n - 1) // 2 and n // 2
+  ranks = np.array([(num_guides - 1) // 2, num_guides // 2])
+  cumulative = histograms.cumsum(axis=1)
+  first_bin = np.array([np.searchsorted(c, ranks[0], side='right') for c in cumulative])
+  last_bin = np.array([np.searchsorted(c, ranks[1], side='right') for c in cumulative])
+  below = np.array([c[b - 1] if b else 0 for c, b in zip(cumulative, first_bin)])
+  kept = [[] for k in range(num_samples)]
+  for ids, counts in read_chunks(counts_tsv, chunk_rows, id_columns):
+    ratios = log_ratios(counts)
+    ratio_bins = bins(ratios)
+    for k in range(num_samples):
+      in_range = (ratio_bins[:,k] >= first_bin[k]) & (ratio_bins[:,k] <= last_bin[k])
+      kept[k].append(ratios[in_range,k])
+  medians = np.zeros(num_samples)
+  for k in range(num_samples):
+    values = np.sort(np.concatenate(kept[k]))
+    medians[k] = values[ranks - below[k]].mean()
+  return(np.exp(medians))
+
+
+# Function to get the size factor of every sample, which its counts are divided by
+def size_factors(counts_tsv, method='total', controls=CONTROL_PATTERN, chunk_rows=CHUNK_ROWS, id_columns=ID_COLUMNS):
+  if method not in METHODS:
+    raise ValueError('Unknown normalisation method %s (must be one of %s)' % (method, ', '.join(METHODS)))
+  samples = read_header(counts_tsv)[id_columns:]
+  if method == 'median_ratio':
+    return(median_ratio_factors(counts_tsv, chunk_rows, id_columns))
+  if method == 'control':
+    controls = read_controls(controls)
+  else:
+    controls = None
+  sums, control_sums, num_controls = column_sums(counts_tsv, controls, chunk_rows, id_columns)
+  if method == 'control':
+    if num_controls == 0:
+      raise ValueError('No control guides found in %s' % counts_tsv)
+    sums = control_sums
+  empty = [sample for sample, total in zip(samples, sums) if total <= 0]
+  if empty:
+    raise ValueError('No %sreads in sample(s) %s' % ('control guide ' if method == 'control' else '', ', '.join(empty)))
+  if method == 'cpm':
+    return(sums / 1e6)
+  return(sums / sums.mean())
+
+
+# Function to write the normalised counts of a counts file. Returns the size factors.
+def normalise(counts_tsv, out_file=None, method='total', controls=CONTROL_PATTERN, decimals=3,
+              chunk_rows=CHUNK_ROWS, id_columns=ID_COLUMNS):
+  if out_file is None:
+    out_file = os.path.join(os.path.dirname(counts_tsv), OUT_FILE)
+  factors = size_factors(counts_tsv, method, controls, chunk_rows, id_columns)
+  fmt = '%.' + str(decimals) + 'f'
+  temp_file = out_file + '.tmp'
+  with open(temp_file, 'w') as file_obj:
+    file_obj.write('\t'.join(read_header(counts_tsv)) + '\n')
+    for ids, counts in read_chunks(counts_tsv, chunk_rows, id_columns):
+      values = np.char.mod(fmt, counts / factors)
+      file_obj.writelines('\t'.join(row_ids + list(row)) + '\n' for row_ids, row in zip(ids, values))
+  os.replace(temp_file, out_file)
+  return(factors)
 
-file_list = glob.glob('*.tsv')
 
-#Copies MAGeCK file into dataframe
-df = pd.read_csv(file_list[0],sep='\t')
+# Function to find the aggregated counts file of the current folder
+def find_counts_file():
+  file_list = sorted(glob.glob('counts_aggregated_*.tsv')) or sorted(f for f in glob.glob('*.tsv') if f != OUT_FILE)
+  if not file_list:
+    raise IOError('No counts file (.tsv) found in %s' % os.getcwd())
+  return(file_list[0])
 
-#Creates new dataframe with just guide counts
-df1 = df.select_dtypes(include=['integer'])
 
-header_list = []
-for col in df1.columns:
-    header_list.append(col)
-    
-header_count = len(header_list)
+if __name__ == '__main__':
 
-column_sum = df1.sum()
-column_sum2 = list(column_sum)
-total_sum = column_sum.sum()
+  from argparse import ArgumentParser
 
-exp_fract = 1/header_count
+  arg_parse = ArgumentParser(prog=PROG_NAME, description='Normalises the guide counts of an aggregated counts file.')
+  arg_parse.add_argument('counts_tsv', metavar='COUNTS_TSV', nargs='?', default=None,
+                         help='Aggregated counts file (e.g. counts_aggregated_mageck.tsv). Default: the one in the current folder')
+  arg_parse.add_argument('-method', default='total', choices=METHODS, help='Normalisation method. Default: total')
+  arg_parse.add_argument('-controls', default=CONTROL_PATTERN,
+                         help='''Control guides for -method control: a file of guide names (one per line), or a regular
+                                 expression matched to guide and gene names. Default: %s''' % CONTROL_PATTERN.replace('%', '%%'))
+  arg_parse.add_argument('-decimals', default=3, type=int, help='Decimal places of the normalised counts. Default: 3')
+  arg_parse.add_argument('-o', '--out', default=None, help='Output file. Default: %s next to the counts file' % OUT_FILE)
 
-counter = 0
-while counter < header_count:
-        for x in column_sum2:
-            y = x / total_sum #fraction of total reads
-            z = exp_fract / y #normalisation factor
-            df[header_list[counter]] = df[header_list[counter]].multiply(z) #normalisation of guide counts
-            df[header_list[counter]] = df[header_list[counter]].astype(int)
-            counter += 1
+  args = vars(arg_parse.parse_args())
 
-df.to_csv('normalised-counts-aggregated.tsv', sep='\t',index=False)
\ No newline at end of file
+  counts_tsv = args['counts_tsv'] or find_counts_file()
+  factors = normalise(counts_tsv, args['out'], args['method'], args['controls'], args['decimals'])
+  for sample, factor in zip(read_header(counts_tsv)[ID_COLUMNS:], factors):
+    print('%s\tsize factor %.6g' % (sample, factor))
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+"""
+Live progress events of a CAM run.
+
+With -progress, CAM writes JSON lines to a pipe (file descriptor), a named
+pipe (FIFO), a Unix socket or a file while it runs:
+
+  {"event": "stage", "stage": "counting", "state": "start", "time": ...}
+  {"event": "sample", "stage": "counting", "sample": "s1.fastq.gz", "state": "running",
+   "reads": 1200000, "reads_per_s": 350000.0, "fraction": 0.42, "eta_s": 9.5, "time": ...}
+  {"event": "stage", "stage": "counting", "state": "done", "wall_s": 21.3, "reads": 2400000, "time": ...}
+  {"event": "run", "state": "done", "counts_aggregated": ..., "time": ...}
+
+Stage events come from run_report stages. Sample events come from the
+loops that read each input file (counting, protospacer extraction, sam/bam
+parsing, alignment). They are sent at most once per INTERVAL seconds per
+sample, plus a last one when the sample is done. fraction and eta_s come
+from how far into the file reading has got (in compressed bytes for gzip
+files), and are null when that is not known (e.g. reads from a pipe).
+
+Each event is written with a single write, so events from worker processes
+(which inherit the destination when forked) do not interleave. Without a
+destination, no events are built and trackers only add up reads.
+
+Usage: python3 progress.py events.fifo (creates the FIFO and prints the events of a run started with -progress events.fifo)
+"""
+
+import json
+import os
+import socket
+import stat
+import time
+from itertools import islice
+
+
+INTERVAL = 1.0 # seconds between the events of a sample
+BLOCK_READS = 1 << 16 # reads between progress checks when iterating over lines
+
+
+class Progress(object):
+  """
+  Destination of the progress events of a run (a file descriptor), and the current stage.
+  """
+  def __init__(self, fd=None, owned=False):
+    self.fd = fd
+    self.owned = owned # the descriptor was opened here, so it is closed here
+    self.stage = None
+
+  @property
+  def enabled(self):
+    return(self.fd is not None)
+
+  def emit(self, event, **fields):
+    if self.fd is None:
+      return
+    fields['event'] = event
+    fields['time'] = round(time.time(), 3)
+    try:
+      os.write(self.fd, (json.dumps(fields) + '\n').encode('utf-8'))
+    except OSError:
+      # Nobody is listening any more (e.g. the GUI was closed): the run goes on without events
+      self.fd = None
+
+  def stage_start(self, name):
+    self.stage = name
+    self.emit('stage', stage=name, state='start')
+
+  def stage_done(self, name, wall_s=None, reads=None):
+    self.emit('stage', stage=name, state='done', wall_s=wall_s, reads=reads)
+    self.stage = None
+
+  # Tracker of one sample of the current stage (size: bytes of its input file, if known)
+  def tracker(self, sample, size=None, stage=None):
+    return(Tracker(self, stage or self.stage, sample, size))
+
+  def close(self):
+    if self.fd is not None and self.owned:
+      os.close(self.fd)
+    self.fd = None
+
+
+class Tracker(object):
+  """
+  Reads processed for one sample, sent as progress events at most every INTERVAL seconds.
+  """
+  def __init__(self, progress, stage, sample, size=None):
+    self.progress = progress
+    self.stage = stage
+    self.sample = sample
+    self.size = size
+    self.reads = 0
+    self.started = time.time()
+    self._last = 0.0
+
+  # Adds reads processed and, if known, the bytes of the input file read so far
+  def update(self, reads, position=None):
+    self.reads += reads
+    if not self.progress.enabled:
+      return
+    now = time.time()
+    if now - self._last >= INTERVAL:
+      self._last = now
+      self._send('running', position, now)
+
+  def start(self):
+    self._send('running', 0, time.time())
+
+  def done(self):
+    self._send('done', self.size, time.time())
+
+  # Function to pass lines through, adding up the reads (one per line) every BLOCK_READS lines.
+  # file_obj is the file the lines come from, to know how far into it reading has got.
+  def lines(self, lines, file_obj=None):
+    if not self.progress.enabled:
+      return(lines)
+    def tracked():
+      it = iter(lines)
+      while True:
+        block = list(islice(it, BLOCK_READS))
+        if not block:
+          return
+        yield from block
+        self.update(len(block), file_position(file_obj))
+    return(tracked())
+
+  def _send(self, state, position, now):
+    if not self.progress.enabled:
+      return
+    elapsed = now - self.started
+    event = {'stage': self.stage, 'sample': self.sample, 'state': state, 'reads': self.reads,
+             'reads_per_s': round(self.reads / elapsed, 1) if elapsed > 0 else None, 'fraction': None, 'eta_s': None}
+    if position is not None and self.size:
+      fraction = min(1.0, position / float(self.size))
+      event['fraction'] = round(fraction, 4)
+      if 0 < fraction < 1:
+        event['eta_s'] = round(elapsed * (1 - fraction) / fraction, 1)
+    self.progress.emit('sample', **event)
+
+
+# Function to get how far into its file reading has got through a file object (in bytes of the file
+# itself, e.g. compressed bytes of a gzip file), or None if it is not known (e.g. pipes)
+def file_position(file_obj):
+  if file_obj is None:
+    return(None)
+  try:
+    return(os.lseek(file_obj.fileno(), 0, os.SEEK_CUR))
+  except (AttributeError, OSError, ValueError):
+    return(None)
+
+
+# Function to open a progress destination: a file descriptor number, a Unix socket, a FIFO or a file
+def open_destination(destination):
+  if isinstance(destination, int) or str(destination).isdigit():
+    return(int(destination), False)
+  if os.path.exists(destination) and stat.S_ISSOCK(os.stat(destination).st_mode):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(destination)
+    return(sock.detach(), True)
+  return(os.open(destination, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644), True)
+
+
+# Function to get the tracker of an input file of the current stage (the sample is the file name)
+def file_tracker(path):
+  size = None
+  if os.path.isfile(path):
+    size = os.path.getsize(path)
+  return(get_progress().tracker(os.path.basename(path), size))
+
+
+# Function to describe a sample event in a few words (e.g. for a progress bar)
+def describe(event):
+  words = ['{:,} reads'.format(event['reads'])]
+  if event.get('reads_per_s'):
+    words.append('{:,.0f} reads/s'.format(event['reads_per_s']))
+  if event['state'] == 'done':
+    words.append('done')
+  elif event.get('eta_s') is not None:
+    words.append('ETA %d:%02d' % divmod(int(event['eta_s']), 60))
+  return(', '.join(words))
+
+
+_progress = Progress()
+
+
+def init_progress(destination=None):
+  global _progress
+  _progress.close()
+  if destination is None:
+    _progress = Progress()
+  else:
+    _progress = Progress(*open_destination(destination))
+  return _progress
+
+
+def get_progress():
+  return _progress
+
+
+if __name__ == '__main__':
+
+  from argparse import ArgumentParser
+
+  arg_parse = ArgumentParser(prog='progress', description='Print the progress events of a CAM run started with -progress FIFO.')
+  arg_parse.add_argument('fifo', metavar='FIFO', help='Named pipe to read the events from (created if it does not exist)')
+  args = vars(arg_parse.parse_args())
+
+  if not os.path.exists(args['fifo']):
+    os.mkfifo(args['fifo'])
+  with open(args['fifo'], 'r') as file_obj:
+    for line in file_obj:
+      event = json.loads(line)
+      if event['event'] == 'sample':
+        print('%s %s: %s' % (event['stage'], event['sample'], describe(event)), flush=True)
+      elif event['event'] == 'stage':
+        print('Stage %s %s' % (event['stage'], 'started' if event['state'] == 'start' else 'done'), flush=True)
+      else:
+        print('Run %s' % event['state'], flush=True)
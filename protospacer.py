@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+"""
+In-process protospacer extraction for CAM (-trimmer native).
+
+Replaces the trim_galore pass, which writes a trimmed copy of every FASTQ
+file. Reads are collapsed into unique sequences as they are read, then the
+protospacer is cut out of each unique sequence once. The 3' vector (adapter)
+is located allowing the configured error rate, and the bases before it are
+kept, minus the --clip_R1 bases at the 5' end. Reads shorter than --length
+after clipping are dropped, like trim_galore does.
+
+The options are read from the same string as -trim_galore (-a, -e, --length,
+--clip_R1, --stringency). When no adapter is given, the 3' vector of the
+library in libraries_info.csv is used.
+
+Differences with cutadapt: only substitutions are allowed (no indels) and
+reads are not quality trimmed.
+"""
+
+import functools
+import shlex
+from collections import Counter
+from itertools import islice
+
+import fastq_reader
+import guide_counts
+import progress
+
+
+DEFAULT_ADAPTER = 'GTTTAAGAGCTA'
+ADAPTER_LENGTH = 12 # trim_galore uses the first 12 bp of its adapters
+DEFAULT_SETTINGS = {'adapter': DEFAULT_ADAPTER, 'error_rate': 0.2, 'min_length': 11, 'clip5': 1, 'min_overlap': 1}
+
+# Most reads of a fastq file are seen in every chunk of it (see fastq_reader.py), so each process
+# keeps the protospacers it has already extracted, up to MAX_CACHED reads
+MAX_CACHED = 1 << 19
+_cache_key = None
+_cache = {}
+
+# trim_galore option -> (setting, type)
+TRIM_OPTIONS = {'-a': ('adapter', str),
+                '--adapter': ('adapter', str),
+                '-e': ('error_rate', float),
+                '--length': ('min_length', int),
+                '--clip_R1': ('clip5', int),
+                '--stringency': ('min_overlap', int)}
+
+
+# Function to read the extraction settings from a trim_galore options string.
+# Returns the settings and the options that are not supported (ignored).
+def parse_trim_args(trim_galore=None, adapter=None):
+  settings = dict(DEFAULT_SETTINGS)
+  if adapter:
+    settings['adapter'] = adapter[:ADAPTER_LENGTH]
+  ignored = []
+  args = shlex.split(trim_galore or '')
+  k = 0
+  while k < len(args):
+    arg = args[k]
+    value = None
+    if '=' in arg:
+      arg, value = arg.split('=', 1)
+    if arg in TRIM_OPTIONS:
+      if value is None:
+        k += 1
+        value = args[k]
+      key, cast = TRIM_OPTIONS[arg]
+      settings[key] = cast(value)
+    else:
+      ignored.append(args[k])
+    k += 1
+  settings['adapter'] = settings['adapter'].upper()
+  return(settings, ignored)
+
+
+# Function to find where the adapter starts in a read. Every position where the adapter, or for
+# partial=True just the start of it at the 3' end of the read, matches with at most error_rate x overlap
+# substitutions is scored as in cutadapt (matches - mismatches), and the leftmost best match wins.
+# Returns None if the adapter is not found.
+def adapter_position(seq, adapter, error_rate=0.2, min_overlap=1, partial=True):
+  # Nothing can score higher than a full exact match
+  exact = seq.find(adapter)
+  if exact >= 0:
+    return(exact)
+  length = len(adapter)
+  last = len(seq) - length
+  if partial:
+    last = len(seq) - min_overlap
+  best = None
+  best_score = 0
+  for start in range(last + 1):
+    overlap = min(length, len(seq) - start)
+    max_errors = int(error_rate * overlap)
+    errors = 0
+    for a, b in zip(seq[start:start + overlap], adapter):
+      if a != b:
+        errors += 1
+        if errors > max_errors:
+          break
+    else:
+      score = overlap - 2 * errors
+      if score > best_score:
+        best, best_score = start, score
+  return(best)
+
+
+# Function to cut the protospacer out of a read.
+# Returns the protospacer (None if the read is too short) and whether the adapter was found.
+def extract(seq, settings, partial=True):
+  pos = adapter_position(seq, settings['adapter'], settings['error_rate'], settings['min_overlap'], partial)
+  if pos is not None:
+    seq = seq[:pos]
+  clip5 = settings['clip5']
+  if clip5 and len(seq) > clip5:
+    seq = seq[clip5:]
+  if len(seq) < settings['min_length']:
+    return(None, pos is not None)
+  return(seq, pos is not None)
+
+
+# Function to get the protospacers already extracted by this process with the same settings
+def extraction_cache(settings, max_length=None):
+  global _cache_key, _cache
+  key = (tuple(sorted(settings.items())), max_length)
+  if key != _cache_key:
+    _cache_key = key
+    _cache = {}
+  return(_cache)
+
+
+# Function to get the part of a read that holds a protospacer of max_length and the adapter after it
+def read_window(settings, max_length):
+  return(settings['clip5'] + max_length + len(settings['adapter']))
+
+
+# Function to collapse read sequence lines into unique protospacers.
+# With max_length, reads are only looked at up to where a protospacer of max_length and the
+# adapter after it would end, which is enough for prefix matching against the guide library.
+# Returns protospacer -> number of reads, and trimming stats.
+def seq_line_protospacers(seq_lines, settings, max_length=None):
+  if max_length is not None:
+    # Reads that end within the window keep their newline, so partial adapters are only looked for at the real 3' end
+    window = read_window(settings, max_length)
+    seq_lines = (line[:window] for line in seq_lines)
+  return(read_protospacers(Counter(seq_lines), settings, max_length))
+
+
+# Function to extract the protospacers of unique reads (read -> number of reads).
+# Reads keep their newline if they end there (see seq_line_protospacers).
+def read_protospacers(read_counts, settings, max_length=None):
+  cache = extraction_cache(settings, max_length)
+  seq_counts = Counter()
+  stats = {'reads': 0, 'adapter_found': 0, 'too_short': 0}
+  for read, n in read_counts.items():
+    stats['reads'] += n
+    extracted = cache.get(read)
+    if extracted is None:
+      seq = read.rstrip('\n')
+      extracted = extract(seq, settings, partial=len(seq) < len(read))
+      if len(cache) < MAX_CACHED:
+        cache[read] = extracted
+    protospacer, found = extracted
+    if found:
+      stats['adapter_found'] += n
+    if protospacer is None:
+      stats['too_short'] += n
+    else:
+      seq_counts[protospacer] += n
+  return(seq_counts, stats)
+
+
+# Function to collapse a fastq file into unique protospacers
+def protospacer_counts(fastq, settings, max_length=None):
+  tracker = progress.file_tracker(fastq)
+  with guide_counts.open_fastq(fastq) as fq:
+    seq_counts, stats = seq_line_protospacers(tracker.lines(islice(fq, 1, None, 4), fq), settings, max_length)
+  tracker.done()
+  return(seq_counts, stats)
+
+
+# Function to generate the unique protospacers of a fastq file as fasta records for the aligners.
+# Read names carry the multiplicity, like collapse_fastq, so counts are restored after alignment.
+# The trimming stats are written to trim_log once all reads have been read.
+def collapsed_fasta(fastq, settings, trim_log=None):
+  seq_counts, stats = protospacer_counts(fastq, settings)
+  if trim_log is not None:
+    guide_counts.write_count_log(trim_log, stats)
+  for rank, (seq, n) in enumerate(seq_counts.most_common(), 1):
+    yield '>%d-%d\n%s\n' % (rank, n, seq)
+
+
+# Function to extract protospacers from read sequence lines and count guides.
+# trim5 bases are skipped before matching (same as aligner option -5).
+def count_seq_lines(seq_lines, library, settings, trim5=0):
+  seq_counts, stats = seq_line_protospacers(seq_lines, settings, trim5 + max(library.lengths))
+  return(count_protospacers(seq_counts, stats, library, trim5))
+
+
+# Function to count guides from unique protospacers, adding the counting stats to the trimming stats
+def count_protospacers(seq_counts, stats, library, trim5=0):
+  if trim5:
+    prefix_counts = Counter()
+    for seq, n in seq_counts.items():
+      prefix_counts[seq[trim5:]] += n
+    seq_counts = prefix_counts
+  counts, count_stats = guide_counts.assign_counts(seq_counts, library)
+  stats.update(count_stats)
+  return(counts, stats)
+
+
+# Function to extract the protospacers of one fastq file, count guides and write its counts files.
+# With num_workers > 1, the file is split into chunks counted by that many processes.
+def count_fastq_file(fastq_counts, library, settings, trim5=0, num_workers=1):
+  fastq, counts_file = fastq_counts
+  tracker = progress.file_tracker(fastq)
+  if num_workers > 1:
+    mapper = functools.partial(count_seq_lines, library=library, settings=settings, trim5=trim5)
+    counts, stats = fastq_reader.map_reduce(fastq, mapper, num_workers, on_partial=guide_counts.track_partials(tracker))
+  else:
+    with guide_counts.open_fastq(fastq) as fq:
+      counts, stats = count_seq_lines(tracker.lines(islice(fq, 1, None, 4), fq), library, settings, trim5)
+  tracker.done()
+  return(guide_counts.write_sample_counts(counts_file, library, counts, stats))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Library QC figures (guide frequency, pre/post ratio and Lorenz curves).
+
+Curves over all guides are decimated before plotting: they are sorted, so
+a fixed number of evenly spaced quantile points draws the same shape, and
+the first and last points, where the curves change fastest (and a log
+axis spreads them out), are all kept. A genome-wide library then takes a
+few thousand vertices per curve instead of hundreds of thousands.
+
+Figures are PNG and SVG by default, and several figures (e.g. groups of
+samples of an aggregated counts file) are rendered in parallel processes.
+
+Usage: python3 qc_plots.py counts_aggregated_mageck.tsv -formats png svg
+"""
+
+import multiprocessing
+import os
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import library_qc
+import normalise
+
+
+PROG_NAME = 'qc_plots'
+FORMATS = ['png', 'svg']
+NUM_POINTS = 2000 # evenly spaced quantile points of a curve
+END_POINTS = 200 # points kept at each end of a curve
+SAMPLES_PER_FIGURE = 8
+COLOURS = ['navy', 'green', 'red', 'darkorange', 'purple', 'teal', 'saddlebrown', 'grey']
+
+
+# Function to pick the points of a sorted curve of n points that are plotted:
+# num_points evenly spaced ones, plus the first and last end_points
+def decimation_indices(n, num_points=NUM_POINTS, end_points=END_POINTS):
+  if n <= num_points + 2 * end_points:
+    return(np.arange(n))
+  evenly_spaced = np.linspace(0, n - 1, num_points).round().astype(np.int64)
+  ends = np.concatenate([np.arange(end_points), np.arange(n - end_points, n)])
+  return(np.unique(np.concatenate([evenly_spaced, ends])))
+
+
+# Function to decimate a sorted curve (x, y)
+def decimate(x, y, num_points=NUM_POINTS, end_points=END_POINTS):
+  idx = decimation_indices(len(y), num_points, end_points)
+  return(np.asarray(x)[idx], np.asarray(y)[idx])
+
+
+# Function to render one figure from its description (a dict of plain data, so it can be sent to a worker process).
+# Returns the paths of the files written.
+def render(figure):
+  fig, ax = plt.subplots(figsize=figure.get('size', [6.4, 4.8]))
+  for k, line in enumerate(figure['lines']):
+    ax.plot(line['x'], line['y'], label=line.get('label'), color=line.get('colour', COLOURS[k % len(COLOURS)]), linewidth=1)
+  if figure.get('diagonal'):
+    ax.plot([0,1], [0,1], color='k', label='Ideal library', linewidth=1)#line plot of equality
+  if figure.get('log_y'):
+    ax.set_yscale('log')
+  ax.set(xlabel=figure.get('xlabel'), ylabel=figure.get('ylabel'))
+  ax.grid(True, color='0.9')
+  ax.set_axisbelow(True)
+  for k, text in enumerate(figure.get('texts', [])):
+    ax.text(0.05, 0.95 - 0.05 * k, text, transform=ax.transAxes, verticalalignment='top')
+  if any(line.get('label') for line in figure['lines']):
+    ax.legend(loc='lower right')
+  fig.tight_layout()
+  paths = []
+  for fmt in figure['formats']:
+    path = '%s.%s' % (figure['path'], fmt)
+    fig.savefig(path, dpi=150)
+    paths.append(path)
+  plt.close(fig)
+  return(paths)
+
+
+# Function to render figures, in parallel processes if there are several
+def render_figures(figures, num_workers=1):
+  num_workers = min(num_workers, len(figures))
+  if num_workers <= 1:
+    paths = [render(figure) for figure in figures]
+  else:
+    with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+      paths = pool.map(render, figures)
+  return([path for figure_paths in paths for path in figure_paths])
+
+
+# Figure of the counts of each sample, sorted and normalised to the total of `norm_total` (default: their own)
+def frequency_figure(sorted_counts, labels, path, formats=FORMATS, norm_total=None, colours=None):
+  lines = []
+  for k, label in enumerate(labels):
+    total = norm_total if norm_total else sorted_counts[:,k].sum()
+    x, y = decimate(np.arange(len(sorted_counts)), sorted_counts[:,k] / total)
+    lines.append({'x': x, 'y': y, 'label': label, 'colour': colours[k] if colours else COLOURS[k % len(COLOURS)]})
+  return({'path': path, 'formats': formats, 'lines': lines, 'log_y': True,
+          'xlabel': 'sgRNA', 'ylabel': 'Normalised sgRNA count'})
+
+
+# Figure of the sorted ratios of two samples
+def ratio_figure(ratios, path, formats=FORMATS, ylabel='Ratio'):
+  sorted_ratios = np.sort(ratios)
+  x, y = decimate(np.arange(len(sorted_ratios)), sorted_ratios)
+  return({'path': path, 'formats': formats, 'lines': [{'x': x, 'y': y, 'colour': 'navy'}], 'log_y': True,
+          'xlabel': 'sgRNA', 'ylabel': ylabel})
+
+
+# Figure of the Lorenz curves of each sample (from a column-sorted matrix), with their Gini indices
+def lorenz_figure(sorted_counts, labels, path, formats=FORMATS, colours=None):
+  curves = library_qc.lorenz_curves(sorted_counts)
+  gini = library_qc.gini(sorted_counts)
+  fractions = np.arange(len(curves)) / float(len(curves) - 1)
+  lines = []
+  texts = []
+  for k, label in enumerate(labels):
+    x, y = decimate(fractions, curves[:,k])
+    lines.append({'x': x, 'y': y, 'label': label, 'colour': colours[k] if colours else COLOURS[k % len(COLOURS)]})
+    texts.append('%s Gini index = %.3f' % (label, gini[k]))
+  return({'path': path, 'formats': formats, 'lines': lines, 'diagonal': True, 'texts': texts, 'size': [6, 6],
+          'xlabel': 'sgRNAs ranked by abundance', 'ylabel': 'Cumulative fraction of reads represented'})
+
+
+# Function to plot the guide frequency and Lorenz curves of every sample of a counts matrix,
+# SAMPLES_PER_FIGURE samples per figure. Returns the paths of the files written.
+def plot_samples(counts, samples, out_dir='.', formats=FORMATS, samples_per_figure=SAMPLES_PER_FIGURE, num_workers=1):
+  sorted_counts = np.sort(np.asarray(counts, dtype=np.float64), axis=0)
+  # Samples without reads have no curves
+  keep = [k for k in range(len(samples)) if sorted_counts[:,k].sum() > 0]
+  groups = [keep[k:k + samples_per_figure] for k in range(0, len(keep), samples_per_figure)]
+  figures = []
+  for g, group in enumerate(groups):
+    suffix = '-%d' % (g + 1) if len(groups) > 1 else ''
+    labels = [samples[k] for k in group]
+    figures.append(frequency_figure(sorted_counts[:,group], labels, os.path.join(out_dir, 'guides-frequency' + suffix), formats))
+    figures.append(lorenz_figure(sorted_counts[:,group], labels, os.path.join(out_dir, 'lorenz-curve' + suffix), formats))
+  return(render_figures(figures, num_workers))
+
+
+if __name__ == '__main__':
+
+  from argparse import ArgumentParser
+
+  arg_parse = ArgumentParser(prog=PROG_NAME, description='Guide frequency and Lorenz curves of every sample of an aggregated counts file.')
+  arg_parse.add_argument('counts_tsv', metavar='COUNTS_TSV', nargs='?', default=None,
+                         help='Aggregated counts file (e.g. counts_aggregated_mageck.tsv). Default: the one in the current folder')
+  arg_parse.add_argument('-o', '--out_dir', default='.', help='Output folder. Default: current folder')
+  arg_parse.add_argument('-formats', nargs='+', default=FORMATS, help='Figure formats. Default: png svg')
+  arg_parse.add_argument('-samples_per_figure', default=SAMPLES_PER_FIGURE, type=int,
+                         help='Number of samples per figure. Default: %d' % SAMPLES_PER_FIGURE)
+  arg_parse.add_argument('-cpu', default=os.cpu_count(), type=int, help='Number of figures rendered at once. Default: all cores')
+
+  args = vars(arg_parse.parse_args())
+
+  counts_tsv = args['counts_tsv'] or normalise.find_counts_file()
+  counts, samples = library_qc.read_counts(counts_tsv)
+  for path in plot_samples(counts, samples, args['out_dir'], args['formats'], args['samples_per_figure'], args['cpu']):
+    print(path)
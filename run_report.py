@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+"""
+Per-stage timing, throughput and memory report of a CAM run.
+
+Every stage (trimming, fastqc, index build, alignment, sam to bam, counting,
+aggregation, multiqc) is timed with stage(), which records:
+
+  wall_s              elapsed time
+  cpu_s               user + system time of CAM and of the processes it waited for
+  max_rss_mb          high-water resident memory of CAM, and of its largest child process
+  read_mb, write_mb   bytes read from / written to storage by CAM and its child processes
+  reads, reads_per_s  reads processed, when the stage knows them
+
+Subprocesses started through call() or popen()/wait() are also recorded one
+by one, with their exact resource use (os.wait4).
+
+The report is written as JSON (cam_run_report.json) after every stage, so
+that runs that fail still leave a report, and summary() gives a table for
+the end of the run. The start and end of every stage are also sent as live
+progress events (see progress.py).
+"""
+
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import progress
+
+
+REPORT_FILE = 'cam_run_report.json'
+MB = float(1 << 20)
+BLOCK_SIZE = 512 # unit of ru_inblock / ru_oublock
+
+
+# Function to read the storage I/O counters of this process, which include those of its waited-for
+# children (Linux only). Elsewhere, the block I/O of the children is used instead.
+def proc_io():
+  io = {'read_bytes': 0, 'write_bytes': 0}
+  try:
+    with open('/proc/self/io', 'r') as file_obj:
+      for line in file_obj:
+        key, value = line.split(':')
+        if key in io:
+          io[key] = int(value)
+  except (OSError, ValueError):
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = {'read_bytes': children.ru_inblock * BLOCK_SIZE, 'write_bytes': children.ru_oublock * BLOCK_SIZE}
+  return(io)
+
+
+# ru_maxrss is in KiB on Linux and in bytes on macOS
+def maxrss_mb(maxrss):
+  if os.uname().sysname == 'Darwin':
+    return(maxrss / MB)
+  return(maxrss / 1024.0)
+
+
+# Function to take a snapshot of the resources used so far by this process and its waited-for children
+def snapshot():
+  self_usage = resource.getrusage(resource.RUSAGE_SELF)
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  io = proc_io()
+  return({'time': time.time(),
+          'cpu': self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime,
+          'read_bytes': io['read_bytes'],
+          'write_bytes': io['write_bytes'],
+          'max_rss_self': maxrss_mb(self_usage.ru_maxrss),
+          'max_rss_children': maxrss_mb(children.ru_maxrss)})
+
+
+# Function to get the exit code of a process from a wait status
+def exit_code(status):
+  if os.WIFSIGNALED(status):
+    return(-os.WTERMSIG(status))
+  return(os.WEXITSTATUS(status))
+
+
+class RunReport(object):
+  """
+  Stage and subprocess records of one run. Stages are sequential,
+  subprocesses may run concurrently (e.g. several aligner jobs).
+  """
+  def __init__(self, path=None):
+    self.path = path
+    self.started = time.time()
+    self.stages = []
+    self.calls = []
+    self.info = {}
+    self._stage = None
+    self._lock = threading.Lock()
+
+  @contextmanager
+  def stage(self, name, reads=None):
+    record = {'stage': name, 'reads': reads}
+    start = snapshot()
+    self._stage = name
+    events = progress.get_progress()
+    events.stage_start(name)
+    try:
+      yield record
+    finally:
+      end = snapshot()
+      self._stage = None
+      wall = end['time'] - start['time']
+      record.update({'wall_s': round(wall, 3),
+                     'cpu_s': round(end['cpu'] - start['cpu'], 3),
+                     'max_rss_mb': round(end['max_rss_self'], 1),
+                     'max_rss_children_mb': round(end['max_rss_children'], 1),
+                     'read_mb': round((end['read_bytes'] - start['read_bytes']) / MB, 1),
+                     'write_mb': round((end['write_bytes'] - start['write_bytes']) / MB, 1)})
+      record['reads_per_s'] = None
+      if record['reads'] and wall > 0:
+        record['reads_per_s'] = round(record['reads'] / wall, 1)
+      with self._lock:
+        self.stages.append(record)
+      events.stage_done(name, record['wall_s'], record['reads'])
+      self.write()
+
+  def popen(self, cmdArgs, **kwargs):
+    proc = subprocess.Popen(cmdArgs, **kwargs)
+    proc.report_start = time.time()
+    proc.report_stage = self._stage
+    return(proc)
+
+  # Waits for a process started with popen() and records its resource use. Returns its exit code.
+  def wait(self, proc):
+    if proc.returncode is not None:
+      return(proc.returncode)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = exit_code(status)
+    record = {'stage': proc.report_stage,
+              'command': ' '.join(proc.args) if isinstance(proc.args, list) else proc.args,
+              'exit_code': proc.returncode,
+              'wall_s': round(time.time() - proc.report_start, 3),
+              'cpu_s': round(usage.ru_utime + usage.ru_stime, 3),
+              'max_rss_mb': round(maxrss_mb(usage.ru_maxrss), 1),
+              'read_mb': round(usage.ru_inblock * BLOCK_SIZE / MB, 1),
+              'write_mb': round(usage.ru_oublock * BLOCK_SIZE / MB, 1)}
+    with self._lock:
+      self.calls.append(record)
+    return(proc.returncode)
+
+  # Runs a command to completion (stdout/stderr may be file paths). Returns its exit code.
+  def call(self, cmdArgs, stdout=None, stderr=None):
+    files = []
+    try:
+      if isinstance(stdout, str):
+        stdout = open(stdout, 'w')
+        files.append(stdout)
+      if isinstance(stderr, str):
+        stderr = open(stderr, 'w')
+        files.append(stderr)
+      proc = self.popen(cmdArgs, stdout=stdout, stderr=stderr)
+      return(self.wait(proc))
+    finally:
+      for file_obj in files:
+        file_obj.close()
+
+  def as_dict(self):
+    with self._lock:
+      return({'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+              'wall_s': round(time.time() - self.started, 3),
+              'info': dict(self.info),
+              'stages': list(self.stages),
+              'calls': list(self.calls)})
+
+  def write(self, path=None):
+    path = path or self.path
+    if path is None:
+      return(None)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file_obj:
+      json.dump(self.as_dict(), file_obj, indent=1)
+    os.replace(temp_path, path)
+    return(path)
+
+  # Summary table of the stages, one line per stage
+  def summary(self):
+    lines = ['%-22s %9s %9s %12s %10s %10s %12s' % ('Stage', 'Wall (s)', 'CPU (s)', 'Max RSS (MB)', 'Read (MB)', 'Write (MB)', 'Reads/s')]
+    for record in self.stages:
+      reads_per_s = '-'
+      if record['reads_per_s']:
+        reads_per_s = '%.0f' % record['reads_per_s']
+      max_rss = max(record['max_rss_mb'], record['max_rss_children_mb'])
+      lines.append('%-22s %9.1f %9.1f %12.0f %10.0f %10.0f %12s' % (record['stage'][:22], record['wall_s'], record['cpu_s'], max_rss,
+                                                                 record['read_mb'], record['write_mb'], reads_per_s))
+    return(lines)
+
+
+_report = None
+
+
+def init_report(path=None):
+  global _report
+  _report = RunReport(path)
+  return _report
+
+
+def get_report():
+  if _report is None:
+    return init_report()
+  return _report
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""
+Parameter-aware cache of pipeline steps.
+
+A step is only skipped if a manifest written when it last completed says
+it was run with the same inputs, tool versions and arguments, and its
+outputs are still there, unchanged. This replaces skipping a step as soon
+as its output path exists (pragui.exists_skip), which reuses truncated
+files from runs that died mid-write and stale ones from runs with other
+options.
+
+Outputs are written under temporary names and renamed into place when the
+step succeeds. The manifest (<first output>.step.json) is written last.
+
+Input files are fingerprinted by size, modification time and a hash of
+their first and last MiB, so large fastq files aren't read in full on
+every run.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import subprocess
+
+
+MANIFEST_EXT = '.step.json'
+SAMPLE_SIZE = 1 << 20
+
+
+# Function to fingerprint a file from its size, modification time and first and last MiB
+def fingerprint(path):
+  stat = os.stat(path)
+  digest = hashlib.sha256()
+  with open(path, 'rb') as file_obj:
+    digest.update(file_obj.read(SAMPLE_SIZE))
+    if stat.st_size > SAMPLE_SIZE:
+      file_obj.seek(max(SAMPLE_SIZE, stat.st_size - SAMPLE_SIZE))
+      digest.update(file_obj.read(SAMPLE_SIZE))
+  return({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256_ends': digest.hexdigest()})
+
+
+# Function to get the version reported by a tool (first line of tool --version), or None if it can't be run
+@functools.lru_cache(maxsize=None)
+def tool_version(tool):
+  try:
+    proc = subprocess.run([tool, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+  except OSError:
+    return(None)
+  lines = proc.stdout.strip().splitlines()
+  # bowtie and bowtie2 print the path of their binary before the version
+  for line in lines:
+    if 'version' in line:
+      return(line[line.index('version'):])
+  if lines:
+    return(lines[0])
+  return(None)
+
+
+# Function to get the temporary path an output is written to until the step is committed.
+# The extension is kept (e.g. x.sam -> x.tmp.sam), as some tools rely on it.
+def temp_path(path):
+  base, ext = os.path.splitext(path)
+  return(base + '.tmp' + ext)
+
+
+def manifest_path(output):
+  return(output + MANIFEST_EXT)
+
+
+def output_stat(path):
+  stat = os.stat(path)
+  return({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+
+
+# Function to remove the manifest of an output (e.g. when the output is deleted on purpose)
+def forget(output):
+  if os.path.exists(manifest_path(output)):
+    os.remove(manifest_path(output))
+
+
+class Step(object):
+  """
+  One run of a tool that turns input files into output files.
+  inputs are file paths, tools are program names whose versions are recorded
+  and args is anything else that changes the outputs (must be JSON serialisable).
+  """
+  def __init__(self, name, outputs, inputs=(), tools=(), args=()):
+    self.name = name
+    self.outputs = list(outputs)
+    self.manifest = manifest_path(self.outputs[0])
+    self.record = {'step': name,
+                   'inputs': dict((os.path.abspath(f), fingerprint(f)) for f in inputs),
+                   'tools': dict((tool, tool_version(tool)) for tool in tools),
+                   'args': list(args)}
+    self.key = hashlib.sha256(json.dumps(self.record, sort_keys=True).encode()).hexdigest()
+
+  def temp(self, output):
+    return(temp_path(output))
+
+  # True if the step was completed with the same key and its outputs haven't changed since
+  def is_current(self):
+    try:
+      with open(self.manifest, 'r') as file_obj:
+        manifest = json.load(file_obj)
+      if manifest.get('key') != self.key:
+        return(False)
+      for output in self.outputs:
+        if manifest['outputs'].get(output) != output_stat(output):
+          return(False)
+    except (OSError, ValueError, KeyError):
+      return(False)
+    return(True)
+
+  # Invalidates the previous run and clears temporary files left by a failed one
+  def start(self):
+    forget(self.outputs[0])
+    for output in self.outputs:
+      if os.path.exists(self.temp(output)):
+        os.remove(self.temp(output))
+
+  # Moves the outputs into place and writes the manifest
+  def commit(self):
+    for output in self.outputs:
+      os.replace(self.temp(output), output)
+    manifest = dict(self.record)
+    manifest['key'] = self.key
+    manifest['outputs'] = dict((output, output_stat(output)) for output in self.outputs)
+    temp_manifest = self.temp(self.manifest)
+    with open(temp_manifest, 'w') as file_obj:
+      json.dump(manifest, file_obj, indent=1)
+    os.replace(temp_manifest, self.manifest)
+
+  # Removes the temporary outputs of a step that won't be committed
+  def discard(self):
+    for output in self.outputs:
+      if os.path.exists(self.temp(output)):
+        os.remove(self.temp(output))